@@ -4,3 +4,8 @@ from django.apps import AppConfig
 class LlmApiConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'llm_api'
+
+    def ready(self):
+        # fail at startup, not mid-request, if a prompt template is missing
+        from .prompt_templates import registry
+        registry.load()
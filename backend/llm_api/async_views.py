@@ -0,0 +1,384 @@
+"""
+Async variants of the LLM-bound views, mounted under /api/LLM/async/.
+
+Run the project under an ASGI server (uvicorn firmflow.asgi:application) and
+these views await OpenAI (AsyncOpenAI), Pinecone (asyncio index) and the
+database (Django's async ORM) instead of holding a worker thread for the
+whole call, so one process can serve many concurrent chats. Request and
+response bodies match the synchronous views in views.py.
+"""
+
+import asyncio
+import json
+import logging
+import time
+
+from asgiref.sync import sync_to_async
+from django.http import Http404, JsonResponse, StreamingHttpResponse
+from django.shortcuts import aget_object_or_404
+from django.views import View
+from rest_framework.exceptions import AuthenticationFailed
+from rest_framework_simplejwt.authentication import JWTAuthentication
+
+from . import semantic_cache
+from .conversation import conversation_context, conversation_summary, schedule_summary_refresh
+from .extraction import PDF_MAX_BYTES
+from .ingestion import source_for_job
+from .clients import UpstreamUnavailable, achat_completion
+from .model import aget_embedding, aretrieve_chunks
+from .models import AIInteraction, Document, Firm, IngestionJob, MainDocument
+from .plans import expire_stale, fail_stale_plan, is_stale, start_plan_generation_async
+from .prompt_templates import registry as prompt_templates
+from .views import (
+    GPT_MODEL, LAW_NAMESPACE, PLAN_STREAM_HEARTBEAT_SECONDS, PLAN_STREAM_MAX_SECONDS, compose_chat_messages,
+    dataset_namespaces, extra_document_context, new_document_messages, plan_stream_events, plan_stream_timeout,
+    plan_update_messages, save_chat_interaction, sse_event, upstream_error_status,
+)
+
+logger = logging.getLogger(__name__)
+
+
+def json_response(data, status=200):
+    return JsonResponse(data, status=status, json_dumps_params={"ensure_ascii": False})
+
+
+def event_stream_response(events):
+    response = StreamingHttpResponse(events, content_type="text/event-stream")
+    response["Cache-Control"] = "no-cache"
+    response["X-Accel-Buffering"] = "no"
+    return response
+
+
+def upstream_error_response(e):
+    response = json_response({"error": str(e)}, status=upstream_error_status(e))
+    if isinstance(e, UpstreamUnavailable):
+        response["Retry-After"] = str(max(1, round(e.retry_after)))
+    return response
+
+
+class AsyncAPIView(View):
+    """Async view with the same JWT authentication as the DRF views; handlers read self.data."""
+    authentication = JWTAuthentication()
+
+    @classmethod
+    def as_view(cls, **initkwargs):
+        view = super().as_view(**initkwargs)
+        view.csrf_exempt = True  # token-authenticated, like DRF's APIView
+        return view
+
+    async def dispatch(self, request, *args, **kwargs):
+        try:
+            result = await sync_to_async(self.authentication.authenticate)(request)
+        except AuthenticationFailed as e:
+            return json_response({"detail": e.detail}, status=401)
+        if result is None:
+            return json_response({"detail": "Authentication credentials were not provided."}, status=401)
+        request.user = result[0]
+
+        if request.content_type == "application/json":
+            try:
+                self.data = json.loads(request.body or b"{}")
+            except ValueError:
+                return json_response({"error": "Invalid JSON body."}, status=400)
+        else:
+            self.data = request.POST
+        return await super().dispatch(request, *args, **kwargs)
+
+    def get_list(self, name):
+        if hasattr(self.data, "getlist"):
+            return self.data.getlist(name)
+        return self.data.get(name, []) or []
+
+
+class AsyncSubmitPromptView(AsyncAPIView):
+    """Async SubmitPromptView. URL: /api/LLM/async/submit/<int:firm_id>/ (supports ?stream=1)."""
+
+    async def post(self, request, firm_id):
+        self.started = time.perf_counter()  # time to first token counts from request entry
+        user_prompt = str(self.data.get("prompt", "")).strip()
+        save_as_document = self.data.get("save_as_document", False)
+        document_id = self.data.get("document_id", None)
+
+        if not user_prompt:
+            return json_response({"error": "Prompt cannot be empty"}, status=400)
+
+        main_document = await aget_object_or_404(MainDocument.objects.select_related("firm"), firm_id=firm_id)
+        main_document = await sync_to_async(expire_stale)(main_document)
+        if main_document.status == MainDocument.STATUS_GENERATING:
+            return json_response({"error": "The plan is still being generated."}, status=409)
+        firm = main_document.firm
+        stream = request.GET.get("stream") in ("1", "true")
+
+        try:
+            return await self.respond(firm, main_document, user_prompt, document_id, save_as_document, stream)
+        except Http404:
+            raise  # an unknown document_id; Django answers 404
+        except Exception as e:
+            logger.exception("Firm %s: answering the prompt failed", firm.id)
+            return upstream_error_response(e)
+
+    async def respond(self, firm, main_document, user_prompt, document_id, save_as_document, stream):
+        scopes = [dataset_namespaces(firm, self.request.user), LAW_NAMESPACE]
+        conversation = asyncio.ensure_future(sync_to_async(conversation_context)(firm))
+        cache_embedding = None
+        self.cache_context = ""
+        if semantic_cache.ENABLED and not save_as_document and not document_id:
+            cache_embedding, summary = await asyncio.gather(
+                aget_embedding(user_prompt), sync_to_async(conversation_summary)(firm))
+            # the rolling summary and the namespaces are part of the key, the latest raw turns are not
+            self.cache_context = semantic_cache.context_key(summary, scopes)
+            cached = await sync_to_async(semantic_cache.lookup)(
+                firm, main_document.version, prompt_templates.version("systemPrompt.txt"), self.cache_context, cache_embedding)
+            if cached:
+                entry, similarity = cached
+                ai_response = entry.interaction.ai_response
+                await AIInteraction.objects.acreate(firm=firm, user_prompt=user_prompt, ai_response=ai_response)
+                await sync_to_async(schedule_summary_refresh)(firm)
+                body = {"response": ai_response, "rag_context": "", "cached": True, "similarity": round(similarity, 4)}
+                if stream:
+                    return event_stream_response(self.replay(ai_response, body))
+                return json_response(body)
+
+        # database reads and the vector lookups overlap
+        document_context, conversation_history, (retrieved_chunks, law_chunks) = await asyncio.gather(
+            sync_to_async(extra_document_context)(firm, document_id),
+            conversation,
+            aretrieve_chunks(user_prompt, scopes),
+        )
+        messages, context_from_chunks = compose_chat_messages(
+            firm, main_document, user_prompt, document_context, conversation_history,
+            retrieved_chunks, law_chunks, save_as_document)
+
+        if stream:
+            return event_stream_response(self.stream_response(
+                firm, main_document, user_prompt, messages, context_from_chunks, save_as_document, cache_embedding))
+
+        response = await achat_completion(
+            model="gpt-4",
+            messages=messages,
+            temperature=0.5
+        )
+        ai_response = response.choices[0].message.content.strip()
+        document = await sync_to_async(save_chat_interaction)(
+            firm, main_document, user_prompt, ai_response, save_as_document, cache_embedding, self.cache_context)
+
+        if document:
+            return json_response({"response": ai_response, "document": document.document_number, "message": "Response saved as document.", "rag_context": context_from_chunks})
+        return json_response({"response": ai_response, "rag_context": context_from_chunks})
+
+    async def replay(self, ai_response, body):
+        yield sse_event("token", {"text": ai_response})
+        yield sse_event("done", body)
+
+    async def stream_response(self, firm, main_document, user_prompt, messages, context_from_chunks, save_as_document, cache_embedding):
+        started = self.started
+        ttft_ms = None
+        parts = []
+
+        try:
+            stream = await achat_completion(
+                model="gpt-4",
+                messages=messages,
+                temperature=0.5,
+                stream=True
+            )
+            async for chunk in stream:
+                if not chunk.choices or not chunk.choices[0].delta.content:
+                    continue
+                token = chunk.choices[0].delta.content
+                if ttft_ms is None:
+                    ttft_ms = round((time.perf_counter() - started) * 1000)
+                    logger.info("Firm %s: first token after %d ms", firm.id, ttft_ms)
+                    yield sse_event("meta", {"ttft_ms": ttft_ms, "rag_context": context_from_chunks})
+                parts.append(token)
+                yield sse_event("token", {"text": token})
+        except Exception as e:
+            logger.exception("Firm %s: streaming completion failed", firm.id)
+            yield sse_event("error", {"error": str(e)})
+            return
+
+        ai_response = "".join(parts).strip()
+        document = await sync_to_async(save_chat_interaction)(
+            firm, main_document, user_prompt, ai_response, save_as_document, cache_embedding, self.cache_context)
+        total_ms = round((time.perf_counter() - started) * 1000)
+
+        done = {"response": ai_response, "ttft_ms": ttft_ms, "total_ms": total_ms, "rag_context": context_from_chunks}
+        if document:
+            done["document"] = document.document_number
+            done["message"] = "Response saved as document."
+        yield sse_event("done", done)
+
+
+class AsyncCreateFirmView(AsyncAPIView):
+    """Async CreateFirmView; the plan is generated by a task on the server's event loop."""
+
+    async def post(self, request):
+        firm_name = str(self.data.get("name", "")).strip()
+        firm_budget = str(self.data.get("budget", "")).strip()
+        firm_notes = str(self.data.get("description", "")).strip()
+
+        if not firm_name:
+            return json_response({"error": "Firm name is required"}, status=400)
+
+        firm = await Firm.objects.acreate(name=firm_name, description=firm_notes)
+        content = (
+            f"Name : {firm_name}\n"
+            f"Firm Budget : {firm_budget}\n"
+            f"Extra user descriptions / notes : {firm_notes}\n"
+        )
+        main_document = await MainDocument.objects.acreate(firm=firm, text="", status=MainDocument.STATUS_GENERATING)
+        start_plan_generation_async(main_document, content)
+
+        return json_response({
+            "firm_id": firm.id,
+            "plan_status": main_document.status,
+            "status_url": f"/api/LLM/firms/{firm.id}/plan/status/",
+            "stream_url": f"/api/LLM/async/firms/{firm.id}/plan/stream/"
+        }, status=201)
+
+
+class AsyncPlanStreamView(AsyncAPIView):
+    """
+    PlanStreamView as a live stream: token events as the plan is generated, then done or error,
+    or timeout after PLAN_STREAM_MAX_SECONDS. Waiting between reads is an asyncio.sleep, so an
+    open stream costs no worker; this is the stream clients should use under ASGI.
+    """
+    poll_interval = 0.5
+    max_seconds = PLAN_STREAM_MAX_SECONDS
+    heartbeat_seconds = PLAN_STREAM_HEARTBEAT_SECONDS
+
+    async def get(self, request, firm_id):
+        await aget_object_or_404(MainDocument, firm_id=firm_id)
+        return event_stream_response(self.events(firm_id))
+
+    async def events(self, firm_id):
+        sent = 0
+        started = last_write = time.monotonic()
+        while True:
+            row = await MainDocument.objects.filter(firm_id=firm_id).values_list(
+                "id", "text", "status", "error", "updated_at").afirst()
+            if row is None:  # the firm was deleted meanwhile
+                yield sse_event("error", {"status": None, "error": "Plan not found."})
+                return
+            main_document_id, text, doc_status, error, updated_at = row
+            if is_stale(doc_status, updated_at):
+                await sync_to_async(fail_stale_plan)(main_document_id, updated_at)
+                continue
+            events, finished = plan_stream_events(text, doc_status, error, sent)
+            for event in events:
+                yield event
+            if finished:
+                return
+            now = time.monotonic()
+            if len(text) > sent:
+                sent = len(text)
+                last_write = now
+            if now - started >= self.max_seconds:
+                yield plan_stream_timeout(firm_id, doc_status)
+                return
+            if now - last_write >= self.heartbeat_seconds:
+                yield ": heartbeat\n\n"
+                last_write = now
+            await asyncio.sleep(self.poll_interval)
+
+
+class AsyncEditMainDocumentAIView(AsyncAPIView):
+    """Async EditMainDocumentAIView."""
+
+    async def post(self, request, firm_id):
+        selected_messages = self.get_list("selected_messages")
+        if not selected_messages:
+            return json_response({"error": "selected_messages cannot be empty."}, status=400)
+
+        firm = await aget_object_or_404(Firm, id=firm_id)
+        main_document = await MainDocument.objects.filter(firm=firm).afirst()
+        if main_document:
+            main_document = await sync_to_async(expire_stale)(main_document)
+        if main_document and main_document.status == MainDocument.STATUS_GENERATING:
+            return json_response({"error": "The plan is still being generated."}, status=409)
+        current_plan = main_document.text if main_document else "No existing plan."
+
+        try:
+            response = await achat_completion(
+                model=GPT_MODEL,
+                messages=plan_update_messages(current_plan, selected_messages),
+                temperature=0.1
+            )
+        except Exception as e:
+            return upstream_error_response(e)
+
+        updated_plan = response.choices[0].message.content.strip()
+        if main_document:
+            main_document.text = updated_plan
+            # an edited plan is usable again, even if its generation had failed
+            main_document.status, main_document.error = MainDocument.STATUS_READY, ""
+            await main_document.asave()
+        else:
+            await MainDocument.objects.acreate(firm=firm, text=updated_plan)
+
+        return json_response({"updated_plan": updated_plan})
+
+
+class AsyncAddNewDoc(AsyncAPIView):
+    """Async AddNewDoc."""
+
+    async def post(self, request, firm_id):
+        selected_messages = self.get_list("selected_messages")
+        if not selected_messages:
+            return json_response({"error": "selected_messages cannot be empty."}, status=400)
+
+        firm = await aget_object_or_404(Firm, id=firm_id)
+
+        try:
+            response = await achat_completion(
+                model=GPT_MODEL,
+                messages=new_document_messages(selected_messages),
+                temperature=0.3
+            )
+        except Exception as e:
+            return upstream_error_response(e)
+
+        new_doc = response.choices[0].message.content.strip()
+        new_index = await sync_to_async(Document.next_number)(firm.id)
+        await Document.objects.acreate(firm=firm, document_number=new_index, title=f"Document {new_index}", text=new_doc)
+
+        return json_response({"updated_plan": new_doc})
+
+
+class AsyncRAGUploadView(AsyncAPIView):
+    """Async RAGUploadView; queues an ingestion job like the sync view."""
+
+    async def post(self, request):
+        text_input = str(self.data.get("rag_EXTRA", "")).strip()
+        url = str(self.data.get("url", "")).strip()
+        pdf_file = request.FILES.get("pdf_file")
+        name = str(self.data.get("name", "")).strip()
+        firm_id = self.data.get("firm_id")
+        firm = await aget_object_or_404(Firm, id=firm_id) if firm_id else None
+
+        if pdf_file:
+            if pdf_file.size > PDF_MAX_BYTES:
+                return json_response({"error": f"PDF uploads are limited to {PDF_MAX_BYTES // 1024 // 1024} MB."}, status=413)
+            job = IngestionJob(user=request.user, source_type=IngestionJob.SOURCE_PDF, file=pdf_file)
+        elif url:
+            job = IngestionJob(user=request.user, source_type=IngestionJob.SOURCE_URL, url=url)
+        elif text_input:
+            job = IngestionJob(user=request.user, source_type=IngestionJob.SOURCE_TEXT, text=text_input)
+        else:
+            return json_response({"error": "Provide either 'rag_EXTRA', 'url' or 'pdf_file'."}, status=400)
+
+        try:
+            await sync_to_async(job.full_clean)(exclude=["file"])
+        except Exception as e:
+            return json_response({"error": "Invalid upload.", "details": getattr(e, "message_dict", str(e))}, status=400)
+        job.firm = firm
+        job.source = await sync_to_async(source_for_job)(job, name, firm)
+        await job.asave()
+
+        return json_response({
+            "message": "Upload queued for RAG ingestion.",
+            "job_id": job.id,
+            "source_id": job.source_id,
+            "status": job.status,
+            "source_type": job.source_type
+        }, status=202)
@@ -0,0 +1,31 @@
+"""
+In-process thread pool for work that should not hold up a response,
+such as refreshing conversation summaries.
+"""
+
+import logging
+import os
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from django.db import close_old_connections, connections
+
+logger = logging.getLogger(__name__)
+
+executor = ThreadPoolExecutor(
+    max_workers=int(os.getenv("BACKGROUND_WORKERS", "4")),
+    thread_name_prefix="background",
+)
+
+
+def run_in_background(fn, *args, **kwargs) -> Future:
+    """Runs fn on the pool with its own database connection; errors are logged, not raised."""
+    def task():
+        close_old_connections()
+        try:
+            return fn(*args, **kwargs)
+        except Exception:
+            logger.exception("Background task %s failed", getattr(fn, "__name__", fn))
+        finally:
+            connections.close_all()
+
+    return executor.submit(task)
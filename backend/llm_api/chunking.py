@@ -0,0 +1,242 @@
+"""
+Structure-aware chunking for Bulgarian legal text.
+
+Text is split at its legal structure instead of at fixed character offsets:
+headings (Част, Глава, Раздел, ... разпоредби), articles (Чл. 5., § 3.),
+paragraphs ((1), ал. 2), points (1., т. 3.) and blank-line paragraphs. The
+pieces are then packed into chunks of up to CHUNK_MAX_TOKENS, starting a new
+chunk at every heading and, once a chunk is big enough, at every article.
+Each chunk carries its structural path (e.g. "Глава първа > Чл. 5, ал. 2")
+in its metadata.
+
+iter_chunks is a generator over lines, so input given as an iterable of text
+parts (pages, fetched blocks) streams through without the full chunk list
+being built. Parts given as (page_number, text) add "page" (and "page_end"
+when a chunk runs over a page break) to the chunk metadata. Plain text without
+legal markers falls back to paragraphs and sentences.
+"""
+
+import os
+import re
+from typing import Iterable, Iterator, List, NamedTuple, Optional, Tuple, Union
+
+Source = Union[str, Iterable[Union[str, Tuple[int, str]]]]
+
+try:
+    from .tokens import count_tokens
+except ImportError:  # imported by model.py run as a standalone script
+    from tokens import count_tokens
+
+CHUNK_MAX_TOKENS = int(os.getenv("CHUNK_MAX_TOKENS", "400"))
+# below this a chunk keeps absorbing the next article instead of closing
+CHUNK_MIN_TOKENS = int(os.getenv("CHUNK_MIN_TOKENS", "120"))
+
+# heading keyword -> nesting level; a heading closes every heading at its level or deeper
+HEADING_LEVELS = {"част": 0, "дял": 0, "глава": 1, "раздел": 2}
+HEADING = re.compile(
+    r"^(?:(#+)\s*\S.*"
+    r"|(Част|Дял|Глава|Раздел)\s+\S.*"
+    r"|(?:Допълнителн|Преходн|Заключителн)\S*\s+(?:и\s+\S+\s+)?разпоредби)$",
+    re.IGNORECASE,
+)
+ARTICLE = re.compile(r"^(Чл\.\s*\d+[а-я]?|§\s*\d+[а-я]?)\.\s*")
+ALINEA = re.compile(r"^(?:\((\d+[а-я]?)\)|ал\.\s*(\d+[а-я]?)\.?)\s+")
+POINT = re.compile(r"^(?:т\.\s*)?(\d{1,3}[а-я]?)\.\s+(?=\S)")
+# abbreviations whose period does not end a sentence: "чл. 5", "ал. 2", "т. 3", "2003 г.", "ДВ, бр. 58", "Изм. и доп."
+SENTENCE_ABBREVIATIONS = ("чл", "ал", "т", "г", "бр", "изм", "доп", "вж", "напр")
+SENTENCE_END = re.compile(
+    r"(?<=[.!?;])"
+    + "".join(rf"(?<!\b{variant}\.)" for abbreviation in SENTENCE_ABBREVIATIONS
+              for variant in {abbreviation, abbreviation.capitalize()})
+    + r"\s+"
+)
+HEADING_MAX_CHARS = 120
+
+
+class Chunk(NamedTuple):
+    text: str
+    metadata: dict
+
+
+class Piece(NamedTuple):
+    """One structural unit: an article opening, a paragraph, a point or a plain paragraph."""
+    lines: List[str]
+    heading: str
+    article: str
+    alinea: str
+    point: str
+    starts_article: bool
+    page: Optional[int]
+
+
+def is_title_line(line: str) -> bool:
+    """Upper-case title lines such as "ОБЩИ ПОЛОЖЕНИЯ" that follow a heading."""
+    return len(line) <= HEADING_MAX_CHARS and any(c.isalpha() for c in line) and line == line.upper() \
+        and not line.endswith((".", ",", ";", ":"))
+
+
+def structure_path(heading: str, article: str, alinea: str = "", point: str = "") -> str:
+    location = ", ".join(part for part in (
+        article, f"ал. {alinea}" if alinea else "", f"т. {point}" if point else "") if part)
+    return " > ".join(part for part in (heading, location) if part)
+
+
+def iter_lines(source: Source) -> Iterator[Tuple[Optional[int], str]]:
+    parts = [source] if isinstance(source, str) else source
+    for part in parts:
+        page, text = part if isinstance(part, tuple) else (None, part)
+        for line in text.splitlines():
+            yield page, line
+        yield page, ""  # a part boundary ends the current paragraph
+
+
+def heading_level(match: re.Match) -> int:
+    if match.group(1):
+        return len(match.group(1)) - 1
+    if match.group(2):
+        return HEADING_LEVELS[match.group(2).lower()]
+    return 1  # transitional/final provisions sit at chapter level
+
+
+def iter_pieces(source: Source) -> Iterator[Piece]:
+    headings: List[List] = []  # open headings as [level, title]
+    heading = article = alinea = point = ""
+    lines: List[str] = []
+    starts_article = False
+    piece_path = ("", "", "", "")
+    piece_page = None
+
+    def flush():
+        nonlocal lines, starts_article
+        if lines:
+            yield Piece(lines, *piece_path, starts_article, piece_page)
+        lines, starts_article = [], False
+
+    previous_was_heading = False
+    at_start = True  # upper-case lines before any body text are the document title
+    for page, raw in iter_lines(source):
+        line = " ".join(raw.split())
+        if not line:
+            yield from flush()
+            continue
+
+        new_heading = HEADING.match(line) if len(line) <= HEADING_MAX_CHARS else None
+        document_title = at_start and not new_heading and is_title_line(line)
+        if new_heading or document_title or (previous_was_heading and is_title_line(line)):
+            yield from flush()
+            if new_heading:
+                level = heading_level(new_heading)
+                headings = [h for h in headings if h[0] < level] + [[level, line.lstrip("# ")]]
+            elif document_title and not headings:
+                headings = [[-1, line]]  # "ТЪРГОВСКИ ЗАКОН" above every Част/Глава
+            else:
+                headings[-1][1] += f" {line}"  # "Глава първа" + "ОБЩИ ПОЛОЖЕНИЯ"
+            heading = " > ".join(title for _, title in headings)
+            article = alinea = point = ""
+            previous_was_heading = True
+            continue
+        previous_was_heading = False
+
+        new_article = ARTICLE.match(line)
+        rest = line[new_article.end():] if new_article else line
+        new_alinea = ALINEA.match(rest)
+        new_point = None if new_article or new_alinea else POINT.match(line)
+
+        if new_article or new_alinea or new_point:
+            yield from flush()
+            if new_article:
+                article, alinea, point = " ".join(new_article.group(1).split()), "", ""
+                starts_article = True
+            if new_alinea:
+                alinea, point = new_alinea.group(1) or new_alinea.group(2), ""
+            if new_point:
+                point = new_point.group(1)
+        if not lines:
+            piece_path = (heading, article, alinea, point)
+            piece_page = page
+        lines.append(line)
+        at_start = False
+    yield from flush()
+
+
+def split_oversized(text: str, max_tokens: int) -> Iterator[str]:
+    """Splits one over-budget piece at sentence ends, then at spaces, then hard."""
+    current, current_tokens = [], 0
+    for sentence in SENTENCE_END.split(text):
+        tokens = count_tokens(sentence)
+        if tokens > max_tokens:
+            if current:
+                yield " ".join(current)
+                current, current_tokens = [], 0
+            words = sentence.split(" ")
+            step = max(1, len(words) * max_tokens // tokens)
+            for i in range(0, len(words), step):
+                part = " ".join(words[i:i + step])
+                if count_tokens(part) > max_tokens:  # a single huge "word"
+                    size = max(1, len(part) * max_tokens // count_tokens(part))
+                    yield from (part[j:j + size] for j in range(0, len(part), size))
+                else:
+                    yield part
+            continue
+        if current and current_tokens + tokens > max_tokens:
+            yield " ".join(current)
+            current, current_tokens = [], 0
+        current.append(sentence)
+        current_tokens += tokens
+    if current:
+        yield " ".join(current)
+
+
+def iter_chunks(source: Source, max_tokens: Optional[int] = None,
+                min_tokens: Optional[int] = None) -> Iterator[Chunk]:
+    """
+    Yields chunks of at most max_tokens (plus a short path header on chunks
+    that start inside an article). Chunk metadata has "path", the structural
+    path where the chunk starts and, if different, where it ends, and "heading".
+    """
+    max_tokens = max_tokens or CHUNK_MAX_TOKENS
+    min_tokens = CHUNK_MIN_TOKENS if min_tokens is None else min_tokens
+    pieces: List[Piece] = []
+    texts: List[str] = []
+    tokens = 0
+
+    def make_chunk() -> Chunk:
+        first, last = pieces[0], pieces[-1]
+        path = structure_path(first.heading, first.article, first.alinea, first.point)
+        end = structure_path("", last.article, last.alinea, last.point)
+        if end and (last.article, last.alinea, last.point) != (first.article, first.alinea, first.point):
+            path = f"{path} – {end}"
+        text = "\n".join(texts)
+        if first.article and not first.starts_article:
+            # continuing an article: say which one, so the chunk stands on its own
+            text = f"[{structure_path('', first.article)}]\n{text}"
+        metadata = {"path": path, "heading": first.heading}
+        if first.page is not None:
+            metadata["page"] = first.page
+            if last.page != first.page:
+                metadata["page_end"] = last.page
+        return Chunk(text, metadata)
+
+    for piece in iter_pieces(source):
+        text = " ".join(piece.lines)
+        piece_tokens = count_tokens(text)
+        if pieces and (
+            piece.heading != pieces[-1].heading
+            or (piece.starts_article and tokens >= min_tokens)
+            or tokens + piece_tokens > max_tokens
+        ):
+            yield make_chunk()
+            pieces, texts, tokens = [], [], 0
+
+        if piece_tokens > max_tokens:
+            for i, part in enumerate(split_oversized(text, max_tokens)):
+                pieces, texts = [piece if i == 0 else piece._replace(starts_article=False)], [part]
+                yield make_chunk()
+            pieces, texts, tokens = [], [], 0
+            continue
+
+        pieces.append(piece)
+        texts.append(text)
+        tokens += piece_tokens
+    if pieces:
+        yield make_chunk()
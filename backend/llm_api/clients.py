@@ -0,0 +1,324 @@
+"""
+Shared OpenAI and Pinecone clients.
+
+Every module gets its clients from here instead of building its own:
+
+- OpenAI (sync and async) run on keep-alive httpx pools with bounded sizes,
+  and Pinecone on a bounded urllib3 pool.
+- Each call type (chat, streamed chat, embeddings, vector query/upsert) has
+  its own timeout.
+- Rate limits, timeouts and 5xx responses are retried with jittered
+  exponential backoff, drawing on a process-wide retry budget so an outage
+  cannot multiply the load with retries.
+- A circuit breaker per upstream opens after repeated failures; while open,
+  calls fail at once with UpstreamUnavailable instead of piling up workers.
+
+The SDKs are imported and the clients built on first use (get_openai_client,
+get_index, ...), so importing the app - migrate, check, the test runner,
+worker boot - needs neither the SDK import time nor credentials.
+"""
+
+import asyncio
+import os
+import random
+import threading
+import time
+
+HTTP_MAX_CONNECTIONS = int(os.getenv("HTTP_MAX_CONNECTIONS", "50"))
+HTTP_MAX_KEEPALIVE = int(os.getenv("HTTP_MAX_KEEPALIVE", "20"))
+HTTP_KEEPALIVE_EXPIRY = 30.0
+CONNECT_TIMEOUT = 5.0
+
+# read timeouts (seconds) per call type; for streams this is the gap allowed between chunks
+TIMEOUTS = {
+    "chat": float(os.getenv("CHAT_TIMEOUT", "120")),
+    "chat_stream": float(os.getenv("CHAT_STREAM_TIMEOUT", "30")),
+    "embeddings": float(os.getenv("EMBEDDINGS_TIMEOUT", "30")),
+    "vector_query": float(os.getenv("VECTOR_QUERY_TIMEOUT", "10")),
+    "vector_write": float(os.getenv("VECTOR_WRITE_TIMEOUT", "60")),
+}
+
+RETRY_ATTEMPTS = 5
+RETRY_BASE_DELAY = 1.0
+RETRY_MAX_DELAY = 30.0
+
+
+class UpstreamUnavailable(Exception):
+    """Raised without calling the upstream while its circuit breaker is open."""
+
+    def __init__(self, service: str, retry_after: float):
+        super().__init__(f"{service} is unavailable, retry in {retry_after:.0f}s")
+        self.service = service
+        self.retry_after = retry_after
+
+
+def is_retryable(exc: Exception) -> bool:
+    """Rate limits, timeouts and 5xx from OpenAI or Pinecone are worth another try."""
+    import httpx
+    from openai import APIConnectionError, APITimeoutError, RateLimitError
+
+    if isinstance(exc, (RateLimitError, APIConnectionError, APITimeoutError, httpx.TimeoutException)):
+        return True
+    status = getattr(exc, "status_code", None) or getattr(exc, "status", None)
+    return status == 429 or (isinstance(status, int) and status >= 500)
+
+
+class RetryBudget:
+    """
+    Token bucket shared by all calls: every call deposits `ratio` tokens and
+    every retry spends one, so retries stay at roughly `ratio` of traffic
+    (plus a small floor) no matter how many requests are failing.
+    """
+
+    def __init__(self, ratio: float = 0.2, floor: float = 10.0):
+        self.ratio = ratio
+        self.floor = floor
+        self.balance = floor
+        self.lock = threading.Lock()
+
+    def deposit(self):
+        with self.lock:
+            self.balance = min(self.floor + 100 * self.ratio, self.balance + self.ratio)
+
+    def withdraw(self) -> bool:
+        with self.lock:
+            if self.balance < 1:
+                return False
+            self.balance -= 1
+            return True
+
+
+class CircuitBreaker:
+    """Opens after `threshold` consecutive failures; lets one trial call through after `reset_after` seconds."""
+
+    def __init__(self, service: str, threshold: int = 5, reset_after: float = 30.0):
+        self.service = service
+        self.threshold = threshold
+        self.reset_after = reset_after
+        self.failures = 0
+        self.opened_at = None
+        self.trial_running = False
+        self.lock = threading.Lock()
+
+    def before_call(self):
+        with self.lock:
+            if self.opened_at is None:
+                return
+            waited = time.monotonic() - self.opened_at
+            if waited < self.reset_after or self.trial_running:
+                raise UpstreamUnavailable(self.service, max(0.0, self.reset_after - waited))
+            self.trial_running = True  # half-open
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial_running = False
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            self.trial_running = False
+            if self.opened_at is not None or self.failures >= self.threshold:
+                self.opened_at = time.monotonic()
+
+    def release_trial(self):
+        """A call that ended without an answer either way (cancelled, interrupted) frees the trial slot."""
+        with self.lock:
+            self.trial_running = False
+
+    def state(self) -> str:
+        with self.lock:
+            if self.opened_at is None:
+                return "closed"
+            return "half-open" if time.monotonic() - self.opened_at >= self.reset_after else "open"
+
+
+retry_budget = RetryBudget(ratio=float(os.getenv("RETRY_BUDGET_RATIO", "0.2")))
+breakers = {
+    "openai": CircuitBreaker("openai"),
+    "pinecone": CircuitBreaker("pinecone"),
+}
+
+
+def backoff_delay(attempt: int) -> float:
+    return min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt) * random.uniform(0.5, 1.0)
+
+
+def call(service: str, fn, *args, **kwargs):
+    """Calls an upstream through its circuit breaker, retrying within the retry budget."""
+    breaker = breakers[service]
+    retry_budget.deposit()
+    for attempt in range(RETRY_ATTEMPTS):
+        breaker.before_call()
+        try:
+            result = fn(*args, **kwargs)
+        except Exception as e:
+            if not is_retryable(e):
+                breaker.record_success()  # the upstream answered; the request itself was bad
+                raise
+            breaker.record_failure()
+            if attempt == RETRY_ATTEMPTS - 1 or not retry_budget.withdraw():
+                raise
+            time.sleep(backoff_delay(attempt))
+        except BaseException:
+            breaker.release_trial()
+            raise
+        else:
+            breaker.record_success()
+            return result
+
+
+async def acall(service: str, fn, *args, **kwargs):
+    """Async counterpart of call() for coroutine functions."""
+    breaker = breakers[service]
+    retry_budget.deposit()
+    for attempt in range(RETRY_ATTEMPTS):
+        breaker.before_call()
+        try:
+            result = await fn(*args, **kwargs)
+        except Exception as e:
+            if not is_retryable(e):
+                breaker.record_success()
+                raise
+            breaker.record_failure()
+            if attempt == RETRY_ATTEMPTS - 1 or not retry_budget.withdraw():
+                raise
+            await asyncio.sleep(backoff_delay(attempt))
+        except BaseException:
+            # e.g. CancelledError when an ASGI client disconnects mid-call
+            breaker.release_trial()
+            raise
+        else:
+            breaker.record_success()
+            return result
+
+
+def openai_timeout(call_type: str):
+    import httpx
+
+    return httpx.Timeout(TIMEOUTS[call_type], connect=CONNECT_TIMEOUT)
+
+
+def http_limits():
+    import httpx
+
+    return httpx.Limits(
+        max_connections=HTTP_MAX_CONNECTIONS,
+        max_keepalive_connections=HTTP_MAX_KEEPALIVE,
+        keepalive_expiry=HTTP_KEEPALIVE_EXPIRY,
+    )
+
+
+# ------------------- Lazy providers ------------------- #
+
+clients = {}
+clients_lock = threading.RLock()  # reentrant: get_index() builds get_pinecone() under it
+
+
+def provide(name: str, factory):
+    """Returns the client registered under name, building it with factory on first use."""
+    client = clients.get(name)
+    if client is None:
+        with clients_lock:
+            client = clients.get(name)
+            if client is None:
+                client = clients[name] = factory()
+    return client
+
+
+# retries are handled by call()/acall(), so the SDKs' own retries are off
+def build_openai_client():
+    import httpx
+    from openai import OpenAI
+
+    return OpenAI(
+        api_key=os.getenv("OPENAI_API_KEY"),
+        max_retries=0,
+        http_client=httpx.Client(limits=http_limits(), timeout=openai_timeout("chat")),
+    )
+
+
+def build_async_openai_client():
+    import httpx
+    from openai import AsyncOpenAI
+
+    return AsyncOpenAI(
+        api_key=os.getenv("OPENAI_API_KEY"),
+        max_retries=0,
+        http_client=httpx.AsyncClient(limits=http_limits(), timeout=openai_timeout("chat")),
+    )
+
+
+def build_pinecone():
+    from pinecone import Pinecone
+
+    return Pinecone(api_key=os.getenv("PINECONE_API_KEY"), pool_threads=8)
+
+
+def build_index():
+    return get_pinecone().Index(os.getenv("PINECONE_INDEX_NAME"), connection_pool_maxsize=HTTP_MAX_KEEPALIVE)
+
+
+def get_openai_client():
+    return provide("openai", build_openai_client)
+
+
+def get_async_openai_client():
+    return provide("async_openai", build_async_openai_client)
+
+
+def get_pinecone():
+    return provide("pinecone", build_pinecone)
+
+
+def get_index():
+    return provide("index", build_index)
+
+
+# ------------------- Call helpers ------------------- #
+
+
+def chat_completion(**kwargs):
+    call_type = "chat_stream" if kwargs.get("stream") else "chat"
+    return call("openai", get_openai_client().chat.completions.create, timeout=openai_timeout(call_type), **kwargs)
+
+
+async def achat_completion(**kwargs):
+    call_type = "chat_stream" if kwargs.get("stream") else "chat"
+    return await acall("openai", get_async_openai_client().chat.completions.create, timeout=openai_timeout(call_type), **kwargs)
+
+
+def create_embeddings(**kwargs):
+    return call("openai", get_openai_client().embeddings.create, timeout=openai_timeout("embeddings"), **kwargs)
+
+
+async def acreate_embeddings(**kwargs):
+    return await acall("openai", get_async_openai_client().embeddings.create, timeout=openai_timeout("embeddings"), **kwargs)
+
+
+def vector_query(**kwargs):
+    return call("pinecone", get_index().query, _request_timeout=TIMEOUTS["vector_query"], **kwargs)
+
+
+async def avector_query(async_index, **kwargs):
+    return await acall("pinecone", async_index.query, _request_timeout=TIMEOUTS["vector_query"], **kwargs)
+
+
+def vector_upsert(**kwargs):
+    return call("pinecone", get_index().upsert, _request_timeout=TIMEOUTS["vector_write"], **kwargs)
+
+
+def vector_fetch(**kwargs):
+    return call("pinecone", get_index().fetch, _request_timeout=TIMEOUTS["vector_query"], **kwargs)
+
+
+def vector_delete(**kwargs):
+    return call("pinecone", get_index().delete, _request_timeout=TIMEOUTS["vector_write"], **kwargs)
+
+
+def stats():
+    return {
+        "breakers": {name: breaker.state() for name, breaker in breakers.items()},
+        "retry_budget": round(retry_budget.balance, 2),
+    }
@@ -0,0 +1,110 @@
+"""
+Conversation history for chat prompts.
+
+Instead of re-sending the last 10 interactions verbatim, each firm keeps a
+rolling ConversationSummary. Prompts get the summary plus the interactions it
+does not cover yet (at least the newest RECENT_TURNS). Once SUMMARY_EVERY
+interactions have piled up behind the newest turns, the summary is refreshed
+on the background pool.
+"""
+
+import logging
+import os
+import threading
+
+from django.db.models import Subquery
+from django.db.models.functions import Coalesce
+
+from .background import run_in_background
+from .clients import chat_completion
+from .models import AIInteraction, ConversationSummary
+from .prompt_templates import registry as prompt_templates
+from .tokens import truncate_to_tokens
+
+logger = logging.getLogger(__name__)
+
+SUMMARY_EVERY = int(os.getenv("CONVERSATION_SUMMARY_EVERY", "4"))
+RECENT_TURNS = int(os.getenv("CONVERSATION_RECENT_TURNS", "2"))
+MAX_RAW_TURNS = 10
+SUMMARY_MODEL = os.getenv("GPT_MODEL") or "gpt-4"
+SUMMARY_MAX_TOKENS = 700
+# each interaction is cut to this size before it goes into the summarizer
+FOLD_TURN_TOKENS = 800
+
+# firms whose summary is being refreshed by this process
+refreshing = set()
+refreshing_lock = threading.Lock()
+
+
+def format_turn(interaction) -> str:
+    return f"User: {interaction.user_prompt}\nAI: {interaction.ai_response}"
+
+
+def conversation_context(firm) -> str:
+    """Summary of older turns followed by the raw turns it does not cover, newest first."""
+    summary = ConversationSummary.objects.filter(firm=firm).first()
+    covered = summary.last_interaction_id if summary else 0
+
+    recent = list(AIInteraction.objects.filter(firm=firm).order_by("-created_at")[:MAX_RAW_TURNS])
+    raw = [i for i in recent if i.id > covered]
+    if len(raw) < RECENT_TURNS:
+        raw = recent[:RECENT_TURNS]
+
+    turns = "\n".join(format_turn(i) for i in raw)
+    if summary and summary.text:
+        return f"Summary of the earlier conversation:\n{summary.text}\n\nLatest interactions:\n{turns}"
+    return turns
+
+
+def conversation_summary(firm) -> str:
+    """The firm's rolling summary text; it changes once every SUMMARY_EVERY turns, not on every turn."""
+    return ConversationSummary.objects.filter(firm=firm).values_list("text", flat=True).first() or ""
+
+
+def schedule_summary_refresh(firm):
+    """Queues a refresh once SUMMARY_EVERY turns are waiting behind the newest RECENT_TURNS."""
+    # one query: the summary's coverage is a subquery of the count
+    covered = ConversationSummary.objects.filter(firm=firm).values("last_interaction_id")[:1]
+    pending = AIInteraction.objects.filter(
+        firm=firm, id__gt=Coalesce(Subquery(covered), 0)).count() - RECENT_TURNS
+    if pending < SUMMARY_EVERY:
+        return None
+
+    with refreshing_lock:
+        if firm.id in refreshing:
+            return None
+        refreshing.add(firm.id)
+    return run_in_background(refresh_summary, firm.id)
+
+
+def refresh_summary(firm_id):
+    """Folds every uncovered turn except the newest RECENT_TURNS into the firm's summary."""
+    try:
+        summary, _ = ConversationSummary.objects.get_or_create(firm_id=firm_id)
+        newest = list(AIInteraction.objects.filter(firm_id=firm_id)
+                      .order_by("-created_at").values_list("id", flat=True)[:RECENT_TURNS])
+        to_fold = list(AIInteraction.objects.filter(firm_id=firm_id, id__gt=summary.last_interaction_id)
+                       .exclude(id__in=newest).order_by("created_at"))
+        if not to_fold:
+            return
+
+        new_turns = "\n\n".join(truncate_to_tokens(format_turn(i), FOLD_TURN_TOKENS) for i in to_fold)
+        messages = [
+            {"role": "system", "content": f"Answer in bulgarian. {prompt_templates.get('summarizeConversation.txt')}"},
+            {"role": "user", "content": f"Current summary:\n{summary.text or '(empty)'}\n\nNew interactions:\n{new_turns}"}
+        ]
+        response = chat_completion(
+            model=SUMMARY_MODEL,
+            messages=messages,
+            temperature=0.2,
+            max_tokens=SUMMARY_MAX_TOKENS
+        )
+
+        summary.text = response.choices[0].message.content.strip()
+        summary.last_interaction_id = max(i.id for i in to_fold)
+        summary.interaction_count += len(to_fold)
+        summary.save()
+        logger.info("Firm %s: folded %d interactions into the conversation summary", firm_id, len(to_fold))
+    finally:
+        with refreshing_lock:
+            refreshing.discard(firm_id)
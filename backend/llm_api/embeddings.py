@@ -0,0 +1,114 @@
+"""
+Content-addressed embedding cache.
+
+Embeddings are keyed by (model, sha256(text)). Lookups go through an
+in-process LRU first and then a SQLite file that stores the vectors as
+float32 blobs, so cached embeddings survive restarts and are shared by every
+process on the host.
+"""
+
+import hashlib
+import os
+import sqlite3
+import threading
+from array import array
+from collections import OrderedDict
+from typing import Dict, Iterable, List, Optional, Tuple
+
+DEFAULT_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "embedding_cache.sqlite3")
+
+
+def text_hash(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+class EmbeddingCache:
+    def __init__(self, path: Optional[str] = DEFAULT_PATH, max_items: int = 10000):
+        # path=None keeps the cache in memory only
+        self.path = path
+        self.max_items = max_items
+        self.memory: "OrderedDict[Tuple[str, str], List[float]]" = OrderedDict()
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        if path:
+            self.connection().execute(
+                "CREATE TABLE IF NOT EXISTS embeddings ("
+                " model TEXT NOT NULL, hash TEXT NOT NULL, vector BLOB NOT NULL,"
+                " PRIMARY KEY (model, hash))"
+            )
+
+    def connection(self) -> sqlite3.Connection:
+        # sqlite connections can't be shared across threads, so keep one per thread
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self.local.conn = conn
+        return conn
+
+    def remember(self, key: Tuple[str, str], vector: List[float]):
+        with self.lock:
+            self.memory[key] = vector
+            self.memory.move_to_end(key)
+            while len(self.memory) > self.max_items:
+                self.memory.popitem(last=False)
+
+    def get_many(self, model: str, texts: Iterable[str]) -> Dict[str, List[float]]:
+        """Returns the cached embeddings for whichever of the texts have one."""
+        found, on_disk = {}, {}
+        with self.lock:
+            for text in set(texts):
+                key = (model, text_hash(text))
+                if key in self.memory:
+                    self.memory.move_to_end(key)
+                    found[text] = self.memory[key]
+                    self.memory_hits += 1
+                else:
+                    on_disk[key[1]] = text
+
+        disk_found = 0
+        if on_disk and self.path:
+            hashes = list(on_disk)
+            # stay well under SQLite's bound-parameter limit
+            for start in range(0, len(hashes), 500):
+                batch = hashes[start:start + 500]
+                rows = self.connection().execute(
+                    f"SELECT hash, vector FROM embeddings WHERE model = ? AND hash IN ({','.join('?' * len(batch))})",
+                    [model, *batch],
+                ).fetchall()
+                for digest, blob in rows:
+                    vector = array("f", blob).tolist()
+                    found[on_disk[digest]] = vector
+                    self.remember((model, digest), vector)
+                    disk_found += 1
+
+        with self.lock:
+            self.disk_hits += disk_found
+            self.misses += len(on_disk) - disk_found
+        return found
+
+    def put_many(self, model: str, items: Iterable[Tuple[str, List[float]]]):
+        rows = []
+        for text, vector in items:
+            digest = text_hash(text)
+            self.remember((model, digest), list(vector))
+            rows.append((model, digest, array("f", vector).tobytes()))
+        if rows and self.path:
+            self.connection().executemany(
+                "INSERT OR REPLACE INTO embeddings (model, hash, vector) VALUES (?, ?, ?)", rows)
+
+    def stats(self) -> Dict[str, float]:
+        with self.lock:
+            hits = self.memory_hits + self.disk_hits
+            lookups = hits + self.misses
+            return {
+                "memory_hits": self.memory_hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_rate": round(hits / lookups, 4) if lookups else 0.0,
+                "memory_items": len(self.memory),
+            }
@@ -0,0 +1,291 @@
+"""
+Streaming text extraction for RAG uploads.
+
+iter_pdf_pages yields (page_number, text) one page at a time, so the chunker
+can start before the last page is read and page numbers end up in chunk
+metadata. PDFs with PDF_PARALLEL_MIN_PAGES pages or more are split into page
+ranges that a pool of PDF_WORKERS processes extracts in parallel; results are
+still yielded in page order, with only a couple of ranges per worker in
+flight; inside a daemonic process, which may not have children, they are
+extracted sequentially instead. Each pool process runs under an address-space limit of
+PDF_WORKER_MEMORY_MB, and uploads over PDF_MAX_MB are rejected up front.
+
+fetch_url streams a URL in blocks up to URL_MAX_MB, sends the validators of
+the previous fetch (If-None-Match / If-Modified-Since) so unchanged pages come
+back as 304 without a body, decodes with the declared or sniffed charset and
+turns HTML into plain text: scripts, styles, navigation, form controls and
+other page chrome are dropped, <main>/<article> is preferred when the page has
+one, and headings become "#" lines the chunker splits on. <form> and <header>
+are kept: ASP.NET pages wrap their whole body in one form. A page that yields
+no text raises EmptyDocument instead of being ingested as nothing.
+"""
+
+import hashlib
+import os
+import re
+import tempfile
+import urllib.error
+import urllib.request
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from html.parser import HTMLParser
+from multiprocessing import current_process, get_context
+from typing import Iterator, List, NamedTuple, Optional, Tuple
+
+PDF_MAX_BYTES = int(os.getenv("PDF_MAX_MB", "50")) * 1024 * 1024
+PDF_WORKERS = int(os.getenv("PDF_WORKERS", str(min(4, os.cpu_count() or 1))))
+PDF_PARALLEL_MIN_PAGES = int(os.getenv("PDF_PARALLEL_MIN_PAGES", "100"))
+PDF_PAGES_PER_TASK = 50
+PDF_WORKER_MEMORY_BYTES = int(os.getenv("PDF_WORKER_MEMORY_MB", "1024")) * 1024 * 1024
+
+URL_MAX_BYTES = int(os.getenv("URL_MAX_MB", "5")) * 1024 * 1024
+URL_TIMEOUT = 10
+URL_READ_BLOCK = 64 * 1024
+URL_USER_AGENT = "FirmFlow-RAG/1.0"
+
+
+class DocumentTooLarge(ValueError):
+    pass
+
+
+class UnsupportedContent(ValueError):
+    pass
+
+
+class EmptyDocument(ValueError):
+    pass
+
+
+def check_pdf_size(size: int):
+    if size > PDF_MAX_BYTES:
+        raise DocumentTooLarge(f"PDF is {size / 1024 / 1024:.1f} MB; the limit is {PDF_MAX_BYTES // 1024 // 1024} MB.")
+
+
+def limit_worker_memory(max_bytes: int):
+    """Pool initializer: a runaway page raises MemoryError in the worker instead of swapping the host."""
+    try:
+        import resource
+    except ImportError:  # not available on Windows
+        return
+    resource.setrlimit(resource.RLIMIT_AS, (max_bytes, max_bytes))
+
+
+def extract_page_range(path: str, start: int, stop: int) -> List[Tuple[int, str]]:
+    import PyPDF2
+
+    reader = PyPDF2.PdfReader(path)
+    return [(i + 1, reader.pages[i].extract_text() or "") for i in range(start, stop)]
+
+
+def iter_pdf_pages(path: str) -> Iterator[Tuple[int, str]]:
+    import PyPDF2  # only ingestion workers need it
+
+    check_pdf_size(os.path.getsize(path))
+    reader = PyPDF2.PdfReader(path)
+    page_count = len(reader.pages)
+
+    # a daemonic process (e.g. a multiprocessing pool worker) is not allowed to start the pool
+    if page_count < PDF_PARALLEL_MIN_PAGES or PDF_WORKERS < 2 or current_process().daemon:
+        for i, page in enumerate(reader.pages):
+            yield i + 1, page.extract_text() or ""
+        return
+    del reader
+
+    # spawn, not fork: the worker process may already be running threads and holding DB connections
+    pool = ProcessPoolExecutor(
+        max_workers=PDF_WORKERS,
+        mp_context=get_context("spawn"),
+        initializer=limit_worker_memory,
+        initargs=(PDF_WORKER_MEMORY_BYTES,),
+    )
+    try:
+        in_flight = deque()
+        for start in range(0, page_count, PDF_PAGES_PER_TASK):
+            in_flight.append(pool.submit(extract_page_range, path, start, min(page_count, start + PDF_PAGES_PER_TASK)))
+            if len(in_flight) >= PDF_WORKERS * 2:
+                yield from in_flight.popleft().result()
+        while in_flight:
+            yield from in_flight.popleft().result()
+    finally:
+        pool.shutdown(wait=True, cancel_futures=True)
+
+
+# ------------------- URLs ------------------- #
+
+# form controls are skipped, never <form> itself: WebForms pages put all content inside <form runat="server">
+HTML_SKIP_TAGS = {"script", "style", "noscript", "template", "svg", "canvas", "iframe", "nav", "footer", "aside",
+                  "input", "select", "textarea", "button"}
+HTML_VOID_TAGS = {"area", "base", "br", "col", "embed", "hr", "img", "input", "link", "meta", "source", "track", "wbr"}
+HTML_BLOCK_TAGS = {"p", "div", "section", "li", "ul", "ol", "table", "tr", "td", "th", "dd", "dt", "dl",
+                   "blockquote", "pre", "br", "hr", "main", "article", "figcaption", "address"}
+HTML_HEADING_TAGS = {"h1": "#", "h2": "##", "h3": "###", "h4": "###", "h5": "###", "h6": "###"}
+HTML_MAIN_TAGS = {"main", "article"}
+# <main>/<article> text shorter than this is probably a teaser, not the page's content
+MAIN_CONTENT_MIN_CHARS = 200
+META_CHARSET = re.compile(rb"""<meta[^>]+charset=["']?([\w.:-]+)""", re.IGNORECASE)
+
+
+class HTMLTextExtractor(HTMLParser):
+    """Collects the visible text of a page, once for the whole body and once for <main>/<article>."""
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        # inside a skipped element: its tag and nesting depth (only that tag is counted,
+        # so an unclosed <p> inside a <nav> can't swallow the rest of the page)
+        self.skip_tag = None
+        self.skip_depth = 0
+        self.main_depth = 0
+        self.body: List[str] = []
+        self.main: List[str] = []
+        self.title = ""
+        self.in_title = False
+
+    def emit(self, text: str):
+        self.body.append(text)
+        if self.main_depth:
+            self.main.append(text)
+
+    def handle_starttag(self, tag, attrs):
+        if self.skip_tag:
+            if tag == self.skip_tag:
+                self.skip_depth += 1
+            return
+        if tag in HTML_SKIP_TAGS and tag not in HTML_VOID_TAGS:
+            self.skip_tag, self.skip_depth = tag, 1
+            return
+        if tag == "title":
+            self.in_title = True
+        if tag in HTML_MAIN_TAGS:
+            self.main_depth += 1
+        if tag in HTML_HEADING_TAGS:
+            self.emit(f"\n\n{HTML_HEADING_TAGS[tag]} ")
+        elif tag in HTML_BLOCK_TAGS:
+            self.emit("\n")
+
+    def handle_endtag(self, tag):
+        if self.skip_tag:
+            if tag == self.skip_tag:
+                self.skip_depth -= 1
+                if not self.skip_depth:
+                    self.skip_tag = None
+            return
+        if tag == "title":
+            self.in_title = False
+        if tag in HTML_HEADING_TAGS:
+            self.emit("\n\n")
+        elif tag in HTML_BLOCK_TAGS and tag not in HTML_VOID_TAGS:
+            self.emit("\n")
+        if tag in HTML_MAIN_TAGS and self.main_depth:
+            self.main_depth -= 1
+
+    def handle_data(self, data):
+        if self.in_title:
+            self.title += data
+        elif not self.skip_tag:
+            self.emit(data)
+
+
+def tidy_text(parts: List[str]) -> str:
+    lines = (" ".join(line.split()) for line in "".join(parts).splitlines())
+    # keep single blank lines between blocks, drop the rest
+    return re.sub(r"\n{3,}", "\n\n", "\n".join(lines)).strip()
+
+
+def html_to_text(html: str) -> str:
+    parser = HTMLTextExtractor()
+    parser.feed(html)
+    parser.close()
+    main = tidy_text(parser.main)
+    text = main if len(main) >= MAIN_CONTENT_MIN_CHARS else tidy_text(parser.body)
+    if not text:
+        return ""  # a title alone is nothing to ingest
+    title = " ".join(parser.title.split())
+    return f"# {title}\n\n{text}" if title and not text.startswith("#") else text
+
+
+class FetchResult(NamedTuple):
+    """text is None when the server answered 304 Not Modified."""
+    text: Optional[str]
+    etag: str
+    last_modified: str
+    content_hash: str
+    content_type: str
+
+
+def read_capped(response, limit: int) -> bytes:
+    length = response.headers.get("Content-Length")
+    if length and length.isdigit() and int(length) > limit:
+        raise DocumentTooLarge(f"Response is {int(length) / 1024 / 1024:.1f} MB; the limit is {limit // 1024 // 1024} MB.")
+    blocks, size = [], 0
+    while True:
+        block = response.read(URL_READ_BLOCK)
+        if not block:
+            return b"".join(blocks)
+        size += len(block)
+        if size > limit:
+            raise DocumentTooLarge(f"Response exceeds the {limit // 1024 // 1024} MB limit.")
+        blocks.append(block)
+
+
+def decode(body: bytes, charset: Optional[str]) -> str:
+    if not charset:
+        sniffed = META_CHARSET.search(body[:4096])
+        charset = sniffed.group(1).decode("ascii") if sniffed else "utf-8"
+    try:
+        return body.decode(charset, errors="replace")
+    except LookupError:  # unknown charset name
+        return body.decode("utf-8", errors="replace")
+
+
+def pdf_bytes_to_pages(body: bytes) -> List[Tuple[int, str]]:
+    with tempfile.NamedTemporaryFile(suffix=".pdf", delete=False) as f:
+        f.write(body)
+    try:
+        return list(iter_pdf_pages(f.name))
+    finally:
+        os.unlink(f.name)
+
+
+def fetch_url(url: str, etag: str = "", last_modified: str = "") -> FetchResult:
+    """
+    Fetches url as plain text. Pass the etag/last_modified of an earlier fetch
+    to get text=None back when the page has not changed since.
+    """
+    headers = {"User-Agent": URL_USER_AGENT, "Accept": "text/html, text/plain;q=0.9, application/pdf;q=0.8"}
+    if etag:
+        headers["If-None-Match"] = etag
+    if last_modified:
+        headers["If-Modified-Since"] = last_modified
+    request = urllib.request.Request(url, headers=headers)
+    try:
+        response = urllib.request.urlopen(request, timeout=URL_TIMEOUT)
+    except urllib.error.HTTPError as e:
+        if e.code == 304:
+            return FetchResult(None, etag, last_modified, "", "")
+        raise
+
+    with response:
+        content_type = response.headers.get_content_type()
+        if content_type == "application/pdf":
+            body = read_capped(response, min(URL_MAX_BYTES, PDF_MAX_BYTES))
+            pages = pdf_bytes_to_pages(body)
+            text = "\n\n".join(page for _, page in pages)
+        elif content_type in ("text/html", "application/xhtml+xml", "text/plain"):
+            body = read_capped(response, URL_MAX_BYTES)
+            text = decode(body, response.headers.get_content_charset())
+            if content_type != "text/plain":
+                text = html_to_text(text)
+        else:
+            raise UnsupportedContent(f"Can't ingest '{content_type}' content from {url}.")
+        if not text.strip():
+            raise EmptyDocument(f"No text could be extracted from {url}; the page may be built by JavaScript "
+                                f"or, for a PDF, be scanned images.")
+
+        return FetchResult(
+            text=text,
+            etag=response.headers.get("ETag", ""),
+            last_modified=response.headers.get("Last-Modified", ""),
+            # hash of the extracted text: markup-only changes (nonces, ads) don't count as new content
+            content_hash=hashlib.sha256(text.encode("utf-8")).hexdigest(),
+            content_type=content_type,
+        )
@@ -0,0 +1,329 @@
+"""
+Background RAG ingestion.
+
+RAGUploadView stores every upload as an IngestionJob and returns at once.
+Worker processes started with `python manage.py run_ingestion_worker` claim
+queued jobs straight from the database, so the queue needs nothing beyond
+SQLite/Postgres and local processes.
+
+Every upload belongs to an IngestionSource (a user's URL, file name, given
+name or, for unnamed text, the text itself, optionally for one of the firms),
+whose chunks live in the firm's or the user's own vector namespace and which
+keeps a manifest of its
+chunks by content hash. Vector ids are derived from those hashes, so uploading
+a source again embeds and upserts only the chunks that are new or changed and
+deletes the vectors of chunks that are gone; unchanged chunks are left alone.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import time
+from datetime import timedelta
+from typing import Dict, Optional
+
+from django.db import close_old_connections, transaction
+from django.db.models import Exists, F, OuterRef, Q
+from django.utils import timezone
+
+from .chunking import Chunk, Source, iter_chunks
+from .extraction import fetch_url, iter_pdf_pages
+from .model import delete_vectors, firm_namespace, keyword_index, upsert_chunks, user_namespace
+from .vector_store import get_vector_store
+from .models import IngestedChunk, IngestionJob, IngestionSource
+
+logger = logging.getLogger(__name__)
+
+POLL_INTERVAL = float(os.getenv("INGESTION_POLL_INTERVAL", "2"))
+# a running job whose worker stopped sending heartbeats is handed to another worker
+STALE_AFTER = timedelta(minutes=int(os.getenv("INGESTION_STALE_MINUTES", "10")))
+MAX_ATTEMPTS = 3
+MANIFEST_BATCH_SIZE = 500
+
+
+def source_for_job(job: IngestionJob, name: str = "", firm=None) -> IngestionSource:
+    """
+    Returns the user's source this job uploads, for the firm if one is given,
+    creating it on first upload. Call before the job is saved: a PDF is
+    identified by its uploaded file name.
+    """
+    if job.source_type == IngestionJob.SOURCE_URL:
+        identity, name = job.url, name or job.url
+    elif job.source_type == IngestionJob.SOURCE_PDF:
+        identity = name = name or os.path.basename(job.file.name)
+    else:
+        identity = name or hashlib.sha256(job.text.encode("utf-8")).hexdigest()
+        name = name or " ".join(job.text[:200].split())[:80]
+    identity = f"{job.source_type}:{identity}"
+    if firm is not None:
+        identity = f"firm-{firm.id}:{identity}"
+    source, _ = IngestionSource.objects.get_or_create(
+        user_id=job.user_id,
+        key=hashlib.sha256(identity.encode("utf-8")).hexdigest(),
+        defaults={
+            "firm": firm,
+            "namespace": firm_namespace(firm.id) if firm is not None else user_namespace(job.user_id),
+            "source_type": job.source_type,
+            "name": name[:2048],
+        },
+    )
+    return source
+
+
+def chunk_hash(chunk: Chunk) -> str:
+    # metadata is part of the stored vector, so a chunk that moved to another page counts as changed
+    payload = json.dumps([chunk.text, chunk.metadata], ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def vector_id(source: IngestionSource, content_hash: str) -> str:
+    return f"{source.vector_prefix}-{content_hash[:16]}"
+
+
+def delete_source(source: IngestionSource):
+    """Deletes a source's vectors, then the source with its manifest."""
+    ids = list(source.chunks.values_list("vector_id", flat=True))
+    delete_vectors(ids, namespace=source.namespace)
+    source.delete()
+
+
+def sync_keyword_index() -> Dict[str, int]:
+    """
+    Re-indexes uploaded chunks the local keyword index is missing, e.g. on a
+    host that started without the index file. Which chunks exist comes from
+    the IngestedChunk manifest, their text from the vector store.
+    """
+    store = get_vector_store()
+    restored = unavailable = 0
+    namespaces = IngestionSource.objects.values_list("namespace", flat=True).distinct()
+    for namespace in namespaces:
+        indexed = keyword_index.ids(namespace)
+        missing = [vid for vid in IngestedChunk.objects.filter(source__namespace=namespace)
+                   .values_list("vector_id", flat=True).iterator() if vid not in indexed]
+        for start in range(0, len(missing), MANIFEST_BATCH_SIZE):
+            batch = missing[start:start + MANIFEST_BATCH_SIZE]
+            found = store.fetch_metadata(batch, namespace=namespace)
+            keyword_index.add([{"id": vid, "metadata": metadata} for vid, metadata in found.items()],
+                              namespace=namespace)
+            restored += len(found)
+            unavailable += len(batch) - len(found)
+    if restored or unavailable:
+        logger.warning("Keyword index: re-indexed %d chunks, %d not found in the vector store",
+                       restored, unavailable)
+    return {"restored": restored, "unavailable": unavailable}
+
+
+def extract_text(job: IngestionJob) -> Source:
+    """
+    Returns the job's text for the chunker: PDF pages as (page_number, text)
+    pairs yielded as they are extracted, otherwise the whole text payload.
+    """
+    if job.source_type == IngestionJob.SOURCE_PDF:
+        return iter_pdf_pages(job.file.path)
+    return job.text
+
+
+def fetch_job_url(job: IngestionJob) -> Optional[str]:
+    """
+    Fetches a URL job's page, conditionally on the last successful fetch of its
+    source. Returns None when the page is unchanged since then; the job then
+    points at the source's existing vectors.
+    """
+    previous = (
+        IngestionJob.objects
+        .filter(source_id=job.source_id, status=IngestionJob.STATUS_SUCCEEDED)
+        .exclude(id=job.id)
+        .order_by("-finished_at")
+        .first()
+    )
+    fetched = fetch_url(job.url, etag=previous.etag if previous else "",
+                        last_modified=previous.last_modified if previous else "")
+    jobs = IngestionJob.objects.filter(id=job.id)
+
+    unchanged = fetched.text is None or (previous is not None and fetched.content_hash == previous.content_hash)
+    if previous is not None and unchanged:
+        jobs.update(
+            status=IngestionJob.STATUS_SUCCEEDED,
+            etag=fetched.etag or previous.etag,
+            last_modified=fetched.last_modified or previous.last_modified,
+            content_hash=previous.content_hash,
+            metadata_prefix=previous.metadata_prefix,
+            total_chunks=previous.chunk_count or 0,
+            embedded_chunks=previous.chunk_count or 0,
+            chunk_count=previous.chunk_count,
+            stats={"unchanged": True, "previous_job": previous.id, "chunks": 0},
+            error="",
+            finished_at=timezone.now(),
+        )
+        logger.info("Ingestion job %s: %s unchanged since job %s, skipped", job.id, job.url, previous.id)
+        return None
+    if fetched.text is None:
+        raise ValueError("Server answered 304 Not Modified to an unconditional request.")
+
+    jobs.update(etag=fetched.etag, last_modified=fetched.last_modified, content_hash=fetched.content_hash)
+    return fetched.text
+
+
+def run_job(job: IngestionJob):
+    """
+    Chunks one claimed job and syncs its source with the result: new chunks
+    are embedded and upserted, chunks no longer in the source are deleted.
+    Records progress as it goes.
+    """
+    jobs = IngestionJob.objects.filter(id=job.id)
+    if job.source_id is None:  # queued before sources existed, or its source was deleted since
+        job.source = source_for_job(job, firm=job.firm)
+        jobs.update(source=job.source)
+    source = job.source
+
+    if job.source_type == IngestionJob.SOURCE_URL:
+        text = fetch_job_url(job)
+        if text is None:
+            return
+    else:
+        text = extract_text(job)
+    if isinstance(text, str) and not text.strip():
+        raise ValueError("No valid text found to process.")
+
+    metadata_prefix = source.vector_prefix
+    jobs.update(metadata_prefix=metadata_prefix, heartbeat_at=timezone.now())
+
+    known: Dict[str, str] = dict(source.chunks.values_list("content_hash", "vector_id"))
+    current: Dict[str, str] = {}  # content hash -> vector id for this version of the source
+    total = 0
+
+    def changed_chunks():
+        nonlocal total
+        for chunk in iter_chunks(text):
+            total += 1
+            digest = chunk_hash(chunk)
+            if digest in current:  # the same chunk twice in one document
+                continue
+            current[digest] = known.get(digest) or vector_id(source, digest)
+            if digest not in known:
+                yield chunk
+
+    # chunks are generated as the upsert consumes them, so the total grows until the end;
+    # unchanged chunks count as embedded
+    def report_progress(embedded, produced):
+        jobs.update(embedded_chunks=total - produced + embedded, total_chunks=total, heartbeat_at=timezone.now())
+
+    stats = upsert_chunks(changed_chunks(), metadata_prefix=metadata_prefix, progress_callback=report_progress,
+                          chunk_id=lambda i, chunk: vector_id(source, chunk_hash(chunk)), namespace=source.namespace)
+    if not total:
+        raise ValueError("No valid text found to process.")
+
+    removed = [digest for digest in known if digest not in current]
+    delete_vectors((known[digest] for digest in removed), namespace=source.namespace)
+    with transaction.atomic():
+        for start in range(0, len(removed), MANIFEST_BATCH_SIZE):
+            source.chunks.filter(content_hash__in=removed[start:start + MANIFEST_BATCH_SIZE]).delete()
+        IngestedChunk.objects.bulk_create(
+            [IngestedChunk(source=source, content_hash=digest, vector_id=vid)
+             for digest, vid in current.items() if digest not in known],
+            batch_size=MANIFEST_BATCH_SIZE,
+        )
+        IngestionSource.objects.filter(id=source.id).update(chunk_count=len(current), updated_at=timezone.now())
+
+    stats.update(chunks=total, added=stats["chunks"], kept=len(current) - stats["chunks"], removed=len(removed))
+    jobs.update(
+        status=IngestionJob.STATUS_SUCCEEDED,
+        total_chunks=total,
+        chunk_count=len(current),
+        embedded_chunks=total,
+        stats=stats,
+        error="",
+        finished_at=timezone.now(),
+    )
+    # the upload is only kept around so a job whose worker died can be retried
+    if job.file:
+        job.file.delete(save=False)
+
+
+def fail_job(job: IngestionJob, error: str, **conditions) -> bool:
+    """
+    Marks a job failed for good, if it still matches conditions, and deletes
+    its upload, which nothing will read again.
+    """
+    failed = IngestionJob.objects.filter(id=job.id, **conditions).update(
+        status=IngestionJob.STATUS_FAILED, error=error, finished_at=timezone.now())
+    if failed and job.file:
+        job.file.delete(save=False)
+    return failed
+
+
+def fail_exhausted_jobs():
+    """
+    Fails running jobs whose worker stopped sending heartbeats on the last
+    attempt; claimable_jobs no longer hands them out, so they would stay
+    running forever.
+    """
+    stale = timezone.now() - STALE_AFTER
+    conditions = {"status": IngestionJob.STATUS_RUNNING, "heartbeat_at__lt": stale}
+    exhausted = IngestionJob.objects.filter(attempts__gte=MAX_ATTEMPTS, **conditions)
+    for job in exhausted.only("id", "file", "attempts", "worker"):
+        # conditional, so a job whose worker came back in the meantime is left alone
+        if fail_job(job, f"Worker {job.worker} stopped responding on attempt {job.attempts} of {MAX_ATTEMPTS}.",
+                    **conditions):
+            logger.warning("Ingestion job %s failed: no heartbeat after %d attempts", job.id, job.attempts)
+
+
+def claimable_jobs():
+    stale = timezone.now() - STALE_AFTER
+    # one job per source at a time, so two uploads of a source can't interleave their manifest updates
+    source_busy = IngestionJob.objects.filter(
+        source_id=OuterRef("source_id"), status=IngestionJob.STATUS_RUNNING, heartbeat_at__gte=stale)
+    return IngestionJob.objects.filter(
+        Q(status=IngestionJob.STATUS_QUEUED)
+        | Q(status=IngestionJob.STATUS_RUNNING, heartbeat_at__lt=stale, attempts__lt=MAX_ATTEMPTS)
+    ).exclude(Exists(source_busy))
+
+
+def claim_next_job(worker_name: str):
+    """
+    Atomically moves the oldest claimable job to running and returns it.
+    The conditional UPDATE makes sure two workers never claim the same job,
+    without needing SELECT ... FOR UPDATE SKIP LOCKED (not available on SQLite).
+    """
+    fail_exhausted_jobs()
+    while True:
+        job_id = claimable_jobs().order_by("created_at").values_list("id", flat=True).first()
+        if job_id is None:
+            return None
+        now = timezone.now()
+        claimed = claimable_jobs().filter(id=job_id).update(
+            status=IngestionJob.STATUS_RUNNING,
+            worker=worker_name,
+            attempts=F("attempts") + 1,
+            started_at=now,
+            heartbeat_at=now,
+        )
+        if claimed:
+            return IngestionJob.objects.get(id=job_id)
+
+
+def process_next_job(worker_name: str) -> bool:
+    """Runs one job if there is one. Returns False when the queue is empty."""
+    job = claim_next_job(worker_name)
+    if job is None:
+        return False
+
+    logger.info("%s: running ingestion job %s", worker_name, job.id)
+    try:
+        run_job(job)
+    except Exception as e:
+        logger.exception("%s: ingestion job %s failed", worker_name, job.id)
+        fail_job(job, str(e))
+    return True
+
+
+def work_loop(worker_name: str, poll_interval: float = POLL_INTERVAL, once: bool = False):
+    """Processes jobs until stopped; with once=True, until the queue is empty."""
+    while True:
+        close_old_connections()
+        if process_next_job(worker_name):
+            continue
+        if once:
+            return
+        time.sleep(poll_interval)
@@ -0,0 +1,75 @@
+import statistics
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.management.base import BaseCommand
+from django.db import OperationalError, connection, connections, transaction
+
+
+class Command(BaseCommand):
+    help = ("Simulates concurrent chat requests against the configured database: each one reads the "
+            "conversation, waits as if for the LLM and saves the interaction (every tenth also as a "
+            "document). Reports write latency and lock errors. Nothing is sent to the LLM.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--threads", type=int, default=8,
+                            help="Concurrent simulated requests.")
+        parser.add_argument("--requests", type=int, default=200,
+                            help="Total simulated requests.")
+        parser.add_argument("--llm-ms", type=int, default=50,
+                            help="Milliseconds each request spends 'waiting for the model' between read and write.")
+
+    def handle(self, *args, **options):
+        from llm_api.models import AIInteraction, Document, Firm
+
+        firm = Firm.objects.create(name=f"db-load-test-{time.time_ns()}")
+        llm_seconds = options["llm_ms"] / 1000
+        latencies, errors = [], []
+        lock = threading.Lock()
+
+        def chat_request(i):
+            try:
+                # what SubmitPromptView reads before calling the model
+                list(AIInteraction.objects.filter(firm=firm).order_by("-created_at")[:10])
+                time.sleep(llm_seconds)
+                started = time.perf_counter()
+                with transaction.atomic():
+                    # read, then write in one transaction, like get_or_create or the summary bookkeeping
+                    AIInteraction.objects.filter(firm=firm).count()
+                    AIInteraction.objects.create(firm=firm, user_prompt=f"prompt {i}", ai_response=f"answer {i}")
+                    if i % 10 == 0:
+                        Document.objects.create(firm=firm, title=f"Load test {i}", text=f"answer {i}")
+                elapsed = time.perf_counter() - started
+                with lock:
+                    latencies.append(elapsed)
+            except OperationalError as e:
+                with lock:
+                    errors.append(str(e))
+            finally:
+                connection.close()  # each pool thread has its own connection
+
+        vendor = connection.vendor
+        started = time.perf_counter()
+        try:
+            with ThreadPoolExecutor(max_workers=max(1, options["threads"])) as pool:
+                list(pool.map(chat_request, range(options["requests"])))
+            total = time.perf_counter() - started
+            saved = AIInteraction.objects.filter(firm=firm).count()
+        finally:
+            firm.delete()
+            connections.close_all()
+
+        self.stdout.write(f"{vendor}: {saved}/{options['requests']} interactions saved by "
+                          f"{options['threads']} threads in {total:.2f}s "
+                          f"({options['requests'] / total:.1f} requests/s)")
+        if latencies:
+            latencies.sort()
+            self.stdout.write(
+                f"write latency: p50 {statistics.median(latencies) * 1000:.1f} ms, "
+                f"p95 {latencies[int(len(latencies) * 0.95) - 1] * 1000:.1f} ms, "
+                f"max {latencies[-1] * 1000:.1f} ms")
+        if errors:
+            self.stdout.write(self.style.ERROR(f"{len(errors)} failed writes, e.g. {errors[0]}"))
+        else:
+            self.stdout.write(self.style.SUCCESS("no failed writes"))
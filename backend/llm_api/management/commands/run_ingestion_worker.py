@@ -0,0 +1,76 @@
+import multiprocessing
+import os
+import socket
+
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+
+def worker_process(worker_name, poll_interval, once):
+    # spawned children (the default on Windows/macOS) start without Django set up
+    import django
+    django.setup()
+    from llm_api.ingestion import work_loop
+    work_loop(worker_name, poll_interval=poll_interval, once=once)
+
+
+class Command(BaseCommand):
+    help = "Runs local worker processes that process queued RAG ingestion jobs."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--processes", type=int, default=1,
+                            help="Number of worker processes to run.")
+        parser.add_argument("--poll-interval", type=float, default=None,
+                            help="Seconds to wait between polls when the queue is empty.")
+        parser.add_argument("--once", action="store_true",
+                            help="Exit once the queue is empty instead of polling forever.")
+        parser.add_argument("--skip-keyword-sync", action="store_true",
+                            help="Don't re-index chunks missing from the local keyword index at startup.")
+
+    def handle(self, *args, **options):
+        from llm_api.ingestion import POLL_INTERVAL, sync_keyword_index, work_loop
+
+        poll_interval = options["poll_interval"] or POLL_INTERVAL
+        if not options["skip_keyword_sync"]:
+            # the keyword index is a local file; catch up on chunks this host has not indexed
+            try:
+                restored = sync_keyword_index()["restored"]
+            except Exception as e:
+                self.stderr.write(f"Keyword index sync failed, keyword search may miss uploads: {e}")
+            else:
+                if restored:
+                    self.stdout.write(f"Re-indexed {restored} chunks missing from the keyword index.")
+        processes = max(1, options["processes"])
+        base_name = f"{socket.gethostname()}-{os.getpid()}"
+
+        if processes == 1:
+            self.stdout.write(f"Ingestion worker {base_name} started.")
+            work_loop(base_name, poll_interval=poll_interval, once=options["once"])
+            return
+
+        # children must not inherit the parent's open database connections
+        connections.close_all()
+        # not daemonic: a daemonic process may not start the PDF extraction pool
+        workers = [
+            multiprocessing.Process(
+                target=worker_process,
+                args=(f"{base_name}-{i}", poll_interval, options["once"]),
+            )
+            for i in range(processes)
+        ]
+        try:
+            for worker in workers:
+                worker.start()
+            self.stdout.write(f"Started {processes} ingestion workers.")
+            for worker in workers:
+                worker.join()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            # so the workers never outlive the command
+            for worker in workers:
+                if worker.is_alive():
+                    worker.terminate()
+            for worker in workers:
+                if worker.pid is not None:
+                    worker.join()
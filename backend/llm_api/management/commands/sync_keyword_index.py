@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+
+
+class Command(BaseCommand):
+    help = ("Re-indexes uploaded chunks missing from this host's keyword index (KEYWORD_INDEX_PATH), "
+            "reading their text back from the vector store.")
+
+    def handle(self, *args, **options):
+        from llm_api.ingestion import sync_keyword_index
+
+        result = sync_keyword_index()
+        self.stdout.write(f"Re-indexed {result['restored']} chunks.")
+        if result["unavailable"]:
+            self.stdout.write(self.style.WARNING(
+                f"{result['unavailable']} chunks in the manifest were not found in the vector store; "
+                "upload their sources again."))
@@ -0,0 +1,43 @@
+# Generated by Django 5.1.7 on 2026-10-18 07:53
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('llm_api', '0007_remove_firm_latitude_remove_firm_longitude'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='IngestionJob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('status', models.CharField(choices=[('queued', 'Queued'), ('running', 'Running'), ('succeeded', 'Succeeded'), ('failed', 'Failed')], default='queued', max_length=16)),
+                ('source_type', models.CharField(choices=[('pdf', 'PDF'), ('url', 'URL'), ('text', 'Text')], max_length=8)),
+                ('file', models.FileField(blank=True, null=True, upload_to='rag_uploads/')),
+                ('url', models.URLField(blank=True, max_length=2048)),
+                ('text', models.TextField(blank=True)),
+                ('total_chunks', models.PositiveIntegerField(default=0)),
+                ('embedded_chunks', models.PositiveIntegerField(default=0)),
+                ('chunk_count', models.PositiveIntegerField(blank=True, null=True)),
+                ('metadata_prefix', models.CharField(blank=True, max_length=255)),
+                ('stats', models.JSONField(blank=True, null=True)),
+                ('error', models.TextField(blank=True)),
+                ('worker', models.CharField(blank=True, max_length=255)),
+                ('attempts', models.PositiveIntegerField(default=0)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('started_at', models.DateTimeField(blank=True, null=True)),
+                ('heartbeat_at', models.DateTimeField(blank=True, null=True)),
+                ('finished_at', models.DateTimeField(blank=True, null=True)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='ingestion_jobs', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['status', 'created_at'], name='llm_api_ing_status_4b98ed_idx')],
+            },
+        ),
+    ]
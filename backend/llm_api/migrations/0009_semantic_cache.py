@@ -0,0 +1,35 @@
+# Generated by Django 5.1.7 on 2026-10-18 07:55
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('llm_api', '0008_ingestionjob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='maindocument',
+            name='version',
+            field=models.PositiveIntegerField(default=1),
+        ),
+        migrations.CreateModel(
+            name='SemanticCacheEntry',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('main_document_version', models.PositiveIntegerField()),
+                ('embedding', models.BinaryField()),
+                ('hits', models.PositiveIntegerField(default=0)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('last_hit_at', models.DateTimeField(blank=True, null=True)),
+                ('firm', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='semantic_cache_entries', to='llm_api.firm')),
+                ('interaction', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='llm_api.aiinteraction')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['firm', 'main_document_version', 'created_at'], name='llm_api_sem_firm_id_bb0b3a_idx')],
+            },
+        ),
+    ]
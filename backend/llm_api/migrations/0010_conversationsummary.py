@@ -0,0 +1,25 @@
+# Generated by Django 5.1.7 on 2026-10-18 07:57
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('llm_api', '0009_semantic_cache'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ConversationSummary',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('text', models.TextField(blank=True)),
+                ('last_interaction_id', models.BigIntegerField(default=0)),
+                ('interaction_count', models.PositiveIntegerField(default=0)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('firm', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='conversation_summary', to='llm_api.firm')),
+            ],
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.1.7 on 2026-10-18 07:57
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('llm_api', '0010_conversationsummary'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='semanticcacheentry',
+            name='prompt_version',
+            field=models.CharField(blank=True, max_length=64),
+        ),
+    ]
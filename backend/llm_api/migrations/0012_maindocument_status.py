@@ -0,0 +1,28 @@
+# Generated by Django 5.1.7 on 2026-10-18 07:58
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('llm_api', '0011_semanticcacheentry_prompt_version'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='maindocument',
+            name='error',
+            field=models.TextField(blank=True),
+        ),
+        migrations.AddField(
+            model_name='maindocument',
+            name='status',
+            field=models.CharField(choices=[('generating', 'Generating'), ('ready', 'Ready'), ('failed', 'Failed')], default='ready', max_length=16),
+        ),
+        migrations.AlterField(
+            model_name='maindocument',
+            name='text',
+            field=models.TextField(blank=True),
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 5.1.7 on 2026-10-18 08:23
+
+import os
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+def existing_sources_namespace(apps, schema_editor):
+    # sources created before this migration were upserted into the global NAMESPACE
+    IngestionSource = apps.get_model("llm_api", "IngestionSource")
+    IngestionSource.objects.update(namespace=os.getenv("NAMESPACE") or "")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('llm_api', '0014_ingestion_sources'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='ingestionsource',
+            name='firm',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='ingestion_sources', to='llm_api.firm'),
+        ),
+        migrations.AddField(
+            model_name='ingestionsource',
+            name='namespace',
+            field=models.CharField(blank=True, max_length=255),
+        ),
+        migrations.RunPython(existing_sources_namespace, migrations.RunPython.noop),
+    ]
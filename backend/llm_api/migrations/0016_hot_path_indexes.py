@@ -0,0 +1,27 @@
+# Generated by Django 5.1.7 on 2026-10-18 08:27
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('llm_api', '0015_ingestionsource_namespace'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='aiinteraction',
+            index=models.Index(fields=['firm', '-created_at'], name='llm_api_aii_firm_id_b20c31_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='firm',
+            index=models.Index(fields=['-created_at'], name='llm_api_fir_created_71b84d_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='ingestionsource',
+            index=models.Index(fields=['user', '-updated_at'], name='llm_api_ing_user_id_3071dd_idx'),
+        ),
+    ]
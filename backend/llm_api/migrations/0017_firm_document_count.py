@@ -0,0 +1,30 @@
+# Generated by Django 5.1.7 on 2026-10-18 08:29
+
+from django.db import migrations, models
+from django.db.models import Max, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def existing_document_counts(apps, schema_editor):
+    # continue after each firm's highest existing number
+    Firm = apps.get_model("llm_api", "Firm")
+    Document = apps.get_model("llm_api", "Document")
+    highest = (Document.objects.filter(firm=OuterRef("pk")).order_by()
+               .values("firm").annotate(highest=Max("document_number")).values("highest"))
+    Firm.objects.update(document_count=Coalesce(Subquery(highest), 0))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('llm_api', '0016_hot_path_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='firm',
+            name='document_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(existing_document_counts, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,34 @@
+# Generated by Django 5.1.7 on 2026-10-18 08:41
+
+import django.utils.timezone
+from django.db import migrations, models
+from django.db.models import F
+
+
+def existing_documents_updated_at(apps, schema_editor):
+    # unknown for existing documents; the upload time is the best guess
+    Document = apps.get_model("llm_api", "Document")
+    Document.objects.update(updated_at=F("uploaded_at"))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('llm_api', '0017_firm_document_count'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='document',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True, default=django.utils.timezone.now),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name='maindocument',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True, default=django.utils.timezone.now),
+            preserve_default=False,
+        ),
+        migrations.RunPython(existing_documents_updated_at, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.1.7 on 2026-10-18 08:44
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('llm_api', '0018_document_updated_at'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='semanticcacheentry',
+            name='context_key',
+            field=models.CharField(blank=True, max_length=64),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 5.1.7 on 2026-10-18 08:58
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery
+
+
+def existing_jobs_firm(apps, schema_editor):
+    IngestionJob = apps.get_model("llm_api", "IngestionJob")
+    IngestionSource = apps.get_model("llm_api", "IngestionSource")
+    IngestionJob.objects.filter(source__isnull=False).update(
+        firm=Subquery(IngestionSource.objects.filter(id=OuterRef("source_id")).values("firm")[:1]))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('llm_api', '0019_semantic_cache_context_key'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='ingestionjob',
+            name='firm',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='ingestion_jobs', to='llm_api.firm'),
+        ),
+        migrations.RunPython(existing_jobs_firm, migrations.RunPython.noop),
+    ]
@@ -16,17 +16,33 @@ Usage:
 
 import os
 import sys
-import pinecone
-from openai import OpenAI  # We'll use the new openai>=1.0.0 style
-from typing import List, Tuple
-from dotenv import load_dotenv
-from pinecone import Pinecone
+import time
+import asyncio
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple, Union
+
+try:
+    from .chunking import Chunk, iter_chunks
+    from .clients import acreate_embeddings, chat_completion, create_embeddings
+    from .embeddings import DEFAULT_PATH as EMBEDDING_CACHE_DEFAULT_PATH, EmbeddingCache
+    from .retrieval import DEFAULT_PATH as KEYWORD_INDEX_DEFAULT_PATH, RETRIEVAL_CANDIDATES, KeywordIndex, rank
+    from .tokens import count_tokens
+    from .vector_store import Match, get_vector_store
+except ImportError:  # run as a standalone script; inside Django, settings.py loads .env
+    from dotenv import load_dotenv
+    load_dotenv()
+    from chunking import Chunk, iter_chunks
+    from clients import acreate_embeddings, chat_completion, create_embeddings
+    from embeddings import DEFAULT_PATH as EMBEDDING_CACHE_DEFAULT_PATH, EmbeddingCache
+    from retrieval import DEFAULT_PATH as KEYWORD_INDEX_DEFAULT_PATH, RETRIEVAL_CANDIDATES, KeywordIndex, rank
+    from tokens import count_tokens
+    from vector_store import Match, get_vector_store
 
 # ------------------- Configuration Section ------------------- #
 # If you store these in environment variables, we read them; otherwise fill in directly here.
 
-load_dotenv()
-
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 PINECONE_API_KEY = os.getenv("PINECONE_API_KEY")
 # e.g. 'us-east-1-aws' or 'us-east1-gcp'
@@ -38,72 +54,288 @@ INDEX_NAME = os.getenv("PINECONE_INDEX_NAME")
 # Good for general embeddings
 EMBEDDING_MODEL = os.getenv("PINECONE_EMBEDDING_MODEL")
 GPT_MODEL = os.getenv("GPT_MODEL")            # or "gpt-4"
+# shared, read-only base corpus (the laws, loaded with chunk-and-store); uploads go to
+# the uploading firm's or user's own namespace (firm_namespace / user_namespace)
 NAMESPACE = os.getenv("NAMESPACE")
 # Create OpenAI client
 DIMENSION = 1536
-TOP_K = 3
+# plain vector lookups (query_pinecone); retrieve_chunks sizes its results with
+# RETRIEVAL_MAX_CHUNKS and RETRIEVAL_TOKEN_BUDGET (see retrieval.py)
+TOP_K = int(os.getenv("TOP_K", "3"))
 
-openai_client = OpenAI(api_key=OPENAI_API_KEY)
-pc = Pinecone(api_key=PINECONE_API_KEY)
-index = pc.Index(INDEX_NAME)
+# Batched ingestion. The embeddings endpoint accepts up to 2048 inputs and
+# 300k tokens per request; stay a little under the token ceiling.
+EMBED_BATCH_MAX_INPUTS = int(os.getenv("EMBED_BATCH_MAX_INPUTS", "256"))
+EMBED_BATCH_MAX_TOKENS = int(os.getenv("EMBED_BATCH_MAX_TOKENS", "250000"))
+EMBED_WORKERS = int(os.getenv("EMBED_WORKERS", "4"))
+UPSERT_BATCH_SIZE = int(os.getenv("UPSERT_BATCH_SIZE", "100"))
 
-# ------------------- 1. Document Chunking ------------------- #
+# OpenAI and Pinecone clients, timeouts and retries live in clients.py;
+# VECTOR_STORE picks Pinecone or the local index (see vector_store.py)
 
+# embeddings by (model, sha256(text)); an LRU in front of a SQLite file that survives restarts
+embedding_cache = EmbeddingCache(
+    path=os.getenv("EMBEDDING_CACHE_PATH", EMBEDDING_CACHE_DEFAULT_PATH) or None,
+    max_items=int(os.getenv("EMBEDDING_CACHE_MEMORY_ITEMS", "10000")),
+)
 
-def chunk_text(text: str, chunk_size=1000, overlap=100) -> List[str]:
-    chunks = []
-    start = 0
-    text_length = len(text)
+# BM25 side of hybrid retrieval; every upsert and delete goes to both indexes
+keyword_index = KeywordIndex(os.getenv("KEYWORD_INDEX_PATH") or KEYWORD_INDEX_DEFAULT_PATH)
 
-    while start < text_length:
-        end = start + chunk_size
-        chunk_end = min(text_length, end + overlap)
-        chunk = text[start:chunk_end].strip()
-        chunks.append(chunk)
-        start += chunk_size
+# shared by request threads for the concurrent namespace lookups in retrieve_chunks
+retrieval_pool = ThreadPoolExecutor(max_workers=8, thread_name_prefix="retrieval")
 
-    return chunks
+# ------------------- 1. Document Chunking ------------------- #
+# Structure-aware chunking (articles, paragraphs, points) lives in chunking.py;
+# iter_chunks yields Chunk(text, metadata) lazily.
 
 # ------------------- 2. Generate Embeddings ------------------- #
 
 
 def get_embedding(text: str) -> List[float]:
-    resp = openai_client.embeddings.create(
-        model=EMBEDDING_MODEL,
-        input=[text]
-    )
-    return resp.data[0].embedding
+    return get_embeddings([text])[0]
+
+
+def pack_embedding_batches(chunks: Iterable[Tuple[int, Chunk]]) -> Iterator[List[Tuple[int, Chunk]]]:
+    """
+    Groups numbered chunks into embedding requests that respect the per-request
+    input count and token limits of the embeddings endpoint.
+    """
+    batch, batch_tokens = [], 0
+    for item in chunks:
+        tokens = count_tokens(item[1].text, EMBEDDING_MODEL)
+        if batch and (len(batch) >= EMBED_BATCH_MAX_INPUTS or batch_tokens + tokens > EMBED_BATCH_MAX_TOKENS):
+            yield batch
+            batch, batch_tokens = [], 0
+        batch.append(item)
+        batch_tokens += tokens
+    if batch:
+        yield batch
+
+
+def get_embeddings(texts: List[str]) -> List[List[float]]:
+    """
+    Embeds a batch of texts, keeping the input order. Texts already in the
+    embedding cache are not sent; the rest go out in one request.
+    """
+    found = embedding_cache.get_many(EMBEDDING_MODEL, texts)
+    missing = [text for text in dict.fromkeys(texts) if text not in found]
+    if missing:
+        resp = create_embeddings(model=EMBEDDING_MODEL, input=missing)
+        fresh = [item.embedding for item in sorted(resp.data, key=lambda d: d.index)]
+        embedding_cache.put_many(EMBEDDING_MODEL, zip(missing, fresh))
+        found.update(zip(missing, fresh))
+    return [found[text] for text in texts]
+
+
+class StageStats:
+    """Item count and wall time for one ingestion stage."""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.items = 0
+        self.calls = 0
+        self.seconds = 0.0
+        self.lock = threading.Lock()
+
+    def add(self, items: int, seconds: float):
+        with self.lock:
+            self.items += items
+            self.calls += 1
+            self.seconds += seconds
+
+    def as_dict(self) -> Dict[str, float]:
+        return {
+            "items": self.items,
+            "calls": self.calls,
+            "seconds": round(self.seconds, 3),
+            "items_per_second": round(self.items / self.seconds, 1) if self.seconds else 0.0,
+        }
 
 # ------------------- 3. Upsert Embeddings into Pinecone ------------------- #
 
 
-def upsert_chunks(chunks: List[str], metadata_prefix="Document"):
-    vectors = []
+def upsert_chunks(chunks: Iterable[Union[str, Chunk]], metadata_prefix="Document",
+                  progress_callback: Optional[Callable[[int, int], None]] = None,
+                  chunk_id: Optional[Callable[[int, Chunk], str]] = None,
+                  namespace: Optional[str] = NAMESPACE) -> Dict[str, Dict[str, float]]:
+    """
+    Embeds chunks in packed batches on a bounded worker pool and upserts the
+    vectors in fixed-size batches as embeddings come back. chunks may be a
+    generator (see chunking.iter_chunks); only a few batches are held at once.
+    progress_callback(embedded, produced) is called after every embedding batch,
+    produced being the number of chunks taken from the input so far.
+    chunk_id(i, chunk) names the vectors; by default "<metadata_prefix>-<i>".
+    Returns per-stage throughput stats and the chunk count.
+    """
+    chunk_id = chunk_id or (lambda i, chunk: f"{metadata_prefix}-{i}")
+    embed_stats, upsert_stats = StageStats("embed"), StageStats("upsert")
+    started = time.perf_counter()
+    produced = 0
+
+    def numbered():
+        nonlocal produced
+        for i, chunk in enumerate(chunks):
+            produced = i + 1
+            yield i, chunk if isinstance(chunk, Chunk) else Chunk(chunk, {})
+
+    def embed_batch(batch: List[Tuple[int, Chunk]]):
+        t0 = time.perf_counter()
+        embeddings = get_embeddings([chunk.text for _, chunk in batch])
+        embed_stats.add(len(batch), time.perf_counter() - t0)
+        return batch, embeddings
+
+    def flush(vectors):
+        t0 = time.perf_counter()
+        get_vector_store().upsert(vectors, namespace=namespace)
+        keyword_index.add(vectors, namespace=namespace)
+        upsert_stats.add(len(vectors), time.perf_counter() - t0)
+
+    pending = []
+    embedded = 0
+
+    def collect(result):
+        nonlocal pending, embedded
+        batch, embeddings = result
+        for (i, chunk), emb in zip(batch, embeddings):
+            meta = {**chunk.metadata, "text": chunk.text, "source": metadata_prefix}
+            pending.append({"id": chunk_id(i, chunk), "values": emb, "metadata": meta})
+        embedded += len(batch)
+        if progress_callback:
+            progress_callback(embedded, produced)
+        while len(pending) >= UPSERT_BATCH_SIZE:
+            flush(pending[:UPSERT_BATCH_SIZE])
+            pending = pending[UPSERT_BATCH_SIZE:]
+
+    # at most two batches per worker in flight, so a generator input is never drained up front
+    in_flight = deque()
+    with ThreadPoolExecutor(max_workers=EMBED_WORKERS, thread_name_prefix="embed") as pool:
+        for batch in pack_embedding_batches(numbered()):
+            in_flight.append(pool.submit(embed_batch, batch))
+            if len(in_flight) >= EMBED_WORKERS * 2:
+                collect(in_flight.popleft().result())
+        while in_flight:
+            collect(in_flight.popleft().result())
+    if pending:
+        flush(pending)
+
+    stats = {"embed": embed_stats.as_dict(), "upsert": upsert_stats.as_dict(), "chunks": produced,
+             "total_seconds": round(time.perf_counter() - started, 3)}
+    print(f"[INFO] Upserted {produced} chunks from '{metadata_prefix}' into namespace '{namespace or ''}'. Stats: {stats}")
+    return stats
+
+
+def delete_vectors(ids: Iterable[str], namespace: Optional[str] = NAMESPACE):
+    ids = list(ids)
+    get_vector_store().delete(ids, namespace=namespace)
+    keyword_index.delete(ids, namespace=namespace)
 
-    for i, chunk in enumerate(chunks):
-        emb = get_embedding(chunk)
-        vector_id = f"{metadata_prefix}-{i}"
-        meta = {"text": chunk, "source": metadata_prefix}
-        vectors.append({"id": vector_id, "values": emb, "metadata": meta})
+# ------------------- 4. Retrieve Relevant Chunks ------------------- #
 
-    index.upsert(vectors=vectors, namespace=NAMESPACE)
-    print(f"[INFO] Upserted {len(chunks)} chunks from '{metadata_prefix}'.")
+# a namespace, or several searched as one pool
+Scope = Union[Optional[str], Tuple[Optional[str], ...]]
 
-# ------------------- 4. Retrieve Relevant Chunks ------------------- #
+
+def query_vector(query_emb: List[float], top_k=TOP_K, namespace: Optional[str] = NAMESPACE) -> List[Tuple[str, float]]:
+    matches = [(match.metadata["text"], match.score)
+               for match in get_vector_store().query(query_emb, top_k, namespace)]
+    return matches
 
 
 def query_pinecone(query_text: str, top_k=TOP_K) -> List[Tuple[str, float]]:
+    return query_vector(get_embedding(query_text), top_k=top_k)
+
+
+def firm_namespace(firm_id: int) -> str:
+    return f"firm-{firm_id}"
+
+
+def user_namespace(user_id: int) -> str:
+    return f"user-{user_id}"
+
+
+def scope_namespaces(scope: Scope) -> Tuple[Optional[str], ...]:
+    return scope if isinstance(scope, tuple) else (scope,)
+
+
+def merge_dense(lookups: List[List[Match]]) -> List[Match]:
+    """Vector matches from several namespaces as one ranking; cosine scores compare across namespaces."""
+    return sorted((match for matches in lookups for match in matches), key=lambda m: -m.score)[:RETRIEVAL_CANDIDATES]
+
+
+def retrieve_chunks(query_text: str, scopes: List[Scope],
+                    max_chunks: Optional[int] = None) -> List[List[Tuple[str, float]]]:
+    """
+    Embeds the query once and runs a hybrid search (see retrieval.py) for every scope.
+    A scope is a namespace or a tuple of namespaces whose chunks compete in one
+    ranking, e.g. a firm's and its user's uploads. The vector lookups of all distinct
+    namespaces run concurrently. Returns one match list per scope; a chunk already
+    returned for an earlier scope is left out of the later ones.
+    """
     query_emb = get_embedding(query_text)
-    result = index.query(
-        vector=query_emb,
-        top_k=top_k,
-        include_metadata=True,
-        namespace=NAMESPACE
+    scopes = [scope_namespaces(scope) for scope in scopes]
+    distinct = list(dict.fromkeys(ns for scope in scopes for ns in scope))
+    store = get_vector_store()
+    futures = {ns: retrieval_pool.submit(store.query, query_emb, RETRIEVAL_CANDIDATES, ns) for ns in distinct}
+    results = []
+    for scope in scopes:
+        sparse = keyword_index.search(query_text, RETRIEVAL_CANDIDATES, scope)
+        dense = merge_dense([futures[ns].result() for ns in scope])
+        results.append(rank(query_text, dense, sparse, max_chunks))
+    return dedupe_matches(results)
+
+
+def dedupe_matches(lookups: List[List[Tuple[str, float]]]) -> List[List[Tuple[str, float]]]:
+    """Drops chunks that an earlier lookup in the list already returned."""
+    seen = set()
+    results = []
+    for matches in lookups:
+        unique = []
+        for text, score in matches:
+            if text not in seen:
+                seen.add(text)
+                unique.append((text, score))
+        results.append(unique)
+    return results
+
+# ------------------- 4b. Async Variants (ASGI views) ------------------- #
+
+
+async def aget_embeddings(texts: List[str]) -> List[List[float]]:
+    # the cache reads and writes a SQLite file, which must not block the event loop
+    found = await asyncio.to_thread(embedding_cache.get_many, EMBEDDING_MODEL, texts)
+    missing = [text for text in dict.fromkeys(texts) if text not in found]
+    if missing:
+        resp = await acreate_embeddings(model=EMBEDDING_MODEL, input=missing)
+        fresh = [item.embedding for item in sorted(resp.data, key=lambda d: d.index)]
+        await asyncio.to_thread(embedding_cache.put_many, EMBEDDING_MODEL, list(zip(missing, fresh)))
+        found.update(zip(missing, fresh))
+    return [found[text] for text in texts]
+
+
+async def aget_embedding(text: str) -> List[float]:
+    return (await aget_embeddings([text]))[0]
+
+
+async def aquery_vector(query_emb: List[float], top_k=TOP_K, namespace: Optional[str] = NAMESPACE) -> List[Tuple[str, float]]:
+    return [(match.metadata["text"], match.score)
+            for match in await get_vector_store().aquery(query_emb, top_k, namespace)]
+
+
+async def aretrieve_chunks(query_text: str, scopes: List[Scope],
+                           max_chunks: Optional[int] = None) -> List[List[Tuple[str, float]]]:
+    """Async retrieve_chunks: one embedding, the namespace lookups gathered concurrently."""
+    query_emb = await aget_embedding(query_text)
+    scopes = [scope_namespaces(scope) for scope in scopes]
+    distinct = list(dict.fromkeys(ns for scope in scopes for ns in scope))
+    store = get_vector_store()
+    dense_results, sparse_results = await asyncio.gather(
+        asyncio.gather(*(store.aquery(query_emb, RETRIEVAL_CANDIDATES, ns) for ns in distinct)),
+        asyncio.to_thread(lambda: [keyword_index.search(query_text, RETRIEVAL_CANDIDATES, scope) for scope in scopes]),
     )
-
-    matches = [(match.metadata["text"], match.score)
-               for match in result.matches]
-    return matches
+    dense = dict(zip(distinct, dense_results))
+    return dedupe_matches([rank(query_text, merge_dense([dense[ns] for ns in scope]), sparse, max_chunks)
+                           for scope, sparse in zip(scopes, sparse_results)])
 
 # ------------------- 5. Call GPT with Retrieved Context ------------------- #
 
@@ -123,7 +355,7 @@ def get_gpt_answer(query: str, retrieved_chunks: List[Tuple[str, float]]) -> str
         {"role": "user", "content": query}
     ]
 
-    resp = openai_client.chat.completions.create(
+    resp = chat_completion(
         model=GPT_MODEL,
         messages=messages,
         temperature=0.1
@@ -151,9 +383,8 @@ def main():
         with open(file_path, "r", encoding="utf-8") as f:
             text_data = f.read()
 
-        chunks = chunk_text(text_data)
         prefix = os.path.basename(file_path).replace(".txt", "")
-        upsert_chunks(chunks, metadata_prefix=prefix)
+        upsert_chunks(iter_chunks(text_data), metadata_prefix=prefix)
 
     elif command == "query":
         print("Interactive query mode. Type 'exit' to quit.")
@@ -162,7 +393,7 @@ def main():
             if user_query.lower().strip() == "exit":
                 break
 
-            retrieved = query_pinecone(user_query)
+            retrieved = retrieve_chunks(user_query, [NAMESPACE])[0]
             answer = get_gpt_answer(user_query, retrieved)
             print("\n[AI Answer]:", answer, "\n")
 
@@ -1,4 +1,5 @@
-from django.db import models
+from django.db import models, transaction
+from django.db.models import F
 from django.contrib.auth.models import User
 
 
@@ -10,6 +11,12 @@ class Firm(models.Model):
     image = models.ImageField(upload_to="firm_images/", blank=True, null=True)
     website = models.URLField(blank=True, null=True)  # Stores the website URL
     created_at = models.DateTimeField(auto_now_add=True)
+    # last document number handed out; numbers of deleted documents are not reused
+    document_count = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        # firm list, newest first
+        indexes = [models.Index(fields=["-created_at"])]
 
     def __str__(self):
         return self.name
@@ -17,8 +24,29 @@ class Firm(models.Model):
 
 class MainDocument(models.Model):
     """Stores the main PLAN document associated with a firm"""
+    STATUS_GENERATING = "generating"
+    STATUS_READY = "ready"
+    STATUS_FAILED = "failed"
+    STATUS_CHOICES = [
+        (STATUS_GENERATING, "Generating"),
+        (STATUS_READY, "Ready"),
+        (STATUS_FAILED, "Failed"),
+    ]
+
     firm = models.OneToOneField(Firm, on_delete=models.CASCADE)
-    text = models.TextField()
+    # While generating, holds the partial plan streamed so far
+    text = models.TextField(blank=True)
+    status = models.CharField(max_length=16, choices=STATUS_CHOICES, default=STATUS_READY)
+    error = models.TextField(blank=True)
+    # Bumped on every update so caches built on an older plan stop matching
+    version = models.PositiveIntegerField(default=1)
+    # queryset updates (plan generation) set it themselves
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def save(self, *args, **kwargs):
+        if self.pk is not None:
+            self.version += 1
+        super().save(*args, **kwargs)
 
     def __str__(self):
         return f"Main Document for {self.firm.name}"
@@ -31,6 +59,10 @@ class AIInteraction(models.Model):
     ai_response = models.TextField()
     created_at = models.DateTimeField(auto_now_add=True)
 
+    class Meta:
+        # latest turns of a firm's chat (conversation context, interaction list)
+        indexes = [models.Index(fields=["firm", "-created_at"])]
+
     def __str__(self):
         return f"Interaction {self.id} for {self.firm.name}"
 
@@ -45,19 +77,162 @@ class Document(models.Model):
     title = models.CharField(max_length=255)
     text = models.TextField(blank=False)
     uploaded_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
 
     class Meta:
         # Each firm has unique doc numbers
         unique_together = ("firm", "document_number")
         ordering = ["firm", "document_number"]
 
+    @staticmethod
+    def next_number(firm_id):
+        """
+        Allocates the firm's next document number. The counter update locks the
+        firm row until the transaction ends, so concurrent saves get distinct numbers.
+        """
+        with transaction.atomic():
+            Firm.objects.filter(id=firm_id).update(document_count=F("document_count") + 1)
+            return Firm.objects.filter(id=firm_id).values_list("document_count", flat=True).get()
+
     def save(self, *args, **kwargs):
         """Assigns a unique document number per firm, starting from 1."""
         if not self.document_number:
-            last_doc = Document.objects.filter(
-                firm=self.firm).order_by("-document_number").first()
-            self.document_number = last_doc.document_number + 1 if last_doc else 1
+            self.document_number = Document.next_number(self.firm_id)
         super().save(*args, **kwargs)
 
     def __str__(self):
         return f"{self.firm.name} - Document {self.document_number}: {self.title}"
+
+
+class IngestionSource(models.Model):
+    """A document in a user's RAG index; uploading it again updates its vectors in place"""
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name="ingestion_sources")
+    # uploads for a firm are retrieved in that firm's chats, the others in all of the user's chats
+    firm = models.ForeignKey(Firm, on_delete=models.CASCADE, null=True, blank=True, related_name="ingestion_sources")
+    # vector store namespace the chunks live in, fixed when the source is created
+    namespace = models.CharField(max_length=255, blank=True)
+    source_type = models.CharField(max_length=8)
+    # URL, file name or the name given with the upload
+    name = models.CharField(max_length=2048)
+    # sha256 of the source type and identity (URL, file name, given name or text hash)
+    key = models.CharField(max_length=64)
+    chunk_count = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = ("user", "key")
+        indexes = [models.Index(fields=["user", "-updated_at"])]
+
+    @property
+    def vector_prefix(self):
+        return f"user-{self.user_id}-source-{self.id}"
+
+    def __str__(self):
+        return f"RAG source {self.id}: {self.name}"
+
+
+class IngestedChunk(models.Model):
+    """Manifest entry: a chunk of a source, by content hash, and the id of its vector"""
+    source = models.ForeignKey(IngestionSource, on_delete=models.CASCADE, related_name="chunks")
+    content_hash = models.CharField(max_length=64)
+    vector_id = models.CharField(max_length=255)
+
+    class Meta:
+        unique_together = ("source", "content_hash")
+
+    def __str__(self):
+        return f"Chunk {self.content_hash[:12]} of source {self.source_id}"
+
+
+class IngestionJob(models.Model):
+    """RAG upload waiting for, or processed by, an ingestion worker"""
+    STATUS_QUEUED = "queued"
+    STATUS_RUNNING = "running"
+    STATUS_SUCCEEDED = "succeeded"
+    STATUS_FAILED = "failed"
+    STATUS_CHOICES = [
+        (STATUS_QUEUED, "Queued"),
+        (STATUS_RUNNING, "Running"),
+        (STATUS_SUCCEEDED, "Succeeded"),
+        (STATUS_FAILED, "Failed"),
+    ]
+
+    SOURCE_PDF = "pdf"
+    SOURCE_URL = "url"
+    SOURCE_TEXT = "text"
+    SOURCE_CHOICES = [
+        (SOURCE_PDF, "PDF"),
+        (SOURCE_URL, "URL"),
+        (SOURCE_TEXT, "Text"),
+    ]
+
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name="ingestion_jobs")
+    source = models.ForeignKey(IngestionSource, on_delete=models.SET_NULL, null=True, blank=True, related_name="jobs")
+    # the firm the upload was for, so a source deleted while the job waits is recreated in the right namespace
+    firm = models.ForeignKey(Firm, on_delete=models.CASCADE, null=True, blank=True, related_name="ingestion_jobs")
+    status = models.CharField(max_length=16, choices=STATUS_CHOICES, default=STATUS_QUEUED)
+    source_type = models.CharField(max_length=8, choices=SOURCE_CHOICES)
+    # Exactly one of these holds the upload, depending on source_type
+    file = models.FileField(upload_to="rag_uploads/", blank=True, null=True)
+    url = models.URLField(max_length=2048, blank=True)
+    text = models.TextField(blank=True)
+    # URL jobs: HTTP validators and hash of the extracted text, so re-adding an unchanged page is skipped
+    etag = models.CharField(max_length=255, blank=True)
+    last_modified = models.CharField(max_length=64, blank=True)
+    content_hash = models.CharField(max_length=64, blank=True)
+
+    total_chunks = models.PositiveIntegerField(default=0)
+    embedded_chunks = models.PositiveIntegerField(default=0)
+    chunk_count = models.PositiveIntegerField(null=True, blank=True)
+    metadata_prefix = models.CharField(max_length=255, blank=True)
+    stats = models.JSONField(null=True, blank=True)
+    error = models.TextField(blank=True)
+
+    worker = models.CharField(max_length=255, blank=True)
+    attempts = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    heartbeat_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [models.Index(fields=["status", "created_at"])]
+
+    def __str__(self):
+        return f"Ingestion job {self.id} ({self.source_type}, {self.status})"
+
+
+class SemanticCacheEntry(models.Model):
+    """Embedded prompt whose answer can be reused for near-identical prompts"""
+    firm = models.ForeignKey(Firm, on_delete=models.CASCADE, related_name="semantic_cache_entries")
+    main_document_version = models.PositiveIntegerField()
+    # Version of the system prompt template the answer was generated with
+    prompt_version = models.CharField(max_length=64, blank=True)
+    # Hash of the conversation history and RAG namespaces the answer was generated with
+    context_key = models.CharField(max_length=64, blank=True)
+    interaction = models.ForeignKey(AIInteraction, on_delete=models.CASCADE)
+    # Unit-length float32 vector, so a dot product is the cosine similarity
+    embedding = models.BinaryField()
+    hits = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    last_hit_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [models.Index(fields=["firm", "main_document_version", "created_at"])]
+
+    def __str__(self):
+        return f"Cached answer {self.interaction_id} for {self.firm.name}"
+
+
+class ConversationSummary(models.Model):
+    """Rolling summary of a firm's older chat interactions"""
+    firm = models.OneToOneField(Firm, on_delete=models.CASCADE, related_name="conversation_summary")
+    text = models.TextField(blank=True)
+    # Interactions with an id up to this one are folded into the summary
+    last_interaction_id = models.BigIntegerField(default=0)
+    interaction_count = models.PositiveIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"Conversation summary for {self.firm.name}"
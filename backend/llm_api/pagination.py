@@ -0,0 +1,32 @@
+"""
+Keyset (cursor) pagination for the list endpoints.
+
+Pages are cut with WHERE <ordering> > <last value seen> instead of OFFSET, so
+every page costs the same however far into a firm's history it is. ?limit=
+sets the page size (up to MAX_PAGE_SIZE); the response's next/previous links
+carry an opaque ?cursor= for the neighbouring page.
+"""
+
+from rest_framework.pagination import CursorPagination
+
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 500
+
+
+class KeysetPagination(CursorPagination):
+    page_size = DEFAULT_PAGE_SIZE
+    page_size_query_param = "limit"
+    max_page_size = MAX_PAGE_SIZE
+
+
+class FirmPagination(KeysetPagination):
+    ordering = "-created_at"
+
+
+class DocumentPagination(KeysetPagination):
+    ordering = "document_number"
+
+
+class InteractionPagination(KeysetPagination):
+    # newest first: the first page is the latest part of the conversation
+    ordering = "-created_at"
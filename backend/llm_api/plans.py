@@ -0,0 +1,137 @@
+"""
+Background generation of a new firm's starting plan.
+
+CreateFirmView creates the MainDocument with status "generating" and hands
+the GPT-4 call to the background pool. The completion is streamed and the
+partial text is written to the document every FLUSH_INTERVAL seconds, so
+the plan status/stream endpoints can show progress; the document is marked
+ready (or failed) when the stream ends.
+
+A plan left "generating" by a process that died would block edits and chat
+for good, so the views fail a plan that has written no progress for
+PLAN_STALE_MINUTES when they read it (expire_stale).
+"""
+
+import asyncio
+import logging
+import os
+import time
+from datetime import timedelta
+
+from django.db.models import F
+from django.utils import timezone
+
+from .background import run_in_background
+from .clients import achat_completion, chat_completion
+from .models import MainDocument
+from .prompt_templates import registry as prompt_templates
+
+logger = logging.getLogger(__name__)
+
+FLUSH_INTERVAL = 1.0
+# well past the stream read timeout and its retries, so only a lost generation goes stale
+STALE_AFTER = timedelta(minutes=float(os.getenv("PLAN_STALE_MINUTES", "5")))
+STALE_ERROR = "Plan generation stopped before it finished; please try again."
+
+
+def plan_messages(firm_details: str):
+    return [
+        {"role": "user",
+         "content": f"Answer in bulgarian. {prompt_templates.get('GeneratePlan.txt')}. \n\n Firm details: {firm_details}"}
+    ]
+
+
+def is_stale(status: str, updated_at) -> bool:
+    return status == MainDocument.STATUS_GENERATING and updated_at < timezone.now() - STALE_AFTER
+
+
+def fail_stale_plan(main_document_id: int, updated_at) -> bool:
+    """Fails a plan that has not changed since updated_at; False if its generation moved on meanwhile."""
+    return bool(MainDocument.objects.filter(
+        id=main_document_id, status=MainDocument.STATUS_GENERATING, updated_at=updated_at,
+    ).update(status=MainDocument.STATUS_FAILED, error=STALE_ERROR, version=F("version") + 1, updated_at=timezone.now()))
+
+
+def expire_stale(main_document: MainDocument) -> MainDocument:
+    """Fails main_document if its generation went stale, and returns it as stored."""
+    if is_stale(main_document.status, main_document.updated_at):
+        if fail_stale_plan(main_document.id, main_document.updated_at):
+            logger.warning("Plan generation for main document %s went stale, marked failed", main_document.id)
+        main_document.refresh_from_db()
+    return main_document
+
+
+def generate_plan(main_document_id: int, firm_details: str):
+    # only while generating: a plan failed as stale stays failed when a slow stream ends after all
+    documents = MainDocument.objects.filter(id=main_document_id, status=MainDocument.STATUS_GENERATING)
+    parts = []
+    last_flush = time.monotonic()
+    try:
+        stream = chat_completion(
+            model="gpt-4",
+            messages=plan_messages(firm_details),
+            temperature=0.5,
+            stream=True
+        )
+        for chunk in stream:
+            if not chunk.choices or not chunk.choices[0].delta.content:
+                continue
+            parts.append(chunk.choices[0].delta.content)
+            if time.monotonic() - last_flush >= FLUSH_INTERVAL:
+                # queryset update, so partial writes don't bump the document version
+                documents.update(text="".join(parts), updated_at=timezone.now())
+                last_flush = time.monotonic()
+    except Exception as e:
+        logger.exception("Plan generation for main document %s failed", main_document_id)
+        documents.update(text="".join(parts), status=MainDocument.STATUS_FAILED, error=str(e),
+                         version=F("version") + 1, updated_at=timezone.now())
+        return
+
+    # the finished text is a new version of the plan, like any save
+    documents.update(text="".join(parts).strip(), status=MainDocument.STATUS_READY, error="",
+                     version=F("version") + 1, updated_at=timezone.now())
+
+
+def start_plan_generation(main_document: MainDocument, firm_details: str):
+    return run_in_background(generate_plan, main_document.id, firm_details)
+
+
+async def agenerate_plan(main_document_id: int, firm_details: str):
+    """generate_plan for ASGI: AsyncOpenAI streaming and async ORM writes."""
+    documents = MainDocument.objects.filter(id=main_document_id, status=MainDocument.STATUS_GENERATING)
+    parts = []
+    last_flush = time.monotonic()
+    try:
+        stream = await achat_completion(
+            model="gpt-4",
+            messages=plan_messages(firm_details),
+            temperature=0.5,
+            stream=True
+        )
+        async for chunk in stream:
+            if not chunk.choices or not chunk.choices[0].delta.content:
+                continue
+            parts.append(chunk.choices[0].delta.content)
+            if time.monotonic() - last_flush >= FLUSH_INTERVAL:
+                await documents.aupdate(text="".join(parts), updated_at=timezone.now())
+                last_flush = time.monotonic()
+    except Exception as e:
+        logger.exception("Plan generation for main document %s failed", main_document_id)
+        await documents.aupdate(text="".join(parts), status=MainDocument.STATUS_FAILED, error=str(e),
+                                version=F("version") + 1, updated_at=timezone.now())
+        return
+
+    await documents.aupdate(text="".join(parts).strip(), status=MainDocument.STATUS_READY, error="",
+                            version=F("version") + 1, updated_at=timezone.now())
+
+
+# strong references so running tasks aren't garbage collected
+plan_tasks = set()
+
+
+def start_plan_generation_async(main_document: MainDocument, firm_details: str) -> asyncio.Task:
+    """Schedules agenerate_plan on the running event loop."""
+    task = asyncio.create_task(agenerate_plan(main_document.id, firm_details))
+    plan_tasks.add(task)
+    task.add_done_callback(plan_tasks.discard)
+    return task
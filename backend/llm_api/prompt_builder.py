@@ -0,0 +1,73 @@
+"""
+Token-budgeted prompt assembly.
+
+Sections are added with a weight. Required sections (weight=None) are always
+kept whole; the remaining budget is shared between the weighted sections in
+proportion to their weights, and whatever a small section does not use is
+handed on to the larger ones. Sections over their share are truncated.
+"""
+
+import logging
+from typing import Dict, List, Optional
+
+from .tokens import DEFAULT_MODEL, count_tokens, truncate_to_tokens
+
+logger = logging.getLogger(__name__)
+
+
+class PromptSection:
+    def __init__(self, name: str, text: str, weight: Optional[float], tokens: int):
+        self.name = name
+        self.text = text
+        self.weight = weight
+        self.tokens = tokens
+        self.allowed = tokens
+
+
+class PromptBuilder:
+    def __init__(self, budget: int, model: str = DEFAULT_MODEL, reserved: int = 0):
+        # reserved covers tokens outside the sections, e.g. labels and the user message
+        self.budget = budget
+        self.model = model
+        self.reserved = reserved
+        self.sections: List[PromptSection] = []
+
+    def add(self, name: str, text: str, weight: Optional[float] = 1.0):
+        text = text or ""
+        self.sections.append(PromptSection(name, text, weight, count_tokens(text, self.model) if text else 0))
+        return self
+
+    def allocate(self):
+        required = [s for s in self.sections if s.weight is None]
+        flexible = [s for s in self.sections if s.weight is not None]
+        remaining = max(0, self.budget - self.reserved - sum(s.tokens for s in required))
+
+        # water-filling: sections that fit in their share keep everything and release the rest
+        unsettled = list(flexible)
+        while unsettled:
+            total_weight = sum(s.weight for s in unsettled) or 1.0
+            fitting = [s for s in unsettled if s.tokens <= remaining * s.weight / total_weight]
+            if not fitting:
+                for s in unsettled:
+                    s.allowed = int(remaining * s.weight / total_weight)
+                break
+            for s in fitting:
+                s.allowed = s.tokens
+                remaining -= s.tokens
+                unsettled.remove(s)
+
+    def build(self) -> Dict[str, str]:
+        """Returns each section's text, truncated to its allocation."""
+        self.allocate()
+        return {
+            s.name: s.text if s.allowed >= s.tokens else truncate_to_tokens(s.text, s.allowed, self.model)
+            for s in self.sections
+        }
+
+    def breakdown(self) -> Dict[str, Dict[str, int]]:
+        return {s.name: {"tokens": s.tokens, "used": min(s.tokens, s.allowed)} for s in self.sections}
+
+    def log_breakdown(self, label: str):
+        sections = self.breakdown()
+        used = self.reserved + sum(s["used"] for s in sections.values())
+        logger.info("%s: %d/%d prompt tokens (reserved %d) %s", label, used, self.budget, self.reserved, sections)
@@ -0,0 +1,92 @@
+"""
+Registry of the prompt templates in prompts/.
+
+Every template is read and validated once when the app starts
+(LlmApiConfig.ready), so a missing or empty template stops the server from
+booting instead of leaking into a prompt. With DEBUG on, templates are
+re-read when their file changes. Each template has a short content hash as
+its version, which caches use to drop entries built from an older prompt.
+"""
+
+import hashlib
+import os
+import threading
+from typing import Dict
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+# templates the views depend on; the app refuses to start without them
+REQUIRED_TEMPLATES = [
+    "GeneratePlan.txt",
+    "extradocPrompt.txt",
+    "systemPrompt.txt",
+    "summarizeConversation.txt",
+]
+
+
+class PromptTemplate:
+    def __init__(self, name: str, path: str):
+        self.name = name
+        self.path = path
+        self.read()
+
+    def read(self):
+        with open(self.path, "r", encoding="utf-8") as file:
+            self.text = file.read()
+        self.mtime = os.path.getmtime(self.path)
+        self.version = hashlib.sha256(self.text.encode("utf-8")).hexdigest()[:12]
+
+
+class PromptRegistry:
+    def __init__(self, directory: str, required=REQUIRED_TEMPLATES, hot_reload: bool = False):
+        self.directory = directory
+        self.required = list(required)
+        self.hot_reload = hot_reload
+        self.templates: Dict[str, PromptTemplate] = {}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def normalize(name: str) -> str:
+        return name if name.endswith(".txt") else f"{name}.txt"
+
+    def load(self):
+        """Reads every template in the directory; raises ImproperlyConfigured if any required one is missing or empty."""
+        if not os.path.isdir(self.directory):
+            raise ImproperlyConfigured(f"Prompt directory {self.directory} does not exist.")
+        templates = {
+            name: PromptTemplate(name, os.path.join(self.directory, name))
+            for name in sorted(os.listdir(self.directory)) if name.endswith(".txt")
+        }
+        missing = [name for name in self.required if not templates.get(name) or not templates[name].text.strip()]
+        if missing:
+            raise ImproperlyConfigured(f"Missing or empty prompt templates in {self.directory}: {', '.join(missing)}")
+        with self.lock:
+            self.templates = templates
+
+    def template(self, name: str) -> PromptTemplate:
+        if not self.templates:
+            self.load()
+        template = self.templates.get(self.normalize(name))
+        if template is None:
+            raise KeyError(f"Unknown prompt template '{name}'")
+        if self.hot_reload:
+            try:
+                if os.path.getmtime(template.path) != template.mtime:
+                    with self.lock:
+                        template.read()
+            except OSError:
+                pass  # file removed while running; keep serving the last good copy
+        return template
+
+    def get(self, name: str) -> str:
+        return self.template(name).text
+
+    def version(self, name: str) -> str:
+        return self.template(name).version
+
+    def versions(self) -> Dict[str, str]:
+        return {name: self.version(name) for name in list(self.templates)}
+
+
+registry = PromptRegistry(os.path.join(settings.BASE_DIR, "prompts"), hot_reload=settings.DEBUG)
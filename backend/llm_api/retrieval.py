@@ -0,0 +1,256 @@
+"""
+Hybrid retrieval: BM25 keyword search next to the vector search.
+
+Dense vectors often miss exact article numbers and rare legal terms, so the
+text of every upserted chunk also goes into a local inverted index (SQLite
+FTS5, ranked with its built-in bm25()). A lookup takes RETRIEVAL_CANDIDATES
+from each side, fuses the two rankings with reciprocal rank fusion, reranks the
+fused pool with a cheap heuristic (query term coverage and matching article
+references) and returns chunks best first until RETRIEVAL_MAX_CHUNKS or
+RETRIEVAL_TOKEN_BUDGET is reached.
+
+The keyword index is a SQLite file on the local disk (KEYWORD_INDEX_PATH),
+while the vectors may live in Pinecone: it is per host. Every process that
+ingests or retrieves must use the same file, so run the ingestion workers on
+the web host or put the file on a volume they share. A host that starts
+without the file, or with one that missed writes, is brought back in line
+with `manage.py sync_keyword_index`, which re-indexes uploaded chunks from
+the IngestedChunk manifest and their text in the vector store (the ingestion
+worker runs it at startup). The shared base corpus has no manifest; reload it
+with chunk-and-store on such a host.
+
+Terms are lower-cased, "член"/"алинея"/"точка"/"параграф" are reduced to the
+abbreviations the laws use, and longer words are cut to their first
+STEM_LENGTH letters, a crude but effective stemmer for Bulgarian inflection.
+"""
+
+import logging
+import os
+import re
+import sqlite3
+import threading
+from typing import Dict, Iterable, List, Optional, Set, Tuple, Union
+
+try:
+    from .tokens import count_tokens
+    from .vector_store import Match
+except ImportError:  # imported by model.py run as a standalone script
+    from tokens import count_tokens
+    from vector_store import Match
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "keyword_index.sqlite3")
+
+RETRIEVAL_CANDIDATES = int(os.getenv("RETRIEVAL_CANDIDATES", "20"))
+RETRIEVAL_MAX_CHUNKS = int(os.getenv("RETRIEVAL_MAX_CHUNKS", "5"))
+# tokens of chunk text per lookup; chunks are at most CHUNK_MAX_TOKENS (400) each
+RETRIEVAL_TOKEN_BUDGET = int(os.getenv("RETRIEVAL_TOKEN_BUDGET", "1200"))
+# "heuristic" or "none" (fused order only)
+RETRIEVAL_RERANK = os.getenv("RETRIEVAL_RERANK", "heuristic").lower()
+# the usual RRF constant: damps the difference between the top few ranks
+RRF_K = 60
+RERANK_COVERAGE_WEIGHT = 0.5
+RERANK_REFERENCE_WEIGHT = 1.0
+
+STEM_LENGTH = 6
+WORD = re.compile(r"§|\w+")
+REFERENCE = re.compile(r"(?<!\w)(чл|член|§|параграф)\.?\s*(\d+[а-я]?)", re.IGNORECASE)
+ABBREVIATIONS = {"член": "чл", "алинея": "ал", "алинеи": "ал", "точка": "т", "точки": "т",
+                 "параграф": "пар", "§": "пар"}
+STOPWORDS = {
+    "а", "в", "във", "да", "до", "е", "за", "и", "или", "им", "като", "към", "ли", "на", "не", "но", "от",
+    "по", "при", "с", "са", "се", "си", "със", "то", "той", "тя", "те", "че", "ще", "който", "която",
+    "което", "които", "този", "тази", "това", "тези", "ако", "как", "какво", "какви", "кой", "коя",
+}
+
+
+def terms(text: str) -> List[str]:
+    """Search terms of text, in order, for both indexing and queries."""
+    result = []
+    for word in WORD.findall(text.lower()):
+        word = ABBREVIATIONS.get(word, word)
+        if word in STOPWORDS:
+            continue
+        if word.isalpha() and len(word) > STEM_LENGTH:
+            word = word[:STEM_LENGTH]
+        result.append(word)
+    return result
+
+
+def references(text: str) -> Set[Tuple[str, str]]:
+    """Article references such as ("чл", "5") or ("пар", "3") in text."""
+    return {(ABBREVIATIONS.get(kind.lower(), kind.lower()), number.lower())
+            for kind, number in REFERENCE.findall(text)}
+
+
+def namespace_token(namespace: Optional[str]) -> str:
+    return namespace or "_"
+
+
+def phrase(text: str) -> str:
+    return '"%s"' % text.replace('"', '""')
+
+
+class KeywordIndex:
+    """
+    Chunk texts by (namespace, id) in a plain table, their namespace and terms
+    in an FTS5 table with the same rowid. The namespace is part of the MATCH, so
+    a search only reads the posting lists of its own namespaces. Upserting an id
+    replaces its text.
+    """
+
+    def __init__(self, path: str = DEFAULT_PATH):
+        self.path = path
+        self.local = threading.local()
+
+    def connection(self) -> sqlite3.Connection:
+        # sqlite connections can't be shared across threads, so keep one per thread
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            if not os.path.exists(self.path):
+                logger.warning("Keyword index %s does not exist and is created empty; keyword search misses "
+                               "earlier uploads until `manage.py sync_keyword_index` runs", self.path)
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS chunks ("
+                " rowid INTEGER PRIMARY KEY, namespace TEXT NOT NULL, id TEXT NOT NULL, text TEXT NOT NULL,"
+                " UNIQUE (namespace, id))"
+            )
+            # "-" and "_" kept inside tokens, so a namespace like "firm-12" is a single token
+            conn.execute("CREATE VIRTUAL TABLE IF NOT EXISTS chunk_terms"
+                         " USING fts5(namespace, terms, tokenize=\"unicode61 tokenchars '-_'\")")
+            self.local.conn = conn
+        return conn
+
+    def add(self, vectors: List[dict], namespace: Optional[str] = None):
+        """Indexes the text of vectors as upserted to the vector store (metadata["text"])."""
+        namespace = namespace or ""
+        conn = self.connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            for v in vectors:
+                text = (v.get("metadata") or {}).get("text", "")
+                row = conn.execute("SELECT rowid FROM chunks WHERE namespace = ? AND id = ?",
+                                   (namespace, v["id"])).fetchone()
+                if row:
+                    conn.execute("UPDATE chunks SET text = ? WHERE rowid = ?", (text, row[0]))
+                    conn.execute("DELETE FROM chunk_terms WHERE rowid = ?", row)
+                    rowid = row[0]
+                else:
+                    rowid = conn.execute("INSERT INTO chunks (namespace, id, text) VALUES (?, ?, ?)",
+                                         (namespace, v["id"], text)).lastrowid
+                conn.execute("INSERT INTO chunk_terms (rowid, namespace, terms) VALUES (?, ?, ?)",
+                             (rowid, namespace_token(namespace), " ".join(terms(text))))
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+    def delete(self, ids: Iterable[str], namespace: Optional[str] = None):
+        ids = list(ids)
+        conn = self.connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            # stay well under SQLite's bound-parameter limit
+            for start in range(0, len(ids), 500):
+                batch = ids[start:start + 500]
+                rows = conn.execute(
+                    f"SELECT rowid FROM chunks WHERE namespace = ? AND id IN ({','.join('?' * len(batch))})",
+                    [namespace or "", *batch],
+                ).fetchall()
+                conn.executemany("DELETE FROM chunk_terms WHERE rowid = ?", rows)
+                conn.executemany("DELETE FROM chunks WHERE rowid = ?", rows)
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+    def search(self, query: str, limit: int,
+               namespaces: Union[Optional[str], Iterable[Optional[str]]] = None) -> List[Match]:
+        """
+        BM25-ranked chunks containing any of the query's terms, from one namespace
+        or several; score is the negated bm25() over the terms column.
+        """
+        query_terms = list(dict.fromkeys(terms(query)))
+        if not query_terms:
+            return []
+        namespaces = [namespaces] if namespaces is None or isinstance(namespaces, str) else list(namespaces)
+        expression = "namespace : (%s) AND terms : (%s)" % (
+            " OR ".join(phrase(namespace_token(ns)) for ns in namespaces),
+            " OR ".join(phrase(term) for term in query_terms),
+        )
+        rows = self.connection().execute(
+            "SELECT c.id, c.text, bm25(chunk_terms, 0.0, 1.0) AS rank"
+            " FROM chunk_terms JOIN chunks c ON c.rowid = chunk_terms.rowid"
+            f" WHERE chunk_terms MATCH ? AND c.namespace IN ({','.join('?' * len(namespaces))})"
+            " ORDER BY rank LIMIT ?",
+            (expression, *(ns or "" for ns in namespaces), limit),
+        ).fetchall()
+        return [Match(chunk_id, -rank, {"text": text}) for chunk_id, text, rank in rows]
+
+    def ids(self, namespace: Optional[str] = None) -> Set[str]:
+        return {chunk_id for (chunk_id,) in self.connection().execute(
+            "SELECT id FROM chunks WHERE namespace = ?", (namespace or "",))}
+
+    def stats(self) -> Dict[str, int]:
+        return dict(self.connection().execute("SELECT namespace, COUNT(*) FROM chunks GROUP BY namespace").fetchall())
+
+
+def fuse(rankings: List[List[Match]], k: int = RRF_K) -> List[Tuple[Match, float]]:
+    """Reciprocal rank fusion: each list adds 1 / (k + rank) to a chunk's score."""
+    scores: Dict[str, float] = {}
+    matches: Dict[str, Match] = {}
+    for ranking in rankings:
+        for rank, match in enumerate(ranking, start=1):
+            scores[match.id] = scores.get(match.id, 0.0) + 1.0 / (k + rank)
+            # the vector store's metadata has the structural path as well
+            if match.id not in matches or len(match.metadata) > len(matches[match.id].metadata):
+                matches[match.id] = match
+    return sorted(((matches[i], score) for i, score in scores.items()), key=lambda item: -item[1])
+
+
+def rerank(query: str, fused: List[Tuple[Match, float]]) -> List[Tuple[Match, float]]:
+    """
+    Rescores the fused pool: the fused score scaled to 0..1, plus how many of
+    the query's terms the chunk contains, plus a bonus when the chunk holds an
+    article the query names.
+    """
+    if not fused:
+        return fused
+    query_terms = set(terms(query))
+    query_references = references(query)
+    best = fused[0][1]
+    rescored = []
+    for match, score in fused:
+        text = f"{match.metadata.get('path', '')}\n{match.metadata.get('text', '')}"
+        coverage = len(query_terms & set(terms(text))) / len(query_terms) if query_terms else 0.0
+        cited = bool(query_references & references(text))
+        rescored.append((match, score / best + RERANK_COVERAGE_WEIGHT * coverage + RERANK_REFERENCE_WEIGHT * cited))
+    return sorted(rescored, key=lambda item: -item[1])
+
+
+def select(ranked: List[Tuple[Match, float]], max_chunks: int, token_budget: int) -> List[Tuple[str, float]]:
+    """Takes chunks best first while they fit the token budget; the best one is always kept."""
+    selected, used = [], 0
+    for match, score in ranked:
+        if len(selected) >= max_chunks:
+            break
+        text = match.metadata.get("text", "")
+        tokens = count_tokens(text)
+        if selected and used + tokens > token_budget:
+            continue  # a smaller chunk further down may still fit
+        selected.append((text, score))
+        used += tokens
+    return selected
+
+
+def rank(query: str, dense: List[Match], sparse: List[Match], max_chunks: Optional[int] = None,
+         token_budget: Optional[int] = None) -> List[Tuple[str, float]]:
+    """Fuses vector and keyword matches for one lookup and returns (text, score) pairs."""
+    ranked = fuse([dense, sparse])
+    if RETRIEVAL_RERANK == "heuristic":
+        ranked = rerank(query, ranked)
+    return select(ranked, max_chunks or RETRIEVAL_MAX_CHUNKS, token_budget or RETRIEVAL_TOKEN_BUDGET)
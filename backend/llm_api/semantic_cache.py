@@ -0,0 +1,142 @@
+"""
+Semantic response cache for SubmitPromptView.
+
+Answers are stored with the embedding of the prompt that produced them,
+scoped to the firm, the MainDocument version and the system prompt template
+version they were generated against, and to a context key: a hash of the
+firm's rolling conversation summary and the RAG namespaces the prompt was
+answered with, so an answer is never reused for another user's uploads or
+after the summary moved on. The latest raw turns are left out of the key on
+purpose: every turn, cache hits included, adds one, so keying on them would
+never hit again. A new prompt whose cosine similarity to a stored one reaches
+SEMANTIC_CACHE_THRESHOLD gets the stored answer back instead of a GPT-4 call.
+Entries expire after SEMANTIC_CACHE_TTL_HOURS and each firm keeps at most
+SEMANTIC_CACHE_MAX_ENTRIES of them.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import threading
+from datetime import timedelta
+from typing import TYPE_CHECKING, List, Optional, Tuple
+
+from django.db.models import F
+from django.utils import timezone
+
+from .models import SemanticCacheEntry
+
+if TYPE_CHECKING:  # numpy is imported on first lookup, not at startup
+    import numpy as np
+
+logger = logging.getLogger(__name__)
+
+ENABLED = os.getenv("SEMANTIC_CACHE_ENABLED", "false").lower() in ("1", "true", "yes")
+THRESHOLD = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.95"))
+TTL = timedelta(hours=float(os.getenv("SEMANTIC_CACHE_TTL_HOURS", "72")))
+MAX_ENTRIES = int(os.getenv("SEMANTIC_CACHE_MAX_ENTRIES", "200"))
+
+
+class CacheCounters:
+    """Hit/miss counts and the similarity of the nearest stored prompt, for tuning THRESHOLD."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.similarity_total = 0.0
+        self.compared = 0
+
+    def record(self, hit: bool, similarity: Optional[float]):
+        with self.lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+            if similarity is not None:
+                self.similarity_total += similarity
+                self.compared += 1
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "enabled": ENABLED,
+                "threshold": THRESHOLD,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+                "mean_nearest_similarity": round(self.similarity_total / self.compared, 4) if self.compared else None,
+            }
+
+
+counters = CacheCounters()
+
+
+def normalize(embedding: List[float]) -> "np.ndarray":
+    import numpy as np
+
+    vector = np.asarray(embedding, dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+
+def context_key(summary: str, scopes) -> str:
+    """Hash of what an answer depends on besides the prompt and the plan: the conversation summary and the namespaces."""
+    payload = json.dumps([summary, scopes], ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def lookup(firm, main_document_version: int, prompt_version: str, context: str,
+           embedding: List[float]) -> Optional[Tuple[SemanticCacheEntry, float]]:
+    """Returns the closest live entry and its similarity if it clears THRESHOLD."""
+    import numpy as np
+
+    rows = list(
+        SemanticCacheEntry.objects
+        .filter(firm=firm, main_document_version=main_document_version, prompt_version=prompt_version,
+                context_key=context, created_at__gte=timezone.now() - TTL)
+        .values_list("id", "embedding")
+    )
+    query = normalize(embedding)
+    rows = [(entry_id, blob) for entry_id, blob in rows if len(blob) == query.nbytes]
+    if not rows:
+        counters.record(False, None)
+        return None
+
+    matrix = np.frombuffer(b"".join(bytes(blob) for _, blob in rows), dtype=np.float32).reshape(len(rows), -1)
+    scores = matrix @ query
+    best = int(np.argmax(scores))
+    similarity = float(scores[best])
+
+    if similarity < THRESHOLD:
+        counters.record(False, similarity)
+        logger.info("Firm %s: semantic cache miss (nearest %.4f)", firm.id, similarity)
+        return None
+
+    entry_id = rows[best][0]
+    SemanticCacheEntry.objects.filter(id=entry_id).update(hits=F("hits") + 1, last_hit_at=timezone.now())
+    counters.record(True, similarity)
+    logger.info("Firm %s: semantic cache hit on entry %s (%.4f)", firm.id, entry_id, similarity)
+    return SemanticCacheEntry.objects.select_related("interaction").get(id=entry_id), similarity
+
+
+def store(firm, main_document_version: int, prompt_version: str, context: str, embedding: List[float], interaction):
+    """Adds an answer to the cache and evicts expired and surplus entries for the firm."""
+    SemanticCacheEntry.objects.create(
+        firm=firm,
+        main_document_version=main_document_version,
+        prompt_version=prompt_version,
+        context_key=context,
+        interaction=interaction,
+        embedding=normalize(embedding).tobytes(),
+    )
+    entries = SemanticCacheEntry.objects.filter(firm=firm)
+    entries.filter(created_at__lt=timezone.now() - TTL).delete()
+    # entries for older plan or prompt versions can never match again
+    entries.exclude(main_document_version=main_document_version, prompt_version=prompt_version).delete()
+    surplus = entries.order_by("-created_at").values_list("id", flat=True)[MAX_ENTRIES:]
+    surplus_ids = list(surplus)
+    if surplus_ids:
+        SemanticCacheEntry.objects.filter(id__in=surplus_ids).delete()
@@ -1,10 +1,12 @@
 from rest_framework import serializers
-from .models import Firm, MainDocument, AIInteraction, Document
+from .models import Firm, MainDocument, AIInteraction, Document, IngestionJob, IngestionSource
 
 class FirmSerializer(serializers.ModelSerializer):
     class Meta:
         model = Firm
         fields = "__all__"
+        # allocated by Document.next_number; a client lowering it would hand out taken numbers
+        read_only_fields = ["document_count"]
 
 class MainDocumentSerializer(serializers.ModelSerializer):
     class Meta:
@@ -20,3 +22,54 @@ class DocumentSerializer(serializers.ModelSerializer):
     class Meta:
         model = Document
         fields = "__all__"
+
+class SummarySerializer(serializers.ModelSerializer):
+    """
+    List serializer that leaves large text fields out by default. Serializes
+    Meta.summary_fields, or the fields named with ?fields=a,b (see requested_fields).
+    """
+
+    def __init__(self, *args, fields=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        keep = set(fields or self.Meta.summary_fields)
+        for name in list(self.fields):
+            if name not in keep:
+                self.fields.pop(name)
+
+    @classmethod
+    def requested_fields(cls, request):
+        """?fields= names that exist on the serializer, or the summary fields; unknown names are ignored."""
+        requested = [name.strip() for name in request.query_params.get("fields", "").split(",")]
+        return [name for name in dict.fromkeys(requested) if name in cls.Meta.fields] or list(cls.Meta.summary_fields)
+
+class FirmSummarySerializer(SummarySerializer):
+    class Meta:
+        model = Firm
+        fields = ["id", "name", "description", "image", "website", "created_at"]
+        summary_fields = ["id", "name", "created_at"]
+
+class DocumentSummarySerializer(SummarySerializer):
+    class Meta:
+        model = Document
+        fields = ["id", "firm", "document_number", "title", "text", "uploaded_at", "updated_at"]
+        summary_fields = ["id", "firm", "document_number", "title", "uploaded_at", "updated_at"]
+
+class AIInteractionSummarySerializer(SummarySerializer):
+    class Meta:
+        model = AIInteraction
+        fields = ["id", "firm", "user_prompt", "ai_response", "created_at"]
+        summary_fields = ["id", "firm", "user_prompt", "created_at"]
+
+class IngestionJobSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = IngestionJob
+        fields = [
+            "id", "status", "source", "source_type", "url", "total_chunks", "embedded_chunks",
+            "chunk_count", "metadata_prefix", "stats", "error", "attempts",
+            "created_at", "started_at", "finished_at",
+        ]
+
+class IngestionSourceSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = IngestionSource
+        fields = ["id", "firm", "source_type", "name", "chunk_count", "created_at", "updated_at"]
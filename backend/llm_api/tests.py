@@ -1,3 +1,1947 @@
-from django.test import TestCase
+import asyncio
+import datetime
+import hashlib
+import json
+import os
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from types import SimpleNamespace
+from unittest import mock
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.exceptions import ImproperlyConfigured
+from django.core.files.base import ContentFile
+from django.db import connection
+from django.test import AsyncClient, SimpleTestCase, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.tokens import AccessToken
+
+from . import clients, conversation, extraction, ingestion, pagination, plans, semantic_cache
+from .async_views import AsyncPlanStreamView
+from .chunking import SENTENCE_END, Chunk, iter_chunks
+from .clients import CircuitBreaker, RetryBudget, UpstreamUnavailable
+from .embeddings import EmbeddingCache
+from .model import (aget_embeddings, firm_namespace, get_embeddings, pack_embedding_batches, retrieve_chunks,
+                    upsert_chunks, user_namespace)
+from .models import (
+    AIInteraction, ConversationSummary, Document, Firm, IngestedChunk, IngestionJob, IngestionSource, MainDocument,
+    SemanticCacheEntry,
+)
+from .prompt_builder import PromptBuilder
+from .prompt_templates import PromptRegistry, registry as prompt_templates
+from .retrieval import KeywordIndex, fuse, rank, references, rerank, select, terms
+from .tokens import count_tokens
+from .vector_store import LocalVectorStore, Match, VectorStore
+from .views import PROMPT_TOKEN_BUDGET, compose_chat_messages
 
 # Create your tests here.
+
+# cumulative import time of llm_api.urls after django.setup(); measured ~150ms
+URLS_IMPORT_BUDGET_MS = 500
+LAZY_MODULES = ("openai", "pinecone", "PyPDF2", "numpy", "tiktoken")
+
+IMPORT_SCRIPT = (
+    "import sys, django; django.setup(); import llm_api.urls; "
+    "print(','.join(m for m in %r if m in sys.modules))" % (LAZY_MODULES,)
+)
+
+
+
+# stand-ins for the OpenAI SDK's response objects
+def fake_completion(text):
+    return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=text))])
+
+
+def fake_stream(tokens):
+    return iter([SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=t))]) for t in tokens])
+
+
+def fake_vector(text, dimension=8):
+    """A deterministic unit vector per text."""
+    raw = [b - 127.5 for b in hashlib.sha256(text.encode("utf-8")).digest()[:dimension]]
+    norm = sum(x * x for x in raw) ** 0.5
+    return [x / norm for x in raw]
+
+
+def fake_embeddings(model, input):
+    return SimpleNamespace(data=[SimpleNamespace(index=i, embedding=fake_vector(text)) for i, text in enumerate(input)])
+
+
+def sse_events(content):
+    """(event, data) pairs of a server-sent event stream; comment lines are skipped."""
+    events = []
+    for block in content.strip().split("\n\n"):
+        if block.startswith(":"):
+            continue
+        fields = dict(line.split(": ", 1) for line in block.splitlines())
+        events.append((fields["event"], json.loads(fields["data"])))
+    return events
+
+
+class ImportTimeTests(SimpleTestCase):
+    """Importing the URLconf must stay cheap and must not need API credentials."""
+
+    def import_urls(self):
+        env = {k: v for k, v in os.environ.items() if k not in ("OPENAI_API_KEY", "PINECONE_API_KEY")}
+        env["DJANGO_SETTINGS_MODULE"] = "firmflow.settings"
+        return subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", IMPORT_SCRIPT],
+            cwd=settings.BASE_DIR, env=env, capture_output=True, text=True, timeout=60,
+        )
+
+    def test_urls_import_without_sdks_or_credentials(self):
+        result = self.import_urls()
+        self.assertEqual(result.returncode, 0, result.stderr[-2000:])
+        self.assertEqual(result.stdout.strip(), "", "imported eagerly: " + result.stdout.strip())
+
+    def test_urls_import_time_budget(self):
+        result = self.import_urls()
+        self.assertEqual(result.returncode, 0, result.stderr[-2000:])
+        # -X importtime lines: "import time: self [us] | cumulative | imported package"
+        cumulative = {}
+        for line in result.stderr.splitlines():
+            parts = line.split("|")
+            if line.startswith("import time:") and len(parts) == 3 and parts[1].strip().isdigit():
+                cumulative[parts[2].strip()] = int(parts[1])
+        self.assertIn("llm_api.urls", cumulative)
+        self.assertLess(cumulative["llm_api.urls"] / 1000, URLS_IMPORT_BUDGET_MS)
+
+
+# queries per request, measured with enough rows that an N+1 would show;
+# authentication is forced, so the JWT user lookup is not counted
+QUERY_BUDGETS = {
+    "firm_list": 1,
+    "document_list": 2,
+    "interaction_list": 2,
+    "single_document": 1,
+    "main_document": 1,
+    "plan_status": 1,
+    "firm": 1,
+    "ingestion_job": 1,
+    "ingestion_sources": 1,
+    # firm + main document, document page, interaction page
+    "workspace": 3,
+    # firm + main document, changed documents, document numbers, new interactions, changed plan text
+    "workspace_changes": 5,
+    # plan, conversation summary + latest turns, then saving: interaction, pending-turns count
+    "submit_prompt": 5,
+}
+
+
+class QueryBudgetTests(TestCase):
+    """Every endpoint has a fixed query budget, whatever the number of rows it lists."""
+
+    ROWS = 25
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user("budget", "budget@example.com", "pw")
+        cls.firm = Firm.objects.create(name="Budget Ltd")
+        MainDocument.objects.create(firm=cls.firm, text="plan")
+        for i in range(cls.ROWS):
+            Firm.objects.create(name=f"Firm {i}")
+            Document.objects.create(firm=cls.firm, title=f"Document {i}", text="text " * 100)
+            AIInteraction.objects.create(firm=cls.firm, user_prompt=f"prompt {i}", ai_response="answer " * 100)
+            IngestionSource.objects.create(user=cls.user, firm=cls.firm, namespace="firm", source_type="text",
+                                           name=f"source {i}", key=f"{i:064d}")
+        cls.job = IngestionJob.objects.create(user=cls.user, source_type=IngestionJob.SOURCE_TEXT, text="text")
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def assertWithinBudget(self, name, method, url, **kwargs):
+        with CaptureQueriesContext(connection) as queries:
+            response = getattr(self.client, method)(url, **kwargs)
+        self.assertLess(response.status_code, 300, getattr(response, "data", response))
+        self.assertLessEqual(
+            len(queries), QUERY_BUDGETS[name],
+            f"{name}: {len(queries)} queries\n" + "\n".join(q["sql"] for q in queries.captured_queries))
+        return response
+
+    def test_list_endpoints(self):
+        firm_id = self.firm.id
+        self.assertWithinBudget("firm_list", "get", "/api/LLM/firms/list/")
+        self.assertWithinBudget("document_list", "get", f"/api/LLM/documents/list/{firm_id}/?fields=title,text")
+        response = self.assertWithinBudget("interaction_list", "get", f"/api/LLM/interactions/{firm_id}/?limit=10")
+        self.assertWithinBudget("interaction_list", "get", response.data["next"])
+        self.assertWithinBudget("ingestion_sources", "get", "/api/LLM/rag/sources/")
+
+    def test_detail_endpoints(self):
+        firm_id = self.firm.id
+        self.assertWithinBudget("single_document", "get", f"/api/LLM/document/{firm_id}/1/")
+        self.assertWithinBudget("main_document", "get", f"/api/LLM/documents/main/{firm_id}/")
+        self.assertWithinBudget("plan_status", "get", f"/api/LLM/firms/{firm_id}/plan/status/")
+        self.assertWithinBudget("firm", "get", f"/api/LLM/firm/{firm_id}/")
+        self.assertWithinBudget("ingestion_job", "get", f"/api/LLM/rag/jobs/{self.job.id}/")
+
+    def test_workspace(self):
+        response = self.assertWithinBudget("workspace", "get", f"/api/LLM/workspace/{self.firm.id}/?limit=10")
+        self.assertEqual(len(response.data["documents"]), 10)
+        self.assertWithinBudget("workspace_changes", "get",
+                                f"/api/LLM/workspace/{self.firm.id}/?since={response.data['cursor']}")
+
+    def test_submit_prompt(self):
+        with mock.patch("llm_api.views.retrieve_chunks", return_value=([], [])), \
+                mock.patch("llm_api.views.chat_completion", return_value=fake_completion("answer")), \
+                mock.patch("llm_api.views.semantic_cache.ENABLED", False), \
+                mock.patch("llm_api.conversation.run_in_background") as background:
+            self.assertWithinBudget("submit_prompt", "post", f"/api/LLM/submit/{self.firm.id}/",
+                                    data={"prompt": "question"}, format="json")
+        background.assert_called_once()  # ROWS turns are waiting to be summarized
+
+
+class DocumentNumberingTests(TestCase):
+    def setUp(self):
+        self.firm = Firm.objects.create(name="Numbering Ltd")
+
+    def test_numbers_follow_the_firm_counter(self):
+        first = Document.objects.create(firm=self.firm, title="a", text="a")
+        second = Document.objects.create(firm=self.firm, title="b", text="b")
+        other = Document.objects.create(firm=Firm.objects.create(name="Other Ltd"), title="c", text="c")
+        self.assertEqual((first.document_number, second.document_number, other.document_number), (1, 2, 1))
+
+        # a deleted number is not handed out again, so links to it can't point at a newer document
+        second.delete()
+        self.assertEqual(Document.objects.create(firm=self.firm, title="d", text="d").document_number, 3)
+        self.firm.refresh_from_db()
+        self.assertEqual(self.firm.document_count, 3)
+
+    def test_allocation_is_one_row_update(self):
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(Document.next_number(self.firm.id), 1)
+        statements = [q["sql"] for q in queries.captured_queries if "SAVEPOINT" not in q["sql"]]
+        # UPDATE ... SET document_count + 1, then read it back
+        self.assertEqual([sql.split()[0] for sql in statements], ["UPDATE", "SELECT"])
+
+    def test_new_document_title_matches_its_number(self):
+        Document.objects.create(firm=self.firm, title="a", text="a")
+        user = User.objects.create_user("numbering", "numbering@example.com", "pw")
+        client = APIClient()
+        client.force_authenticate(user)
+        with mock.patch("llm_api.views.chat_completion", return_value=fake_completion("new document")):
+            response = client.post(f"/api/LLM/documents/upload/{self.firm.id}/",
+                                   {"selected_messages": ["a message"]}, format="json")
+        self.assertEqual(response.status_code, 200)
+        document = Document.objects.get(firm=self.firm, document_number=2)
+        self.assertEqual(document.title, "Document 2")
+
+    def test_firm_edit_cannot_change_the_counter(self):
+        Document.objects.create(firm=self.firm, title="a", text="a")
+        client = APIClient()
+        client.force_authenticate(User.objects.create_user("counter", "counter@example.com", "pw"))
+        response = client.put(f"/api/LLM/firm/edit/{self.firm.id}/", {"name": "Renamed Ltd", "document_count": 0},
+                              format="multipart")
+        self.assertEqual(response.status_code, 200, response.content)
+        self.assertEqual(response.data["document_count"], 1)
+        self.firm.refresh_from_db()
+        self.assertEqual((self.firm.name, self.firm.document_count), ("Renamed Ltd", 1))
+        self.assertEqual(Document.objects.create(firm=self.firm, title="b", text="b").document_number, 2)
+
+
+class DatabaseProfileTests(TestCase):
+    def test_sqlite_connections_are_tuned(self):
+        if connection.vendor != "sqlite":
+            self.skipTest("SQLite profile only")
+        with connection.cursor() as cursor:
+            cursor.execute("PRAGMA busy_timeout")
+            self.assertGreater(cursor.fetchone()[0], 0)
+            cursor.execute("PRAGMA synchronous")
+            self.assertEqual(cursor.fetchone()[0], 1)  # NORMAL
+        self.assertEqual(connection.transaction_mode, "IMMEDIATE")
+
+
+class WorkspaceTests(TestCase):
+    def setUp(self):
+        self.firm = Firm.objects.create(name="Workspace Ltd")
+        self.main_document = MainDocument.objects.create(firm=self.firm, text="plan")
+        self.documents = [Document.objects.create(firm=self.firm, title=f"Document {i}", text="text") for i in range(3)]
+        self.interactions = [AIInteraction.objects.create(firm=self.firm, user_prompt=f"prompt {i}", ai_response="answer")
+                             for i in range(3)]
+        self.client = APIClient()
+        self.client.force_authenticate(User.objects.create_user("workspace", "workspace@example.com", "pw"))
+
+    def workspace(self, **params):
+        response = self.client.get(f"/api/LLM/workspace/{self.firm.id}/", params)
+        self.assertEqual(response.status_code, 200, response.data)
+        return response.data
+
+    def age(self, **delta):
+        # move everything written so far out of the cursor's overlap window
+        past = timezone.now() - datetime.timedelta(**delta)
+        Document.objects.update(updated_at=past)
+        MainDocument.objects.update(updated_at=past)
+        AIInteraction.objects.update(created_at=past)
+
+    def test_first_load(self):
+        data = self.workspace(limit=2)
+        self.assertEqual(data["firm"]["name"], "Workspace Ltd")
+        self.assertEqual(data["main_document"]["text"], "plan")
+        self.assertEqual([d["document_number"] for d in data["documents"]], [1, 2])
+        self.assertNotIn("text", data["documents"][0])
+        # latest interactions, oldest of them first
+        self.assertEqual([i["user_prompt"] for i in data["interactions"]], ["prompt 1", "prompt 2"])
+        self.assertIn("ai_response", data["interactions"][0])
+
+        # the next links continue on the list endpoints
+        more = self.client.get(data["documents_next"]).data
+        self.assertEqual([d["document_number"] for d in more["documents"]], [3])
+        more = self.client.get(data["interactions_next"]).data
+        self.assertEqual([(i["user_prompt"], i["ai_response"]) for i in more["interactions"]], [("prompt 0", "answer")])
+
+    def test_changes_since_cursor(self):
+        self.age(minutes=1)
+        cursor = self.workspace()["cursor"]
+
+        data = self.workspace(since=cursor)
+        self.assertEqual((data["documents"], data["interactions"]), ([], []))
+        self.assertNotIn("text", data["main_document"])
+        self.assertEqual(data["document_numbers"], [1, 2, 3])
+
+        self.documents[0].title = "Renamed"
+        self.documents[0].save()
+        self.documents[1].delete()
+        AIInteraction.objects.create(firm=self.firm, user_prompt="new prompt", ai_response="answer")
+        self.main_document.text = "new plan"
+        self.main_document.save()
+
+        data = self.workspace(since=cursor)
+        self.assertEqual([(d["document_number"], d["title"]) for d in data["documents"]], [(1, "Renamed")])
+        self.assertEqual(data["document_numbers"], [1, 3])
+        self.assertEqual([i["user_prompt"] for i in data["interactions"]], ["new prompt"])
+        self.assertEqual(data["main_document"]["text"], "new plan")
+
+    def test_bad_cursor(self):
+        response = self.client.get(f"/api/LLM/workspace/{self.firm.id}/", {"since": "yesterday"})
+        self.assertEqual(response.status_code, 400)
+
+
+class StreamingTests(TestCase):
+    """?stream=1 sends meta (time to first token), token and done events, then saves the answer."""
+
+    def setUp(self):
+        self.firm = Firm.objects.create(name="Streaming Ltd")
+        MainDocument.objects.create(firm=self.firm, text="plan")
+        self.client = APIClient()
+        self.client.force_authenticate(User.objects.create_user("streaming", "streaming@example.com", "pw"))
+
+    def stream(self, completion, retrieve=None):
+        with mock.patch("llm_api.views.retrieve_chunks", side_effect=retrieve or (lambda *args: ([], []))), \
+                mock.patch("llm_api.views.chat_completion", side_effect=completion), \
+                mock.patch("llm_api.views.semantic_cache.ENABLED", False):
+            response = self.client.post(f"/api/LLM/submit/{self.firm.id}/?stream=1", {"prompt": "question"}, format="json")
+            self.assertEqual(response["Content-Type"], "text/event-stream")
+            return sse_events(b"".join(response.streaming_content).decode("utf-8"))
+
+    def test_tokens_then_done(self):
+        events = self.stream(lambda **kwargs: fake_stream(["Отго", "вор", None, "."]))
+        self.assertEqual([name for name, _ in events], ["meta", "token", "token", "token", "done"])
+        self.assertEqual("".join(data["text"] for name, data in events if name == "token"), "Отговор.")
+        self.assertEqual(events[-1][1]["response"], "Отговор.")
+        self.assertEqual(AIInteraction.objects.get(firm=self.firm).ai_response, "Отговор.")
+
+    def test_time_to_first_token_includes_retrieval(self):
+        def slow_retrieval(*args):
+            time.sleep(0.05)
+            return [], []
+
+        events = self.stream(lambda **kwargs: fake_stream(["answer"]), retrieve=slow_retrieval)
+        meta, done = events[0][1], events[-1][1]
+        self.assertGreaterEqual(meta["ttft_ms"], 50)
+        self.assertGreaterEqual(done["total_ms"], meta["ttft_ms"])
+
+    def test_upstream_error_ends_the_stream(self):
+        def broken_stream(**kwargs):
+            yield SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content="half"))])
+            raise ConnectionError("connection reset")
+
+        events = self.stream(broken_stream)
+        self.assertEqual([name for name, _ in events], ["meta", "token", "error"])
+        self.assertFalse(AIInteraction.objects.filter(firm=self.firm).exists())
+
+
+class FakeVectorStore:
+    """Answers every query with the matches given per namespace and records the calls."""
+
+    def __init__(self, matches):
+        self.matches = matches
+        self.queries = []
+
+    def query(self, vector, top_k, namespace=None):
+        self.queries.append(namespace)
+        return self.matches.get(namespace, [])
+
+
+class RetrievalTests(SimpleTestCase):
+    """retrieve_chunks embeds the prompt once, looks up each namespace once and drops repeated chunks."""
+
+    def retrieve(self, scopes, matches):
+        store = FakeVectorStore(matches)
+        keyword_index = mock.Mock(**{"search.return_value": []})
+        with mock.patch("llm_api.model.create_embeddings", side_effect=fake_embeddings) as create_embeddings, \
+                mock.patch("llm_api.model.embedding_cache", EmbeddingCache(path=None)), \
+                mock.patch("llm_api.model.keyword_index", keyword_index), \
+                mock.patch("llm_api.model.get_vector_store", return_value=store):
+            results = retrieve_chunks("Какво гласи чл. 5?", scopes)
+        return results, store, create_embeddings
+
+    def test_one_embedding_and_one_lookup_per_namespace(self):
+        results, store, create_embeddings = self.retrieve(
+            [("firm-1", "user-1"), "laws", "firm-1"],
+            {"firm-1": [Match("f", 0.9, {"text": "firm text"})], "laws": [Match("l", 0.8, {"text": "law text"})]})
+        create_embeddings.assert_called_once()
+        self.assertEqual(sorted(store.queries), ["firm-1", "laws", "user-1"])
+        self.assertEqual([[text for text, _ in scope] for scope in results], [["firm text"], ["law text"], []])
+
+    def test_chunk_found_twice_goes_into_the_prompt_once(self):
+        shared = {"text": "Чл. 5. Общ текст."}
+        results, _, _ = self.retrieve(
+            ["firm-1", "laws"],
+            {"firm-1": [Match("a", 0.9, shared)], "laws": [Match("b", 0.9, shared), Match("c", 0.5, {"text": "other"})]})
+        self.assertEqual([[text for text, _ in scope] for scope in results], [["Чл. 5. Общ текст."], ["other"]])
+
+
+class RecordingVectorStore:
+    def __init__(self):
+        self.upserts = []
+
+    def upsert(self, vectors, namespace=None):
+        self.upserts.append((namespace, [v["id"] for v in vectors]))
+
+
+class BatchedUpsertTests(SimpleTestCase):
+    """upsert_chunks packs embedding requests and upserts in fixed-size batches."""
+
+    def upsert(self, chunks, **kwargs):
+        store = RecordingVectorStore()
+        progress = []
+        with mock.patch("llm_api.model.create_embeddings", side_effect=fake_embeddings) as create_embeddings, \
+                mock.patch("llm_api.model.embedding_cache", EmbeddingCache(path=None)), \
+                mock.patch("llm_api.model.keyword_index") as keyword_index, \
+                mock.patch("llm_api.model.get_vector_store", return_value=store), \
+                mock.patch("llm_api.model.EMBED_BATCH_MAX_INPUTS", 2), \
+                mock.patch("llm_api.model.UPSERT_BATCH_SIZE", 3):
+            stats = upsert_chunks(chunks, progress_callback=lambda *counts: progress.append(counts), **kwargs)
+        return stats, store, create_embeddings, keyword_index, progress
+
+    def test_batches(self):
+        chunks = (Chunk(f"chunk {i}", {"article": str(i)}) for i in range(7))
+        stats, store, create_embeddings, keyword_index, progress = self.upsert(
+            chunks, metadata_prefix="doc", namespace="firm-1")
+
+        self.assertEqual([len(c.kwargs["input"]) for c in create_embeddings.call_args_list], [2, 2, 2, 1])
+        self.assertEqual(store.upserts, [
+            ("firm-1", ["doc-0", "doc-1", "doc-2"]), ("firm-1", ["doc-3", "doc-4", "doc-5"]), ("firm-1", ["doc-6"])])
+        # the keyword index gets the same batches, with the chunk text and metadata
+        self.assertEqual(keyword_index.add.call_count, 3)
+        first = keyword_index.add.call_args_list[0].args[0][0]
+        self.assertEqual(first["metadata"], {"article": "0", "text": "chunk 0", "source": "doc"})
+
+        self.assertEqual(progress[-1], (7, 7))
+        self.assertEqual(stats["chunks"], 7)
+        self.assertEqual((stats["embed"]["items"], stats["embed"]["calls"]), (7, 4))
+        self.assertEqual((stats["upsert"]["items"], stats["upsert"]["calls"]), (7, 3))
+
+    def test_repeated_text_is_embedded_once(self):
+        _, store, create_embeddings, _, _ = self.upsert(["same text", "same text", "other", "same text"])
+        self.assertEqual([c.kwargs["input"] for c in create_embeddings.call_args_list], [["same text"], ["other"]])
+        self.assertEqual(sum(len(ids) for _, ids in store.upserts), 4)
+
+    def test_token_limit_splits_batches(self):
+        chunks = [(i, Chunk("x" * size, {})) for i, size in enumerate([40, 40, 30, 90])]
+        with mock.patch("llm_api.model.count_tokens", side_effect=lambda text, model=None: len(text)), \
+                mock.patch("llm_api.model.EMBED_BATCH_MAX_TOKENS", 100):
+            batches = [[i for i, _ in batch] for batch in pack_embedding_batches(chunks)]
+        self.assertEqual(batches, [[0, 1], [2], [3]])
+
+
+class IngestionQueueTests(TestCase):
+    """Workers claim queued jobs oldest first, one per source, and reclaim or fail jobs whose worker died."""
+
+    def setUp(self):
+        media = tempfile.TemporaryDirectory()
+        self.addCleanup(media.cleanup)
+        settings_override = override_settings(MEDIA_ROOT=media.name)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+        self.user = User.objects.create_user("queue", "queue@example.com", "pw")
+        self.source = IngestionSource.objects.create(user=self.user, namespace="user-1", source_type="pdf",
+                                                     name="upload.pdf", key="1" * 64)
+
+    def job(self, **fields):
+        fields.setdefault("source", self.source)
+        if fields.get("source_type") == IngestionJob.SOURCE_PDF:
+            fields.setdefault("file", ContentFile(b"%PDF-1.4", name="upload.pdf"))
+        return IngestionJob.objects.create(user=self.user, **{"source_type": IngestionJob.SOURCE_TEXT, "text": "text", **fields})
+
+    def stale(self, job, attempts):
+        heartbeat = timezone.now() - ingestion.STALE_AFTER - datetime.timedelta(minutes=1)
+        IngestionJob.objects.filter(id=job.id).update(
+            status=IngestionJob.STATUS_RUNNING, attempts=attempts, heartbeat_at=heartbeat, worker="dead-worker")
+
+    def test_oldest_job_first(self):
+        first, second = self.job(), self.job(source=None)
+        claimed = ingestion.claim_next_job("worker-1")
+        self.assertEqual((claimed.id, claimed.status, claimed.attempts, claimed.worker),
+                         (first.id, IngestionJob.STATUS_RUNNING, 1, "worker-1"))
+        self.assertEqual(ingestion.claim_next_job("worker-2").id, second.id)
+        self.assertIsNone(ingestion.claim_next_job("worker-3"))
+
+    def test_one_running_job_per_source(self):
+        self.job()
+        later = self.job()
+        ingestion.claim_next_job("worker-1")
+        self.assertIsNone(ingestion.claim_next_job("worker-2"))
+        IngestionJob.objects.filter(status=IngestionJob.STATUS_RUNNING).update(status=IngestionJob.STATUS_SUCCEEDED)
+        self.assertEqual(ingestion.claim_next_job("worker-2").id, later.id)
+
+    def test_stale_job_is_reclaimed(self):
+        job = self.job()
+        self.stale(job, attempts=1)
+        claimed = ingestion.claim_next_job("worker-2")
+        self.assertEqual((claimed.id, claimed.attempts, claimed.worker), (job.id, 2, "worker-2"))
+
+    def test_stale_job_on_its_last_attempt_fails(self):
+        job = self.job(source_type=IngestionJob.SOURCE_PDF)
+        path = job.file.path
+        self.stale(job, attempts=ingestion.MAX_ATTEMPTS)
+        later = self.job()
+
+        self.assertEqual(ingestion.claim_next_job("worker-2").id, later.id)
+        job.refresh_from_db()
+        self.assertEqual(job.status, IngestionJob.STATUS_FAILED)
+        self.assertIn("dead-worker", job.error)
+        self.assertFalse(os.path.exists(path))
+
+    def test_failed_job_deletes_its_upload(self):
+        job = self.job(source_type=IngestionJob.SOURCE_PDF)
+        path = job.file.path
+        with mock.patch("llm_api.ingestion.run_job", side_effect=ValueError("No valid text found to process.")):
+            self.assertTrue(ingestion.process_next_job("worker-1"))
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.error), (IngestionJob.STATUS_FAILED, "No valid text found to process."))
+        self.assertFalse(os.path.exists(path))
+        self.assertFalse(ingestion.process_next_job("worker-1"))
+
+
+class EmbeddingCacheTests(SimpleTestCase):
+    """Embeddings are cached by model and text, in memory and in a SQLite file shared across restarts."""
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, "embeddings.sqlite3")
+
+    def test_memory_then_disk(self):
+        cache = EmbeddingCache(self.path, max_items=2)
+        cache.put_many("model", [("a", [1.0, 0.0]), ("b", [0.0, 1.0]), ("c", [0.5, 0.5])])
+        self.assertEqual(len(cache.memory), 2)  # "a" was evicted from memory, not from disk
+
+        self.assertEqual(cache.get_many("model", ["a", "c", "d"]), {"a": [1.0, 0.0], "c": [0.5, 0.5]})
+        self.assertEqual(cache.get_many("other-model", ["a"]), {})
+        stats = cache.stats()
+        self.assertEqual((stats["memory_hits"], stats["disk_hits"], stats["misses"]), (1, 1, 2))
+
+        # a new process finds them on disk
+        self.assertEqual(EmbeddingCache(self.path).get_many("model", ["b"]), {"b": [0.0, 1.0]})
+
+    def test_only_uncached_texts_are_sent(self):
+        cache = EmbeddingCache(self.path)
+        with mock.patch("llm_api.model.embedding_cache", cache), \
+                mock.patch("llm_api.model.EMBEDDING_MODEL", "text-embedding-3-small"), \
+                mock.patch("llm_api.model.create_embeddings", side_effect=fake_embeddings) as create_embeddings:
+            first = get_embeddings(["a", "b", "a"])
+            second = get_embeddings(["b", "c"])
+        self.assertEqual([c.kwargs["input"] for c in create_embeddings.call_args_list], [["a", "b"], ["c"]])
+        self.assertEqual(first[0], first[2])
+        self.assertEqual(second[0], first[1])
+
+    def test_async_lookups_stay_off_the_event_loop(self):
+        cache = EmbeddingCache(self.path)
+        threads = []
+
+        def recording(method):
+            def wrapper(*args):
+                threads.append(threading.current_thread())
+                return method(*args)
+            return wrapper
+
+        async def embed():
+            with mock.patch.object(cache, "get_many", recording(cache.get_many)), \
+                    mock.patch.object(cache, "put_many", recording(cache.put_many)):
+                return await aget_embeddings(["a"]), threading.current_thread()
+
+        async def acreate_embeddings(model, input):
+            return fake_embeddings(model, input)
+
+        with mock.patch("llm_api.model.embedding_cache", cache), \
+                mock.patch("llm_api.model.EMBEDDING_MODEL", "text-embedding-3-small"), \
+                mock.patch("llm_api.model.acreate_embeddings", side_effect=acreate_embeddings):
+            (vectors, loop_thread) = asyncio.run(embed())
+        self.assertEqual(vectors, [fake_vector("a")])
+        self.assertEqual(len(threads), 2)
+        self.assertNotIn(loop_thread, threads)
+
+
+class SemanticCacheTests(TestCase):
+    """Cached answers are reused only for the same plan, prompt template, conversation summary and namespaces."""
+
+    def setUp(self):
+        self.firm = Firm.objects.create(name="Cache Ltd")
+        self.main_document = MainDocument.objects.create(firm=self.firm, text="plan")
+        self.user = User.objects.create_user("cache", "cache@example.com", "pw")
+        self.context = semantic_cache.context_key("", [("firm-1", "user-1"), "laws"])
+
+    def store(self, prompt, context=None, version=1):
+        interaction = AIInteraction.objects.create(firm=self.firm, user_prompt=prompt, ai_response=f"answer to {prompt}")
+        semantic_cache.store(self.firm, version, "v1", context or self.context, fake_vector(prompt), interaction)
+        return interaction
+
+    def lookup(self, prompt, context=None, version=1):
+        return semantic_cache.lookup(self.firm, version, "v1", context or self.context, fake_vector(prompt))
+
+    def test_hit_and_miss(self):
+        interaction = self.store("Какви документи са нужни за ООД?")
+        entry, similarity = self.lookup("Какви документи са нужни за ООД?")
+        self.assertEqual(entry.interaction, interaction)
+        self.assertAlmostEqual(similarity, 1.0, places=5)
+        self.assertEqual(SemanticCacheEntry.objects.get().hits, 1)
+
+        self.assertIsNone(self.lookup("Колко струва регистрацията?"))
+        self.assertIsNone(self.lookup("Какви документи са нужни за ООД?", version=2))
+        # same prompt, but after the summary moved on or against other uploads
+        self.assertIsNone(self.lookup("Какви документи са нужни за ООД?",
+                                      context=semantic_cache.context_key("Обсъдихме ЕООД.", [("firm-1", "user-1"), "laws"])))
+        self.assertIsNone(self.lookup("Какви документи са нужни за ООД?",
+                                      context=semantic_cache.context_key("", [("firm-1", "user-2"), "laws"])))
+
+    def test_expired_entries_miss_and_are_evicted(self):
+        self.store("old question")
+        SemanticCacheEntry.objects.update(created_at=timezone.now() - semantic_cache.TTL - datetime.timedelta(minutes=1))
+        self.assertIsNone(self.lookup("old question"))
+        self.store("new question")
+        self.assertEqual(list(SemanticCacheEntry.objects.values_list("interaction__user_prompt", flat=True)),
+                         ["new question"])
+
+    def test_size_and_version_eviction(self):
+        with mock.patch("llm_api.semantic_cache.MAX_ENTRIES", 2):
+            for prompt in ("first", "second", "third"):
+                self.store(prompt)
+        self.assertEqual(sorted(SemanticCacheEntry.objects.values_list("interaction__user_prompt", flat=True)),
+                         ["second", "third"])
+        # a new plan version makes every older entry unreachable
+        self.store("fourth", version=2)
+        self.assertEqual(list(SemanticCacheEntry.objects.values_list("interaction__user_prompt", flat=True)), ["fourth"])
+
+    def submit(self, user, prompt):
+        client = APIClient()
+        client.force_authenticate(user)
+        return client.post(f"/api/LLM/submit/{self.firm.id}/", {"prompt": prompt}, format="json").data
+
+    def test_submit_hits_after_real_turns(self):
+        with mock.patch("llm_api.views.semantic_cache.ENABLED", True), \
+                mock.patch("llm_api.views.get_embedding", side_effect=fake_vector), \
+                mock.patch("llm_api.views.retrieve_chunks", return_value=([], [])), \
+                mock.patch("llm_api.views.chat_completion", return_value=fake_completion("fresh answer")) as chat, \
+                mock.patch("llm_api.conversation.run_in_background"):
+            self.assertNotIn("cached", self.submit(self.user, "question"))
+            self.submit(self.user, "another question")
+            # two real turns later the conversation differs, the summary does not
+            self.assertTrue(self.submit(self.user, "question")["cached"])
+            self.assertTrue(self.submit(self.user, "question")["cached"])
+            self.assertEqual(chat.call_count, 2)
+
+            # another user's uploads are searched for their prompts
+            other = User.objects.create_user("cache-2", "cache-2@example.com", "pw")
+            self.assertNotIn("cached", self.submit(other, "question"))
+            # a refreshed summary starts a new key
+            ConversationSummary.objects.update_or_create(firm=self.firm, defaults={"text": "Обсъдихме ЕООД."})
+            self.assertNotIn("cached", self.submit(self.user, "question"))
+            self.assertEqual(chat.call_count, 4)
+
+
+def count_words(text, model=None):
+    return len(text.split())
+
+
+def truncate_words(text, max_tokens, model=None):
+    return " ".join(text.split()[:max_tokens])
+
+
+class PromptBudgetTests(SimpleTestCase):
+    """Required sections stay whole; the rest of the budget is shared by weight, unused shares passed on."""
+
+    def build(self, budget, sections, reserved=0):
+        with mock.patch("llm_api.prompt_builder.count_tokens", count_words), \
+                mock.patch("llm_api.prompt_builder.truncate_to_tokens", truncate_words):
+            builder = PromptBuilder(budget, reserved=reserved)
+            for name, words, weight in sections:
+                builder.add(name, " ".join([name] * words), weight=weight)
+            return {name: count_words(text) for name, text in builder.build().items()}, builder.breakdown()
+
+    def test_everything_fits(self):
+        built, breakdown = self.build(100, [("instructions", 10, None), ("plan", 20, 4), ("history", 20, 2)])
+        self.assertEqual(built, {"instructions": 10, "plan": 20, "history": 20})
+        self.assertEqual(breakdown["plan"], {"tokens": 20, "used": 20})
+
+    def test_shares_follow_weights(self):
+        built, _ = self.build(100, [("instructions", 30, None), ("plan", 100, 3), ("history", 100, 1)], reserved=10)
+        self.assertEqual(built, {"instructions": 30, "plan": 45, "history": 15})
+
+    def test_unused_share_goes_to_larger_sections(self):
+        built, breakdown = self.build(100, [("plan", 100, 1), ("law", 5, 1), ("history", 100, 2)])
+        self.assertEqual(built, {"plan": 31, "law": 5, "history": 63})
+        self.assertEqual(breakdown["history"], {"tokens": 100, "used": 63})
+
+    def test_required_sections_over_budget(self):
+        built, _ = self.build(20, [("instructions", 30, None), ("plan", 10, 1)])
+        self.assertEqual(built, {"instructions": 30, "plan": 0})
+
+    def test_chat_prompt_stays_within_budget(self):
+        long_text = "Чл. 1. Дружеството се учредява с договор. " * 3000
+        messages, _ = compose_chat_messages(
+            SimpleNamespace(id=1), SimpleNamespace(text=long_text), "Въпрос?", long_text, long_text,
+            [(long_text, 0.9)], [(long_text, 0.8)], False)
+        used = count_tokens(messages[0]["content"]) + count_tokens(messages[1]["content"])
+        # each truncated section may overshoot by its marker
+        self.assertLessEqual(used, PROMPT_TOKEN_BUDGET + 5 * count_tokens("\n[...]"))
+        self.assertIn(long_text[:200], messages[0]["content"])
+
+
+class ConversationSummaryTests(TestCase):
+    """Prompts get the rolling summary plus the turns it does not cover; older turns are folded in the background."""
+
+    def setUp(self):
+        self.firm = Firm.objects.create(name="Summary Ltd")
+
+    def turns(self, count):
+        start = AIInteraction.objects.filter(firm=self.firm).count()
+        return [AIInteraction.objects.create(firm=self.firm, user_prompt=f"prompt {i}", ai_response=f"answer {i}")
+                for i in range(start, start + count)]
+
+    def test_without_summary_the_latest_turns_are_sent(self):
+        self.turns(conversation.MAX_RAW_TURNS + 2)
+        context = conversation.conversation_context(self.firm)
+        self.assertNotIn("Summary", context)
+        self.assertEqual(context.count("User: "), conversation.MAX_RAW_TURNS)
+        self.assertTrue(context.startswith(f"User: prompt {conversation.MAX_RAW_TURNS + 1}\n"))
+
+    def test_summary_replaces_the_turns_it_covers(self):
+        turns = self.turns(6)
+        ConversationSummary.objects.create(firm=self.firm, text="Обобщение", last_interaction_id=turns[3].id,
+                                           interaction_count=4)
+        context = conversation.conversation_context(self.firm)
+        self.assertTrue(context.startswith("Summary of the earlier conversation:\nОбобщение"))
+        self.assertIn("prompt 5", context)
+        self.assertIn("prompt 4", context)
+        self.assertNotIn("prompt 3", context)
+
+        # the newest RECENT_TURNS are always sent raw, even when they are covered
+        ConversationSummary.objects.filter(firm=self.firm).update(last_interaction_id=turns[-1].id)
+        context = conversation.conversation_context(self.firm)
+        self.assertEqual(context.count("User: "), conversation.RECENT_TURNS)
+
+    def test_refresh_is_scheduled_once_enough_turns_wait(self):
+        self.turns(conversation.RECENT_TURNS + conversation.SUMMARY_EVERY - 1)
+        with mock.patch("llm_api.conversation.run_in_background") as background:
+            self.assertIsNone(conversation.schedule_summary_refresh(self.firm))
+            self.turns(1)
+            conversation.schedule_summary_refresh(self.firm)
+            # a refresh already running for the firm is not queued again
+            conversation.schedule_summary_refresh(self.firm)
+        background.assert_called_once_with(conversation.refresh_summary, self.firm.id)
+        conversation.refreshing.discard(self.firm.id)
+
+    def test_refresh_folds_all_but_the_newest_turns(self):
+        turns = self.turns(6)
+        conversation.refreshing.add(self.firm.id)
+        with mock.patch("llm_api.conversation.chat_completion", return_value=fake_completion(" Ново обобщение ")) as chat:
+            conversation.refresh_summary(self.firm.id)
+
+        sent = chat.call_args.kwargs["messages"][1]["content"]
+        self.assertIn("(empty)", sent)
+        self.assertIn("prompt 3", sent)
+        self.assertNotIn("prompt 4", sent)
+        summary = ConversationSummary.objects.get(firm=self.firm)
+        self.assertEqual((summary.text, summary.last_interaction_id, summary.interaction_count),
+                         ("Ново обобщение", turns[3].id, 4))
+        self.assertNotIn(self.firm.id, conversation.refreshing)
+
+        # nothing new to fold: no model call
+        with mock.patch("llm_api.conversation.chat_completion") as chat:
+            conversation.refresh_summary(self.firm.id)
+        chat.assert_not_called()
+
+
+class PromptRegistryTests(SimpleTestCase):
+    """Templates are validated once at startup and versioned by content."""
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        self.write("system.txt", "Отговаряй кратко.")
+
+    def write(self, name, text, mtime=None):
+        path = os.path.join(self.directory, name)
+        with open(path, "w", encoding="utf-8") as file:
+            file.write(text)
+        if mtime is not None:
+            os.utime(path, (mtime, mtime))
+        return path
+
+    def test_app_templates_load(self):
+        prompt_templates.load()
+        for name in prompt_templates.required:
+            self.assertTrue(prompt_templates.get(name).strip())
+
+    def test_missing_or_empty_required_template(self):
+        with self.assertRaisesMessage(ImproperlyConfigured, "summary.txt"):
+            PromptRegistry(self.directory, required=["system.txt", "summary.txt"]).load()
+        self.write("summary.txt", "  \n")
+        with self.assertRaisesMessage(ImproperlyConfigured, "summary.txt"):
+            PromptRegistry(self.directory, required=["system.txt", "summary.txt"]).load()
+
+    def test_lookup_and_version(self):
+        registry = PromptRegistry(self.directory, required=["system.txt"])
+        self.assertEqual(registry.get("system"), registry.get("system.txt"))
+        version = registry.version("system.txt")
+        self.assertEqual(len(version), 12)
+        with self.assertRaises(KeyError):
+            registry.get("unknown")
+
+        # without hot reload an edited file is not read again
+        self.write("system.txt", "Отговаряй подробно.", mtime=time.time() + 10)
+        self.assertEqual(registry.version("system.txt"), version)
+
+    def test_hot_reload(self):
+        registry = PromptRegistry(self.directory, required=["system.txt"], hot_reload=True)
+        version = registry.version("system.txt")
+        path = self.write("system.txt", "Отговаряй подробно.", mtime=time.time() + 10)
+        self.assertEqual(registry.get("system.txt"), "Отговаряй подробно.")
+        self.assertNotEqual(registry.version("system.txt"), version)
+
+        # a template removed while running keeps its last copy
+        os.remove(path)
+        self.assertEqual(registry.get("system.txt"), "Отговаряй подробно.")
+
+
+class PlanGenerationTests(TestCase):
+    """A firm's plan is generated in the background; a generation that died does not block the firm for good."""
+
+    def setUp(self):
+        self.firm = Firm.objects.create(name="Plan Ltd")
+        self.main_document = MainDocument.objects.create(firm=self.firm, status=MainDocument.STATUS_GENERATING)
+        self.client = APIClient()
+        user = User.objects.create_user("plan", "plan@example.com", "pw")
+        self.client.force_authenticate(user)
+        self.headers = {"Authorization": f"Bearer {AccessToken.for_user(user)}"}
+
+    def generate(self, completion):
+        with mock.patch("llm_api.plans.chat_completion", side_effect=completion):
+            plans.generate_plan(self.main_document.id, "Name : Plan Ltd")
+        self.main_document.refresh_from_db()
+        return self.main_document
+
+    def go_stale(self):
+        MainDocument.objects.filter(id=self.main_document.id).update(
+            text="Частичен", updated_at=timezone.now() - plans.STALE_AFTER - datetime.timedelta(minutes=1))
+
+    def plan_stream(self):
+        response = self.client.get(f"/api/LLM/firms/{self.firm.id}/plan/stream/")
+        return sse_events(b"".join(response.streaming_content).decode("utf-8"))
+
+    async def async_plan_stream(self):
+        response = await AsyncClient().get(f"/api/LLM/async/firms/{self.firm.id}/plan/stream/", headers=self.headers)
+        self.assertEqual(response["Content-Type"], "text/event-stream")
+        return [chunk.decode("utf-8") async for chunk in response.streaming_content]
+
+    def test_finished_plan_is_a_new_version(self):
+        plan = self.generate(lambda **kwargs: fake_stream(["План", " за фирмата "]))
+        self.assertEqual((plan.status, plan.text, plan.version), (MainDocument.STATUS_READY, "План за фирмата", 2))
+
+    def test_failed_generation(self):
+        def broken_stream(**kwargs):
+            yield SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content="План"))])
+            raise ConnectionError("connection reset")
+
+        plan = self.generate(broken_stream)
+        self.assertEqual((plan.status, plan.text, plan.error, plan.version),
+                         (MainDocument.STATUS_FAILED, "План", "connection reset", 2))
+
+    def test_chat_and_edits_wait_for_the_plan(self):
+        response = self.client.post(f"/api/LLM/submit/{self.firm.id}/", {"prompt": "question"}, format="json")
+        self.assertEqual(response.status_code, 409)
+        response = self.client.post(f"/api/LLM/firms/{self.firm.id}/update-main-document/",
+                                    {"selected_messages": ["a message"]}, format="json")
+        self.assertEqual(response.status_code, 409)
+
+    def test_stale_generation_fails_on_read(self):
+        self.go_stale()
+        data = self.client.get(f"/api/LLM/firms/{self.firm.id}/plan/status/").data
+        self.assertEqual((data["status"], data["error"]), (MainDocument.STATUS_FAILED, plans.STALE_ERROR))
+        self.main_document.refresh_from_db()
+        self.assertEqual(self.main_document.version, 2)
+
+        # the plan can be edited again, and a generation that finishes after all does not overwrite it
+        with mock.patch("llm_api.views.chat_completion", return_value=fake_completion("Нов план")):
+            response = self.client.post(f"/api/LLM/firms/{self.firm.id}/update-main-document/",
+                                        {"selected_messages": ["a message"]}, format="json")
+        self.assertEqual(response.status_code, 200)
+        plan = self.generate(lambda **kwargs: fake_stream(["Стар план"]))
+        self.assertEqual((plan.status, plan.text), (MainDocument.STATUS_READY, "Нов план"))
+
+    def test_stream(self):
+        MainDocument.objects.filter(id=self.main_document.id).update(text="Готов план", status=MainDocument.STATUS_READY)
+        self.assertEqual(self.plan_stream(), [
+            ("token", {"text": "Готов план"}), ("done", {"status": "ready", "plan": "Готов план"})])
+
+    def test_stream_of_a_stale_generation_ends(self):
+        self.go_stale()
+        events = self.plan_stream()
+        self.assertEqual([name for name, _ in events], ["token", "error"])
+        self.assertEqual(events[-1][1]["error"], plans.STALE_ERROR)
+
+    def test_sync_stream_does_not_wait(self):
+        # under WSGI the stream would hold a worker, so by default it answers with the plan so far at once
+        MainDocument.objects.filter(id=self.main_document.id).update(text="Нача")
+        with mock.patch("llm_api.views.time.sleep", side_effect=AssertionError("the sync stream waited")):
+            events = self.plan_stream()
+        self.assertEqual(events, [("token", {"text": "Нача"}), ("timeout", {
+            "status": "generating", "status_url": f"/api/LLM/firms/{self.firm.id}/plan/status/"})])
+
+    async def test_async_stream(self):
+        writes = iter(["Нача", "Начало и край"])
+
+        async def generate(seconds):
+            text = next(writes)
+            status = MainDocument.STATUS_READY if text == "Начало и край" else MainDocument.STATUS_GENERATING
+            await MainDocument.objects.filter(id=self.main_document.id).aupdate(text=text, status=status)
+
+        with mock.patch("llm_api.async_views.asyncio.sleep", side_effect=generate) as sleep, \
+                mock.patch("llm_api.views.time.sleep", side_effect=AssertionError("the async stream blocked")):
+            chunks = await self.async_plan_stream()
+        self.assertEqual(sleep.await_count, 2)
+        self.assertEqual(sse_events("".join(chunks)), [
+            ("token", {"text": "Нача"}), ("token", {"text": "ло и край"}),
+            ("done", {"status": "ready", "plan": "Начало и край"})])
+
+    async def test_async_stream_heartbeat_and_timeout(self):
+        with mock.patch.object(AsyncPlanStreamView, "heartbeat_seconds", 0), \
+                mock.patch.object(AsyncPlanStreamView, "max_seconds", 0.05), \
+                mock.patch.object(AsyncPlanStreamView, "poll_interval", 0.01):
+            chunks = await self.async_plan_stream()
+        self.assertIn(": heartbeat\n\n", chunks)
+        self.assertEqual(sse_events("".join(chunks)), [("timeout", {
+            "status": "generating", "status_url": f"/api/LLM/firms/{self.firm.id}/plan/status/"})])
+
+    async def test_async_stream_of_a_stale_generation_ends(self):
+        await sync_to_async(self.go_stale)()
+        events = sse_events("".join(await self.async_plan_stream()))
+        self.assertEqual([name for name, _ in events], ["token", "error"])
+        self.assertEqual(events[-1][1]["error"], plans.STALE_ERROR)
+
+    async def test_async_stream_requires_authentication(self):
+        response = await AsyncClient().get(f"/api/LLM/async/firms/{self.firm.id}/plan/stream/")
+        self.assertEqual(response.status_code, 401)
+
+
+class ThreadRecordingStore(VectorStore):
+    """Remembers which thread ran each query; aquery is the base class's."""
+
+    def __init__(self, matches=None):
+        self.matches = matches or {}
+        self.threads = []
+
+    def upsert(self, vectors, namespace=None):
+        pass
+
+    def query(self, vector, top_k, namespace=None):
+        self.threads.append(threading.current_thread())
+        return self.matches.get(namespace, [])
+
+    def delete(self, ids, namespace=None):
+        pass
+
+    def fetch_metadata(self, ids, namespace=None):
+        return {}
+
+
+class AsyncViewTests(TestCase):
+    """The async submit view answers like the sync one and keeps blocking lookups off the event loop."""
+
+    def setUp(self):
+        self.firm = Firm.objects.create(name="Async Ltd")
+        self.main_document = MainDocument.objects.create(firm=self.firm, text="plan")
+        user = User.objects.create_user("async", "async@example.com", "pw")
+        self.headers = {"Authorization": f"Bearer {AccessToken.for_user(user)}"}
+        self.url = f"/api/LLM/async/submit/{self.firm.id}/"
+
+        self.store = ThreadRecordingStore({f"firm-{self.firm.id}": [Match("a", 0.9, {"text": "Чл. 113. Дружество"})]})
+        self.keyword_threads = []
+
+        def keyword_search(query, limit, namespaces=None):
+            self.keyword_threads.append(threading.current_thread())
+            return []
+
+        async def acreate_embeddings(model, input):
+            return fake_embeddings(model, input)
+
+        async def achat_completion(**kwargs):
+            if kwargs.get("stream"):
+                async def tokens():
+                    for chunk in fake_stream(["Отго", "вор"]):
+                        yield chunk
+                return tokens()
+            return fake_completion("Отговор")
+
+        for target, value in (
+            ("llm_api.model.get_vector_store", mock.Mock(return_value=self.store)),
+            ("llm_api.model.keyword_index", mock.Mock(**{"search.side_effect": keyword_search})),
+            ("llm_api.model.embedding_cache", EmbeddingCache(path=None)),
+            ("llm_api.model.EMBEDDING_MODEL", "text-embedding-3-small"),
+            ("llm_api.model.acreate_embeddings", acreate_embeddings),
+            ("llm_api.async_views.achat_completion", achat_completion),
+            ("llm_api.async_views.semantic_cache.ENABLED", False),
+            ("llm_api.conversation.run_in_background", mock.Mock()),
+        ):
+            patcher = mock.patch(target, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def post(self, url, data, headers=None):
+        return AsyncClient().post(url, data, content_type="application/json",
+                                  headers=self.headers if headers is None else headers)
+
+    async def test_submit(self):
+        response = await self.post(self.url, {"prompt": "Какво гласи чл. 113?"})
+        self.assertEqual(response.status_code, 200, response.content)
+        data = json.loads(response.content)
+        self.assertEqual(data["response"], "Отговор")
+        self.assertIn("Чл. 113. Дружество", data["rag_context"])
+        self.assertEqual(await AIInteraction.objects.filter(firm=self.firm).acount(), 1)
+
+        loop_thread = threading.current_thread()
+        self.assertTrue(self.store.threads and self.keyword_threads)
+        self.assertNotIn(loop_thread, self.store.threads + self.keyword_threads)
+
+    async def test_stream(self):
+        response = await self.post(f"{self.url}?stream=1", {"prompt": "Въпрос"})
+        content = b"".join([chunk async for chunk in response.streaming_content]).decode("utf-8")
+        events = sse_events(content)
+        self.assertEqual([name for name, _ in events], ["meta", "token", "token", "done"])
+        self.assertEqual(events[-1][1]["response"], "Отговор")
+
+    async def test_plan_still_generating(self):
+        await MainDocument.objects.filter(id=self.main_document.id).aupdate(status=MainDocument.STATUS_GENERATING)
+        response = await self.post(self.url, {"prompt": "Въпрос"})
+        self.assertEqual(response.status_code, 409)
+
+    async def test_unknown_document(self):
+        response = await self.post(self.url, {"prompt": "Въпрос", "document_id": 99})
+        self.assertEqual(response.status_code, 404)
+
+    async def test_requires_a_token(self):
+        response = await self.post(self.url, {"prompt": "Въпрос"}, headers={})
+        self.assertEqual(response.status_code, 401)
+
+
+class HTTPStatusError(Exception):
+    def __init__(self, status_code):
+        super().__init__(f"HTTP {status_code}")
+        self.status_code = status_code
+
+
+class UpstreamResilienceTests(SimpleTestCase):
+    """Upstream calls retry within a shared budget behind a per-service circuit breaker."""
+
+    def setUp(self):
+        self.breaker = CircuitBreaker("openai", threshold=3, reset_after=30)
+        self.budget = RetryBudget(ratio=0.2, floor=10)
+        for patcher in (mock.patch.dict(clients.breakers, {"openai": self.breaker}),
+                        mock.patch("llm_api.clients.retry_budget", self.budget),
+                        mock.patch("llm_api.clients.time.sleep")):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_retryable_errors_are_retried(self):
+        upstream = mock.Mock(side_effect=[HTTPStatusError(503), HTTPStatusError(429), "answer"])
+        self.assertEqual(clients.call("openai", upstream), "answer")
+        self.assertEqual(upstream.call_count, 3)
+        self.assertEqual(self.breaker.state(), "closed")
+
+    def test_client_errors_are_not_retried(self):
+        upstream = mock.Mock(side_effect=HTTPStatusError(400))
+        with self.assertRaises(HTTPStatusError):
+            clients.call("openai", upstream)
+        self.assertEqual(upstream.call_count, 1)
+        self.assertEqual(self.breaker.failures, 0)
+
+    def test_retry_budget_limits_retries(self):
+        self.budget.balance = 1.0
+        upstream = mock.Mock(side_effect=HTTPStatusError(503))
+        with self.assertRaises(HTTPStatusError):
+            clients.call("openai", upstream)
+        self.assertEqual(upstream.call_count, 2)  # one retry, then the budget is spent
+
+    def test_breaker_opens_and_recovers(self):
+        upstream = mock.Mock(side_effect=HTTPStatusError(503))
+        # the retry after the third failure finds the breaker open
+        with self.assertRaises(UpstreamUnavailable):
+            clients.call("openai", upstream)
+        self.assertEqual((upstream.call_count, self.breaker.state()), (3, "open"))
+
+        # open: calls fail fast without reaching the upstream
+        with self.assertRaises(UpstreamUnavailable) as raised:
+            clients.call("openai", upstream)
+        self.assertEqual(upstream.call_count, 3)
+        self.assertGreater(raised.exception.retry_after, 0)
+
+        # after reset_after one trial call goes through and closes the breaker
+        later = time.monotonic() + 31
+        with mock.patch("llm_api.clients.time.monotonic", return_value=later):
+            self.assertEqual(self.breaker.state(), "half-open")
+            self.assertEqual(clients.call("openai", mock.Mock(return_value="answer")), "answer")
+        self.assertEqual(self.breaker.state(), "closed")
+
+    def test_async_calls_share_the_breaker(self):
+        async def upstream():
+            raise HTTPStatusError(502)
+
+        with mock.patch("llm_api.clients.asyncio.sleep", mock.AsyncMock()), self.assertRaises(UpstreamUnavailable):
+            asyncio.run(clients.acall("openai", upstream))
+        self.assertEqual(self.breaker.state(), "open")
+
+
+    def test_cancelled_trial_releases_the_half_open_breaker(self):
+        self.breaker.failures, self.breaker.opened_at = 3, time.monotonic() - 31
+        started = asyncio.Event()
+
+        async def hanging():
+            started.set()
+            await asyncio.sleep(60)
+
+        async def cancel_trial():
+            trial = asyncio.ensure_future(clients.acall("openai", hanging))
+            await started.wait()
+            # the trial is running, so other calls still fail fast
+            with self.assertRaises(UpstreamUnavailable):
+                await clients.acall("openai", mock.AsyncMock())
+            trial.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await trial
+
+        asyncio.run(cancel_trial())
+        self.assertEqual(self.breaker.state(), "half-open")
+        self.assertEqual(asyncio.run(clients.acall("openai", mock.AsyncMock(return_value="answer"))), "answer")
+        self.assertEqual(self.breaker.state(), "closed")
+
+    def test_interrupted_sync_trial_releases_the_breaker(self):
+        self.breaker.failures, self.breaker.opened_at = 3, time.monotonic() - 31
+        with self.assertRaises(KeyboardInterrupt):
+            clients.call("openai", mock.Mock(side_effect=KeyboardInterrupt))
+        self.assertEqual(clients.call("openai", mock.Mock(return_value="answer")), "answer")
+
+
+class SubmitErrorTests(TestCase):
+    """Failed upstream calls map to 502/503; request errors keep their own status."""
+
+    def setUp(self):
+        self.firm = Firm.objects.create(name="Errors Ltd")
+        MainDocument.objects.create(firm=self.firm, text="plan")
+        self.client = APIClient()
+        self.client.force_authenticate(User.objects.create_user("errors", "errors@example.com", "pw"))
+
+    def submit(self, data, **patches):
+        with mock.patch("llm_api.views.retrieve_chunks", return_value=([], [])), \
+                mock.patch("llm_api.views.semantic_cache.ENABLED", False), \
+                mock.patch("llm_api.views.chat_completion", **patches):
+            return self.client.post(f"/api/LLM/submit/{self.firm.id}/", data, format="json")
+
+    def test_unknown_document(self):
+        response = self.submit({"prompt": "question", "document_id": 99}, return_value=fake_completion("answer"))
+        self.assertEqual(response.status_code, 404)
+
+    def test_open_breaker(self):
+        response = self.submit({"prompt": "question"}, side_effect=UpstreamUnavailable("openai", 12.4))
+        self.assertEqual((response.status_code, response["Retry-After"]), (503, "12"))
+
+
+class LocalVectorStoreTests(SimpleTestCase):
+    """The on-disk store behind VECTOR_STORE=local, in a temporary directory."""
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = directory.name
+        self.store = LocalVectorStore(self.path)
+
+    def vectors(self, *texts):
+        return [{"id": text, "values": fake_vector(text), "metadata": {"text": text}} for text in texts]
+
+    def ids(self, text, namespace=None, top_k=3, store=None):
+        return [match.id for match in (store or self.store).query(fake_vector(text), top_k, namespace)]
+
+    def test_upsert_and_query(self):
+        self.store.upsert(self.vectors("чл. 1", "чл. 2", "чл. 3"), namespace="laws")
+        matches = self.store.query(fake_vector("чл. 2"), 2, "laws")
+        self.assertEqual(matches[0].id, "чл. 2")
+        self.assertAlmostEqual(matches[0].score, 1.0, places=5)
+        self.assertEqual(matches[0].metadata, {"text": "чл. 2"})
+        self.assertEqual(len(matches), 2)
+        self.assertGreaterEqual(matches[0].score, matches[1].score)
+
+    def test_namespaces_are_separate(self):
+        self.store.upsert(self.vectors("a", "b"), namespace="firm-1")
+        self.store.upsert(self.vectors("a", "c"), namespace="firm-2")
+        self.assertEqual(sorted(self.ids("a", "firm-1")), ["a", "b"])
+        self.assertEqual(sorted(self.ids("a", "firm-2")), ["a", "c"])
+        self.assertEqual(self.ids("a", "firm-3"), [])
+        self.assertEqual(self.ids("a"), [])  # the default namespace is its own
+
+    def test_upsert_replaces_and_delete_hides(self):
+        self.store.upsert(self.vectors("a", "b"), namespace="ns")
+        self.store.upsert([{"id": "a", "values": fake_vector("z"), "metadata": {"text": "new"}}], namespace="ns")
+        match = self.store.query(fake_vector("z"), 1, "ns")[0]
+        self.assertEqual((match.id, match.metadata), ("a", {"text": "new"}))
+        self.assertEqual(self.store.stats()["live"], 2)
+
+        self.store.delete(["a", "missing"], namespace="ns")
+        self.assertEqual(self.ids("z", "ns"), ["b"])
+        # re-adding a deleted id brings it back
+        self.store.upsert(self.vectors("a"), namespace="ns")
+        self.assertEqual(sorted(self.ids("a", "ns")), ["a", "b"])
+
+    def test_other_instances_see_writes(self):
+        reader = LocalVectorStore(self.path)
+        self.assertEqual(self.ids("a", "ns", store=reader), [])
+        self.store.upsert(self.vectors("a"), namespace="ns")
+        self.assertEqual(self.ids("a", "ns", store=reader), ["a"])
+        self.store.delete(["a"], namespace="ns")
+        self.assertEqual(self.ids("a", "ns", store=reader), [])
+
+    def test_failed_writes_roll_back(self):
+        self.store.upsert(self.vectors("a"), namespace="ns")
+        with self.assertRaises(ValueError):
+            self.store.upsert([{"id": "b", "values": [1.0, 0.0], "metadata": {}}], namespace="ns")
+        with mock.patch.object(self.store, "meta", side_effect=sqlite3.OperationalError("disk I/O error")), \
+                self.assertRaises(sqlite3.OperationalError):
+            self.store.upsert(self.vectors("c"), namespace="ns")
+
+        conn = self.store.connection()
+        real_execute = conn.execute
+
+        class FailingConnection:
+            in_transaction = property(lambda self: conn.in_transaction)
+
+            def execute(self, sql, *args):
+                if sql.startswith("UPDATE meta"):
+                    raise sqlite3.OperationalError("disk I/O error")
+                return real_execute(sql, *args)
+
+        with mock.patch.object(self.store, "connection", return_value=FailingConnection()), \
+                self.assertRaises(sqlite3.OperationalError):
+            self.store.delete(["a"], namespace="ns")
+
+        self.assertFalse(conn.in_transaction)
+        # another process can still write, and nothing from the failed writes is visible
+        LocalVectorStore(self.path).upsert(self.vectors("d"), namespace="ns")
+        self.assertEqual(sorted(self.ids("a", "ns")), ["a", "d"])
+
+    def test_stale_snapshot_drops_deleted_chunks_and_detects_compaction(self):
+        self.store.upsert(self.vectors("a", "b", "c"), namespace="ns")
+        self.store.upsert(self.vectors("x"), namespace="other")
+        snapshot = self.store.load()
+        writer = LocalVectorStore(self.path)
+        writer.delete(["a"], namespace="ns")
+        # scored against the old snapshot, the deleted chunk is still filtered out
+        self.assertEqual(sorted(m.id for m in self.store.query_snapshot(snapshot, fake_vector("a"), 10, "ns")),
+                         ["b", "c"])
+
+        writer.compact()
+        self.assertIsNone(self.store.query_snapshot(snapshot, fake_vector("b"), 10, "ns"))
+        self.assertEqual(self.ids("b", "ns", top_k=1), ["b"])
+        self.assertEqual(self.ids("x", "other", top_k=10), ["x"])
+
+    @mock.patch("llm_api.vector_store.COMPACT_MIN_DEAD", 2)
+    def test_queries_while_another_thread_compacts(self):
+        keep = [f"keep {i}" for i in range(20)]
+        self.store.upsert(self.vectors(*keep), namespace="ns")
+        errors, stop = [], threading.Event()
+
+        def read():
+            try:
+                while not stop.is_set():
+                    text = keep[len(errors) % len(keep)]
+                    matches = self.store.query(fake_vector(text), 1, "ns")
+                    if [m.id for m in matches] != [text]:
+                        errors.append(matches)
+            except Exception as e:
+                errors.append(e)
+
+        readers = [threading.Thread(target=read) for _ in range(3)]
+        for reader in readers:
+            reader.start()
+        try:
+            for round in range(15):
+                churn = [f"churn {round} {i}" for i in range(8)]
+                self.store.upsert(self.vectors(*churn), namespace="ns")
+                self.store.delete(churn, namespace="ns")  # compacts every round
+        finally:
+            stop.set()
+            for reader in readers:
+                reader.join()
+        self.assertEqual(errors, [])
+        self.assertGreaterEqual(self.store.stats()["layout"], 15)
+
+    @mock.patch("llm_api.vector_store.COMPACT_MIN_DEAD", 2)
+    def test_deletes_compact_the_vectors_file(self):
+        texts = [f"чл. {i}" for i in range(8)]
+        self.store.upsert(self.vectors(*texts), namespace="ns")
+        reader = LocalVectorStore(self.path)
+        self.assertEqual(self.ids("чл. 5", "ns", top_k=1, store=reader), ["чл. 5"])
+
+        self.store.delete(["чл. 1"], namespace="ns")  # 1 dead row: under the minimum
+        self.assertEqual(self.store.stats()["layout"], 0)
+        self.store.delete(["чл. 2", "чл. 6"], namespace="ns")
+        stats = self.store.stats()
+        self.assertEqual((stats["live"], stats["deleted"], stats["layout"]), (5, 0, 1))
+        self.assertEqual(os.path.getsize(self.store.vectors_file(1)), 5 * 8 * 4)
+
+        live = ["чл. 0", "чл. 3", "чл. 4", "чл. 5", "чл. 7"]
+        for text in live:
+            self.assertEqual(self.ids(text, "ns", top_k=1), [text])
+            # loaded before the compaction, the reader notices the new layout
+            self.assertEqual(self.ids(text, "ns", top_k=1, store=reader), [text])
+        self.assertEqual(sorted(self.ids("чл. 2", "ns", top_k=10)), live)
+
+        self.store.upsert(self.vectors("чл. 8"), namespace="ns")
+        self.assertEqual(self.ids("чл. 8", "ns", top_k=1, store=reader), ["чл. 8"])
+        self.store.compact()
+        self.assertFalse(os.path.exists(os.path.join(self.path, "vectors.f32")))
+        self.assertEqual(sorted(self.ids("чл. 8", "ns", top_k=10, store=reader)), sorted(live + ["чл. 8"]))
+
+
+LAW = """ЗАКОН ЗА ЗАДЪЛЖЕНИЯТА И ДОГОВОРИТЕ
+
+Глава първа
+ОБЩИ ПОЛОЖЕНИЯ
+
+Чл. 1. (1) Договорът е съглашение между две или повече лица.
+(2) Страните по договора са равни.
+Чл. 2. Договорът поражда задължения.
+1. първата точка;
+2. втората точка.
+
+Глава втора
+ИЗПЪЛНЕНИЕ
+
+Чл. 3. Длъжникът изпълнява в срок.
+"""
+REFERENCE = "Съгласно чл. 5, ал. 2, т. 3 от закона (изм. ДВ, бр. 58 от 2003 г.) договорът се прекратява."
+
+
+class ChunkingTests(SimpleTestCase):
+    def test_sentences_do_not_end_at_abbreviations(self):
+        text = f"{REFERENCE} Второ изречение! Чл. 4 се отменя; вж. т. 1."
+        self.assertEqual(SENTENCE_END.split(text),
+                         [REFERENCE, "Второ изречение!", "Чл. 4 се отменя;", "вж. т. 1."])
+
+    def test_chunks_follow_articles_and_paragraphs(self):
+        chunks = list(iter_chunks(LAW, max_tokens=400, min_tokens=0))
+        title = "ЗАКОН ЗА ЗАДЪЛЖЕНИЯТА И ДОГОВОРИТЕ"
+        self.assertEqual([chunk.metadata["path"] for chunk in chunks], [
+            f"{title} > Глава първа ОБЩИ ПОЛОЖЕНИЯ > Чл. 1, ал. 1 – Чл. 1, ал. 2",
+            f"{title} > Глава първа ОБЩИ ПОЛОЖЕНИЯ > Чл. 2 – Чл. 2, т. 2",
+            f"{title} > Глава втора ИЗПЪЛНЕНИЕ > Чл. 3",
+        ])
+        self.assertEqual(chunks[0].text, "Чл. 1. (1) Договорът е съглашение между две или повече лица.\n"
+                                         "(2) Страните по договора са равни.")
+        self.assertEqual(chunks[2].metadata["heading"], f"{title} > Глава втора ИЗПЪЛНЕНИЕ")
+
+    def test_small_articles_share_a_chunk_until_min_tokens(self):
+        chunks = list(iter_chunks(LAW, max_tokens=400, min_tokens=400))
+        # a heading still starts a new chunk
+        self.assertEqual(len(chunks), 2)
+        self.assertTrue(chunks[0].text.startswith("Чл. 1.") and "Чл. 2." in chunks[0].text)
+
+    def test_oversized_article_splits_at_sentences(self):
+        pages = [(3, "Чл. 7. " + " ".join([REFERENCE] * 6)), (4, "Чл. 8. Кратък текст.")]
+        chunks = list(iter_chunks(pages, max_tokens=120, min_tokens=0))
+
+        *parts, last = chunks
+        self.assertGreater(len(parts), 1)
+        self.assertTrue(parts[0].text.startswith("Чл. 7. Съгласно"))
+        for part in parts:
+            self.assertEqual((part.metadata["path"], part.metadata["page"]), ("Чл. 7", 3))
+            body = part.text.removeprefix("[Чл. 7]\n")
+            self.assertLessEqual(count_tokens(body), 120)
+            # whole sentences only: never cut after "чл.", "ал.", "т.", "бр." or "г."
+            self.assertTrue(body.endswith("прекратява."), body)
+        self.assertTrue(all(part.text.startswith("[Чл. 7]\n") for part in parts[1:]))
+        self.assertEqual((last.text, last.metadata["page"]), ("Чл. 8. Кратък текст.", 4))
+
+    def test_sentence_over_budget_splits_at_spaces(self):
+        text = "Чл. 9. " + " ".join(["думата"] * 200)
+        chunks = list(iter_chunks(text, max_tokens=50, min_tokens=0))
+        self.assertGreater(len(chunks), 1)
+        for chunk in chunks:
+            self.assertLessEqual(count_tokens(chunk.text.removeprefix("[Чл. 9]\n")), 50)
+        self.assertEqual(sum(chunk.text.count("думата") for chunk in chunks), 200)
+
+
+class FakePage:
+    def __init__(self, number, extracted):
+        self.number, self.extracted = number, extracted
+
+    def extract_text(self):
+        self.extracted.append(self.number)
+        return f"Чл. {self.number}. Текст на страница {self.number}." if self.number % 5 else None
+
+
+def fake_pdf_reader(page_count, extracted):
+    return lambda path: SimpleNamespace(pages=[FakePage(i + 1, extracted) for i in range(page_count)])
+
+
+def extract_in_process(path, results):
+    try:
+        results.put([number for number, _ in extraction.iter_pdf_pages(path)])
+    except BaseException as e:
+        results.put(repr(e))
+
+
+class PDFStreamingTests(SimpleTestCase):
+    """iter_pdf_pages with PyPDF2.PdfReader faked; the pool runs on threads so the fake reaches it."""
+
+    def setUp(self):
+        pdf = tempfile.NamedTemporaryFile(suffix=".pdf", delete=False)
+        pdf.write(b"%PDF-1.4 " + b"0" * 1024)
+        pdf.close()
+        self.addCleanup(os.unlink, pdf.name)
+        self.path = pdf.name
+        self.extracted = []
+
+    def pages(self, page_count, **settings):
+        from concurrent.futures import ThreadPoolExecutor
+
+        settings.setdefault("PDF_PARALLEL_MIN_PAGES", 100)
+        settings.setdefault("PDF_WORKERS", 2)
+        settings.setdefault("PDF_PAGES_PER_TASK", 3)
+        with mock.patch("PyPDF2.PdfReader", fake_pdf_reader(page_count, self.extracted)), \
+                mock.patch.object(extraction, "ProcessPoolExecutor",
+                                  lambda max_workers, **kwargs: ThreadPoolExecutor(max_workers)), \
+                mock.patch.multiple(extraction, **settings):
+            yield from extraction.iter_pdf_pages(self.path)
+
+    def test_pages_are_extracted_as_they_are_consumed(self):
+        pages = self.pages(8)
+        self.assertEqual(next(pages), (1, "Чл. 1. Текст на страница 1."))
+        self.assertEqual(self.extracted, [1])
+        rest = list(pages)
+        self.assertEqual([number for number, _ in rest], list(range(2, 9)))
+        self.assertEqual(rest[3], (5, ""))  # a page without a text layer
+
+    def test_large_pdfs_are_extracted_in_parallel_in_page_order(self):
+        pages = list(self.pages(20, PDF_PARALLEL_MIN_PAGES=10))
+        self.assertEqual([number for number, _ in pages], list(range(1, 21)))
+        self.assertEqual(pages[6], (7, "Чл. 7. Текст на страница 7."))
+        self.assertEqual(sorted(self.extracted), list(range(1, 21)))
+
+    def test_parallel_extraction_keeps_a_bounded_number_of_ranges_in_flight(self):
+        pages = self.pages(60, PDF_PARALLEL_MIN_PAGES=10)
+        next(pages)
+        time.sleep(0.1)
+        # 2 workers x 2 ranges of 3 pages, plus the range submitted before the first was yielded
+        self.assertLessEqual(len(self.extracted), 5 * 3)
+        pages.close()
+
+    def test_oversized_pdf_is_rejected_before_reading(self):
+        with self.assertRaises(extraction.DocumentTooLarge):
+            next(self.pages(3, PDF_MAX_BYTES=100))
+        self.assertEqual(self.extracted, [])
+
+    def extract_in_worker(self, daemon):
+        """Runs iter_pdf_pages on a real 12-page PDF in a forked process, as run_ingestion_worker does."""
+        import multiprocessing
+
+        import PyPDF2
+
+        writer = PyPDF2.PdfWriter()
+        for _ in range(12):
+            writer.add_blank_page(width=200, height=200)
+        with open(self.path, "wb") as f:
+            writer.write(f)
+        context = multiprocessing.get_context("fork")
+        results = context.Queue()
+        with mock.patch.multiple(extraction, PDF_PARALLEL_MIN_PAGES=5, PDF_WORKERS=2, PDF_PAGES_PER_TASK=4):
+            worker = context.Process(target=extract_in_process, args=(self.path, results), daemon=daemon)
+            worker.start()
+        try:
+            return results.get(timeout=60)
+        finally:
+            worker.join(timeout=10)
+
+    def test_large_pdf_in_a_worker_process_uses_the_pool(self):
+        self.assertEqual(self.extract_in_worker(daemon=False), list(range(1, 13)))
+
+    def test_large_pdf_in_a_daemonic_process_is_extracted_sequentially(self):
+        # a daemonic process may not start the pool; it used to fail with an AssertionError
+        self.assertEqual(self.extract_in_worker(daemon=True), list(range(1, 13)))
+
+    def test_worker_command_starts_processes_that_may_have_children(self):
+        from django.core.management import call_command
+
+        with mock.patch("multiprocessing.Process") as process:
+            call_command("run_ingestion_worker", processes=2, once=True, skip_keyword_sync=True,
+                         stdout=open(os.devnull, "w"))
+        self.assertEqual(process.call_count, 2)
+        self.assertFalse(any(call.kwargs.get("daemon") for call in process.call_args_list))
+        self.assertEqual(process.return_value.join.call_count, 2 + 2)
+
+    def test_pdf_job_chunks_carry_page_numbers(self):
+        job = SimpleNamespace(source_type=IngestionJob.SOURCE_PDF, file=SimpleNamespace(path=self.path))
+        with mock.patch("PyPDF2.PdfReader", fake_pdf_reader(3, self.extracted)):
+            chunks = list(iter_chunks(ingestion.extract_text(job), min_tokens=0))
+        self.assertEqual([(chunk.metadata["path"], chunk.metadata["page"]) for chunk in chunks],
+                         [("Чл. 1", 1), ("Чл. 2", 2), ("Чл. 3", 3)])
+
+
+WEBFORMS_PAGE = """<!DOCTYPE html>
+<html><head><title>Закон за задълженията и договорите - Lex</title>
+<script>var theForm = document.forms['form1'];</script></head>
+<body><form method="post" action="./Law.aspx" id="form1" runat="server">
+<input type="hidden" name="__VIEWSTATE" value="dDwtMTA4MTM2NDM3Njs7Pg==" />
+<header><h1>Закон за задълженията и договорите</h1></header>
+<nav><a href="/">Начало</a> <a href="/laws">Закони</a></nav>
+<div id="content">
+<h2>Глава първа</h2>
+<p>Чл. 1. (1) Договорът е съглашение между две или повече лица.</p>
+<p>(2) Страните по договора са равни.</p>
+<select name="version"><option>Редакция от 2003 г.</option></select>
+<textarea name="comment">Вашият коментар</textarea>
+<button type="submit">Търси</button>
+</div>
+<footer>Всички права запазени</footer>
+</form></body></html>"""
+
+
+class FakeResponse:
+    def __init__(self, body: bytes, content_type="text/html; charset=utf-8", **headers):
+        from email.message import Message
+
+        self.body = body
+        self.headers = Message()
+        self.headers["Content-Type"] = content_type
+        for name, value in headers.items():
+            self.headers[name.replace("_", "-")] = value
+
+    def read(self, size=-1):
+        block, self.body = (self.body, b"") if size < 0 else (self.body[:size], self.body[size:])
+        return block
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+class ExtractionTests(SimpleTestCase):
+    def fetch(self, response, **validators):
+        with mock.patch("urllib.request.urlopen", return_value=response) as urlopen:
+            result = extraction.fetch_url("https://lex.example/Law.aspx", **validators)
+        return result, urlopen.call_args.args[0]
+
+    def test_form_wrapped_page_keeps_its_content(self):
+        text = extraction.html_to_text(WEBFORMS_PAGE)
+        self.assertEqual(text, "# Закон за задълженията и договорите\n\n"
+                               "## Глава първа\n\n"
+                               "Чл. 1. (1) Договорът е съглашение между две или повече лица.\n\n"
+                               "(2) Страните по договора са равни.")
+        for chrome in ("VIEWSTATE", "Начало", "Редакция", "коментар", "Търси", "права", "theForm"):
+            self.assertNotIn(chrome, text)
+
+    def test_main_content_is_preferred(self):
+        article = "<p>" + "Чл. 2. Договорът поражда задължения. " * 10 + "</p>"
+        text = extraction.html_to_text(f"<div>Реклама</div><article>{article}</article>")
+        self.assertNotIn("Реклама", text)
+        self.assertTrue(text.startswith("Чл. 2."))
+        # too short to be the page's content: the whole body is used
+        self.assertIn("Реклама", extraction.html_to_text("<div>Реклама</div><main><p>Кратко.</p></main>"))
+
+    def test_fetch_decodes_declared_or_sniffed_charset(self):
+        page = "<html><body><p>Чл. 3. Длъжникът изпълнява в срок.</p></body></html>".encode("windows-1251")
+        result, request = self.fetch(FakeResponse(page, "text/html; charset=windows-1251", ETag='"v1"'))
+        self.assertEqual((result.text, result.etag), ("Чл. 3. Длъжникът изпълнява в срок.", '"v1"'))
+        self.assertEqual(result.content_hash, hashlib.sha256(result.text.encode("utf-8")).hexdigest())
+
+        sniffed = b'<meta charset="windows-1251">' + page
+        result, _ = self.fetch(FakeResponse(sniffed, "text/html"))
+        self.assertEqual(result.text, "Чл. 3. Длъжникът изпълнява в срок.")
+
+    def test_fetch_sends_validators_and_handles_not_modified(self):
+        import urllib.error
+
+        not_modified = urllib.error.HTTPError("https://lex.example/Law.aspx", 304, "Not Modified", {}, None)
+        with mock.patch("urllib.request.urlopen", side_effect=not_modified) as urlopen:
+            result = extraction.fetch_url("https://lex.example/Law.aspx", etag='"v1"', last_modified="Mon")
+        self.assertIsNone(result.text)
+        self.assertEqual(result.etag, '"v1"')
+        request = urlopen.call_args.args[0]
+        self.assertEqual((request.get_header("If-none-match"), request.get_header("If-modified-since")),
+                         ('"v1"', "Mon"))
+
+    def test_fetch_rejects_empty_oversized_and_unsupported_pages(self):
+        script_only = b"<html><head><title>App</title></head><body><form><div id='root'></div>" \
+                      b"<script>render()</script></form></body></html>"
+        with self.assertRaises(extraction.EmptyDocument):
+            self.fetch(FakeResponse(script_only))
+        with mock.patch.object(extraction, "URL_MAX_BYTES", 1024), self.assertRaises(extraction.DocumentTooLarge):
+            self.fetch(FakeResponse(b"<p>" + b"x" * 2048 + b"</p>"))
+        with mock.patch.object(extraction, "URL_MAX_BYTES", 1024), self.assertRaises(extraction.DocumentTooLarge):
+            self.fetch(FakeResponse(b"", Content_Length="4096"))
+        with self.assertRaises(extraction.UnsupportedContent):
+            self.fetch(FakeResponse(b"\x89PNG", "image/png"))
+
+
+class IncrementalIngestionTests(TestCase):
+    """Uploading a source again embeds only new or changed chunks and deletes the vectors of removed ones."""
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.store = LocalVectorStore(directory.name)
+        self.embedded = []
+
+        def create_embeddings(model, input):
+            self.embedded.extend(input)
+            return fake_embeddings(model, input)
+
+        for patcher in (
+            mock.patch("llm_api.model.create_embeddings", side_effect=create_embeddings),
+            mock.patch("llm_api.model.embedding_cache", EmbeddingCache(path=None)),
+            mock.patch("llm_api.model.keyword_index"),
+            mock.patch("llm_api.model.get_vector_store", return_value=self.store),
+            mock.patch("llm_api.model.EMBEDDING_MODEL", "text-embedding-3-small"),
+            mock.patch("llm_api.chunking.CHUNK_MIN_TOKENS", 0),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        self.user = User.objects.create_user("ingest", "ingest@example.com", "pw")
+        self.firm = Firm.objects.create(name="Кантора")
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def upload(self, *articles, **data):
+        response = self.client.post("/api/LLM/rag/", {"rag_EXTRA": "\n".join(articles), "name": "ЗЗД", **data},
+                                    format="json")
+        self.assertEqual(response.status_code, 202, response.content)
+        self.embedded.clear()
+        self.assertTrue(ingestion.process_next_job("worker-1"))
+        return IngestionJob.objects.get(id=response.json()["job_id"])
+
+    def search(self, text, namespace):
+        return [match.metadata["text"] for match in self.store.query(fake_vector(text), 10, namespace)]
+
+    def test_only_changed_chunks_are_embedded(self):
+        first = self.upload("Чл. 1. Първи текст.", "Чл. 2. Втори текст.", "Чл. 3. Трети текст.")
+        self.assertEqual(first.status, IngestionJob.STATUS_SUCCEEDED, first.error)
+        self.assertEqual(len(self.embedded), 3)
+        self.assertEqual(first.source.chunks.count(), 3)
+        namespace = user_namespace(self.user.id)
+        self.assertEqual(first.source.namespace, namespace)
+
+        second = self.upload("Чл. 1. Първи текст.", "Чл. 2. Изменен текст.", "Чл. 4. Нов текст.")
+        self.assertEqual(second.source_id, first.source_id)
+        self.assertEqual(self.embedded, ["Чл. 2. Изменен текст.", "Чл. 4. Нов текст."])
+        self.assertEqual({key: second.stats[key] for key in ("chunks", "added", "kept", "removed")},
+                         {"chunks": 3, "added": 2, "kept": 1, "removed": 2})
+        self.assertEqual(sorted(self.search("Чл. 1. Първи текст.", namespace)),
+                         ["Чл. 1. Първи текст.", "Чл. 2. Изменен текст.", "Чл. 4. Нов текст."])
+        self.assertEqual(second.source.chunks.count(), 3)
+
+        third = self.upload("Чл. 1. Първи текст.", "Чл. 2. Изменен текст.", "Чл. 4. Нов текст.")
+        self.assertEqual((self.embedded, third.stats["kept"]), ([], 3))
+
+    def test_firm_upload_recreates_a_deleted_source_for_the_firm(self):
+        response = self.client.post("/api/LLM/rag/", {"rag_EXTRA": "Чл. 1. Текст на кантората.", "firm_id": self.firm.id},
+                                    format="json")
+        job = IngestionJob.objects.get(id=response.json()["job_id"])
+        self.assertEqual(job.firm, self.firm)
+        job.source.delete()  # deleted while the job waits in the queue
+
+        self.assertTrue(ingestion.process_next_job("worker-1"))
+        job.refresh_from_db()
+        self.assertEqual(job.status, IngestionJob.STATUS_SUCCEEDED, job.error)
+        self.assertEqual((job.source.firm, job.source.namespace), (self.firm, firm_namespace(self.firm.id)))
+        self.assertEqual(self.search("Чл. 1. Текст на кантората.", firm_namespace(self.firm.id)),
+                         ["Чл. 1. Текст на кантората."])
+        self.assertEqual(self.search("Чл. 1. Текст на кантората.", user_namespace(self.user.id)), [])
+
+
+class HybridRetrievalTests(SimpleTestCase):
+    """BM25 keyword search next to the vector search, fused with RRF and reranked."""
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.index = KeywordIndex(os.path.join(directory.name, "keywords.sqlite3"))
+        with self.assertLogs("llm_api.retrieval", "WARNING") as logs:
+            self.index.connection()
+        self.assertIn("sync_keyword_index", logs.output[0])
+
+    def add(self, namespace, **texts):
+        self.index.add([{"id": chunk_id, "metadata": {"text": text}} for chunk_id, text in texts.items()],
+                       namespace=namespace)
+
+    def test_terms_are_stemmed_and_abbreviated(self):
+        self.assertEqual(terms("Член 5, алинея 2 от Закона за задълженията"),
+                         ["чл", "5", "ал", "2", "закона", "задълж"])
+        self.assertEqual(references("съгласно член 5 и § 3а"), {("чл", "5"), ("пар", "3а")})
+
+    def test_keyword_search_ranks_within_its_namespaces(self):
+        self.add("firm-1", a="Чл. 5. Неустойката се дължи при забава.", b="Чл. 6. Договорът е в писмена форма.")
+        self.add("firm-2", c="Неустойката не може да надвишава вредите.")
+        self.assertEqual([m.id for m in self.index.search("неустойка за забава", 10, "firm-1")], ["a"])
+        self.assertEqual({m.id for m in self.index.search("неустойката", 10, ["firm-1", "firm-2"])}, {"a", "c"})
+        self.assertEqual(self.index.search("неустойката", 10, "firm-3"), [])
+        self.assertEqual(self.index.search("и на от", 10, "firm-1"), [])  # stopwords only
+
+    def test_reindexing_and_deleting_ids(self):
+        self.add("ns", a="Чл. 1. Стар текст.")
+        self.add("ns", a="Чл. 1. Нов текст.")
+        self.assertEqual([m.metadata["text"] for m in self.index.search("текст", 10, "ns")], ["Чл. 1. Нов текст."])
+        self.assertEqual(self.index.search("стар", 10, "ns"), [])
+        self.index.delete(["a"], namespace="ns")
+        self.assertEqual((self.index.search("текст", 10, "ns"), self.index.ids("ns")), ([], set()))
+
+    def test_reciprocal_rank_fusion(self):
+        dense = [Match("a", 0.9, {"text": "A", "path": "Чл. 1"}), Match("b", 0.8, {"text": "B"})]
+        sparse = [Match("b", 7.0, {"text": "B"}), Match("c", 5.0, {"text": "C"}), Match("a", 1.0, {"text": "A"})]
+        fused = fuse([dense, sparse], k=60)
+        self.assertEqual([match.id for match, _ in fused], ["b", "a", "c"])
+        self.assertAlmostEqual(fused[0][1], 1 / 62 + 1 / 61)
+        self.assertAlmostEqual(fused[2][1], 1 / 62)
+        # the richer vector store metadata is kept
+        self.assertEqual(fused[1][0].metadata, {"text": "A", "path": "Чл. 1"})
+
+    def test_rerank_prefers_the_cited_article(self):
+        fused = [(Match("a", 0, {"text": "Общи правила за договорите."}), 0.033),
+                 (Match("b", 0, {"text": "Разни текстове.", "path": "Глава трета > Чл. 12"}), 0.030)]
+        self.assertEqual([match.id for match, _ in rerank("Какво гласи чл. 12?", fused)], ["b", "a"])
+        self.assertEqual(rerank("въпрос", []), [])
+
+    def test_select_keeps_to_the_token_budget(self):
+        ranked = [(Match(name, 0, {"text": "x" * size}), score)
+                  for name, size, score in [("big", 200, 3.0), ("huge", 400, 2.0), ("small", 40, 1.0)]]
+        with mock.patch("llm_api.retrieval.count_tokens", side_effect=len):
+            self.assertEqual([len(text) for text, _ in select(ranked, 5, 300)], [200, 40])
+            self.assertEqual([len(text) for text, _ in select(ranked, 1, 300)], [200])
+            # the best chunk is kept even over budget
+            self.assertEqual([len(text) for text, _ in select(ranked, 5, 100)], [200])
+
+    def test_rank_finds_what_only_keywords_match(self):
+        self.add("laws", a="Чл. 92. Неустойката обезпечава изпълнението.", b="Чл. 93. Задатъкът.")
+        dense = [Match("b", 0.82, {"text": "Чл. 93. Задатъкът."}), Match("x", 0.81, {"text": "Чл. 10. Друго."})]
+        sparse = self.index.search("чл. 92 неустойка", 20, "laws")
+        self.assertEqual([text for text, _ in rank("чл. 92 неустойка", dense, sparse, max_chunks=2)],
+                         ["Чл. 92. Неустойката обезпечава изпълнението.", "Чл. 93. Задатъкът."])
+
+
+class KeywordIndexSyncTests(TestCase):
+    """A host whose keyword index lacks uploaded chunks re-indexes them from the manifest and the vector store."""
+
+    def test_missing_chunks_are_reindexed(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        store = LocalVectorStore(os.path.join(directory.name, "vectors"))
+        index = KeywordIndex(os.path.join(directory.name, "keywords.sqlite3"))
+        with self.assertLogs("llm_api.retrieval", "WARNING"):
+            index.connection()  # a host that starts without the index file
+        user = User.objects.create_user("sync", "sync@example.com", "pw")
+        source = IngestionSource.objects.create(user=user, namespace="user-1", source_type="text", name="ЗЗД",
+                                                key="2" * 64)
+        texts = {"v-1": "Чл. 92. Неустойката обезпечава изпълнението.", "v-2": "Чл. 93. Задатъкът.",
+                 "v-3": "Чл. 94. Изгубен текст."}
+        store.upsert([{"id": vid, "values": fake_vector(text), "metadata": {"text": text}}
+                      for vid, text in texts.items() if vid != "v-3"], namespace="user-1")
+        for vid in texts:
+            IngestedChunk.objects.create(source=source, content_hash=vid * 8, vector_id=vid)
+        index.add([{"id": "v-2", "metadata": {"text": texts["v-2"]}}], namespace="user-1")
+
+        with mock.patch("llm_api.ingestion.get_vector_store", return_value=store), \
+                mock.patch("llm_api.ingestion.keyword_index", index), \
+                self.assertLogs("llm_api.ingestion", "WARNING"):
+            self.assertEqual(ingestion.sync_keyword_index(), {"restored": 1, "unavailable": 1})
+            self.assertEqual([m.id for m in index.search("неустойка", 10, "user-1")], ["v-1"])
+            self.assertEqual(ingestion.sync_keyword_index(), {"restored": 0, "unavailable": 1})
+        self.assertEqual(index.ids("user-1"), {"v-1", "v-2"})
+
+
+class NamespaceTests(TestCase):
+    """Uploads live in their firm's or user's namespace; a firm chat searches those next to the law corpus."""
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.store = LocalVectorStore(os.path.join(directory.name, "vectors"))
+        index = KeywordIndex(os.path.join(directory.name, "keywords.sqlite3"))
+        with self.assertLogs("llm_api.retrieval", "WARNING"):
+            index.connection()
+        for patcher in (
+            mock.patch("llm_api.model.create_embeddings", side_effect=fake_embeddings),
+            mock.patch("llm_api.model.embedding_cache", EmbeddingCache(path=None)),
+            mock.patch("llm_api.model.keyword_index", index),
+            mock.patch("llm_api.model.get_vector_store", return_value=self.store),
+            mock.patch("llm_api.model.EMBEDDING_MODEL", "text-embedding-3-small"),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        self.user = User.objects.create_user("owner", "owner@example.com", "pw")
+        self.firm = Firm.objects.create(name="Кантора")
+        self.other_firm = Firm.objects.create(name="Конкурент")
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def upload(self, text, firm=None):
+        data = {"rag_EXTRA": text, "name": "Бележки"}
+        if firm is not None:
+            data["firm_id"] = firm.id
+        response = self.client.post("/api/LLM/rag/", data, format="json")
+        self.assertEqual(response.status_code, 202, response.content)
+        self.assertTrue(ingestion.process_next_job("worker-1"))
+        return IngestionSource.objects.get(id=response.json()["source_id"])
+
+    def texts(self, query, scopes):
+        return [[text for text, _ in matches] for matches in retrieve_chunks(query, scopes)]
+
+    def test_uploads_go_to_their_own_namespace(self):
+        firm_source = self.upload("Чл. 1. Бележка на кантората.", self.firm)
+        user_source = self.upload("Чл. 1. Лична бележка.")
+        other_source = self.upload("Чл. 1. Бележка на конкурента.", self.other_firm)
+        # the same name is a separate source per firm
+        self.assertEqual(len({firm_source.id, user_source.id, other_source.id}), 3)
+        self.assertEqual([firm_source.namespace, user_source.namespace, other_source.namespace],
+                         [firm_namespace(self.firm.id), user_namespace(self.user.id),
+                          firm_namespace(self.other_firm.id)])
+
+        response = self.client.get(f"/api/LLM/rag/sources/?firm_id={self.firm.id}")
+        self.assertEqual([source["id"] for source in response.json()["sources"]], [firm_source.id])
+
+    def test_firm_chat_searches_its_firm_its_user_and_the_laws(self):
+        self.upload("Чл. 1. Неустойка по договора на кантората.", self.firm)
+        self.upload("Чл. 1. Неустойка в личните бележки.")
+        self.upload("Чл. 1. Неустойка по договора на конкурента.", self.other_firm)
+        self.store.upsert([{"id": "law-1", "values": fake_vector("закон"),
+                            "metadata": {"text": "Чл. 92. Неустойката обезпечава изпълнението."}}], namespace="laws")
+
+        dataset, laws = self.texts("неустойка", [
+            (firm_namespace(self.firm.id), user_namespace(self.user.id)), "laws"])
+        self.assertEqual(sorted(dataset), ["Чл. 1. Неустойка в личните бележки.",
+                                           "Чл. 1. Неустойка по договора на кантората."])
+        self.assertEqual(laws, ["Чл. 92. Неустойката обезпечава изпълнението."])
+        self.assertEqual(self.texts("неустойка", [firm_namespace(self.other_firm.id)]),
+                         [["Чл. 1. Неустойка по договора на конкурента."]])
+
+    def test_submit_searches_the_firm_scopes(self):
+        MainDocument.objects.create(firm=self.firm, text="plan")
+        with mock.patch("llm_api.views.retrieve_chunks", return_value=([], [])) as retrieve, \
+                mock.patch("llm_api.views.semantic_cache.ENABLED", False), \
+                mock.patch("llm_api.views.chat_completion", return_value=fake_completion("answer")), \
+                mock.patch("llm_api.views.LAW_NAMESPACE", "laws"):
+            response = self.client.post(f"/api/LLM/submit/{self.firm.id}/", {"prompt": "Неустойка?"}, format="json")
+        self.assertEqual(response.status_code, 200, response.content)
+        self.assertEqual(retrieve.call_args.args,
+                         ("Неустойка?", [(firm_namespace(self.firm.id), user_namespace(self.user.id)), "laws"]))
+
+    def test_small_namespace_in_a_large_store(self):
+        self.store.upsert([{"id": f"law-{i}", "values": fake_vector(f"закон {i}"), "metadata": {"text": str(i)}}
+                           for i in range(40)], namespace="laws")
+        self.store.upsert([{"id": "mine", "values": fake_vector("бележка"), "metadata": {"text": "mine"}}],
+                          namespace="firm-1")
+        matches = self.store.query(fake_vector("закон 3"), 5, "firm-1")
+        self.assertEqual([match.id for match in matches], ["mine"])
+        self.assertEqual(self.store.query(fake_vector("закон 3"), 1, "laws")[0].id, "law-3")
+
+
+class PaginationTests(TestCase):
+    """List endpoints return keyset pages of summaries; ?limit=, ?cursor= and ?fields= adjust them."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user("pages", "pages@example.com", "pw")
+        cls.firm = Firm.objects.create(name="Pages Ltd")
+        start = timezone.now() - datetime.timedelta(days=1)
+        for i in range(10):
+            Document.objects.create(firm=cls.firm, title=f"Document {i}", text=f"text {i}")
+            interaction = AIInteraction.objects.create(firm=cls.firm, user_prompt=f"prompt {i}", ai_response=f"answer {i}")
+            AIInteraction.objects.filter(id=interaction.id).update(created_at=start + datetime.timedelta(minutes=i))
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def pages(self, url, key):
+        pages = []
+        while url:
+            data = self.client.get(url).json()
+            pages.append(data[key])
+            url = data["next"]
+        return pages
+
+    def test_documents_page_by_number(self):
+        pages = self.pages(f"/api/LLM/documents/list/{self.firm.id}/?limit=4", "documents")
+        self.assertEqual([[d["document_number"] for d in page] for page in pages],
+                         [[1, 2, 3, 4], [5, 6, 7, 8], [9, 10]])
+        self.assertEqual(set(pages[0][0]), {"id", "firm", "document_number", "title", "uploaded_at", "updated_at"})
+
+        second = self.client.get(f"/api/LLM/documents/list/{self.firm.id}/?limit=4").json()["next"]
+        previous = self.client.get(second).json()["previous"]
+        self.assertEqual([d["document_number"] for d in self.client.get(previous).json()["documents"]], [1, 2, 3, 4])
+
+    def test_interactions_start_with_the_latest_in_chronological_order(self):
+        pages = self.pages(f"/api/LLM/interactions/{self.firm.id}/?limit=4", "interactions")
+        self.assertEqual([[i["user_prompt"] for i in page] for page in pages], [
+            ["prompt 6", "prompt 7", "prompt 8", "prompt 9"],
+            ["prompt 2", "prompt 3", "prompt 4", "prompt 5"],
+            ["prompt 0", "prompt 1"],
+        ])
+        self.assertNotIn("ai_response", pages[0][0])
+
+    def test_new_rows_do_not_shift_later_pages(self):
+        first = self.client.get(f"/api/LLM/interactions/{self.firm.id}/?limit=4").json()
+        AIInteraction.objects.create(firm=self.firm, user_prompt="newest", ai_response="answer")
+        second = self.client.get(first["next"]).json()
+        self.assertEqual([i["user_prompt"] for i in second["interactions"]],
+                         ["prompt 2", "prompt 3", "prompt 4", "prompt 5"])
+
+    def test_fields_and_limit(self):
+        data = self.client.get(f"/api/LLM/documents/list/{self.firm.id}/?fields=title,text,bogus&limit=2").json()
+        self.assertEqual(data["documents"], [{"title": "Document 0", "text": "text 0"},
+                                             {"title": "Document 1", "text": "text 1"}])
+        with mock.patch.object(pagination.DocumentPagination, "max_page_size", 3):
+            data = self.client.get(f"/api/LLM/documents/list/{self.firm.id}/?limit=1000").json()
+        self.assertEqual(len(data["documents"]), 3)
+        self.assertEqual(len(self.client.get(f"/api/LLM/documents/list/{self.firm.id}/").json()["documents"]), 10)
+
+    def test_firms_newest_first(self):
+        Firm.objects.create(name="Newest Ltd")
+        data = self.client.get("/api/LLM/firms/list/?limit=2").json()
+        self.assertEqual([firm["name"] for firm in data["firms"]], ["Newest Ltd", "Pages Ltd"])
+        self.assertEqual(set(data["firms"][0]), {"id", "name", "created_at"})
+        self.assertIsNone(data["next"])
+
+    def test_unknown_firm(self):
+        self.assertEqual(self.client.get("/api/LLM/documents/list/999/").status_code, 404)
+        self.assertEqual(self.client.get("/api/LLM/interactions/999/").status_code, 404)
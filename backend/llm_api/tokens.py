@@ -0,0 +1,48 @@
+"""
+Token counting used to size embedding batches and prompts.
+
+tiktoken is used when it is installed and its encoding files can be loaded;
+otherwise a conservative character-based estimate is returned so callers never
+fail because of the tokenizer.
+"""
+
+from functools import lru_cache
+
+DEFAULT_MODEL = "gpt-4"
+
+
+@lru_cache(maxsize=None)
+def _encoding(model: str):
+    try:
+        import tiktoken
+    except ImportError:
+        return None
+    try:
+        try:
+            return tiktoken.encoding_for_model(model)
+        except KeyError:
+            return tiktoken.get_encoding("cl100k_base")
+    except Exception:
+        # encodings are downloaded on first use; offline hosts fall back to the estimate
+        return None
+
+
+def count_tokens(text: str, model: str = DEFAULT_MODEL) -> int:
+    enc = _encoding(model or DEFAULT_MODEL)
+    if enc is None:
+        # Bulgarian text averages 2-3 characters per token, so this errs on the high side
+        return len(text) // 2 + 1
+    return len(enc.encode(text, disallowed_special=()))
+
+
+def truncate_to_tokens(text: str, max_tokens: int, model: str = DEFAULT_MODEL, marker: str = "\n[...]") -> str:
+    """Cuts text down to roughly max_tokens, keeping the beginning and appending marker."""
+    if max_tokens <= 0:
+        return ""
+    if count_tokens(text, model) <= max_tokens:
+        return text
+    budget = max(0, max_tokens - count_tokens(marker, model))
+    enc = _encoding(model or DEFAULT_MODEL)
+    if enc is None:
+        return text[:budget * 2] + marker
+    return enc.decode(enc.encode(text, disallowed_special=())[:budget]) + marker
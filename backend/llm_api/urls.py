@@ -4,6 +4,12 @@ from .views import (
     DeleteDocumentView, ListFirmDocumentsView, ListFirmsView,
  UpdateFirmDocumentView, ListFirmInteractionsView, EditMainDocumentAIView, RAGUploadView,  GetFirm,
     GetMainDocumentView, EditDeleteFirmView ,EditDocumentView,GetSingleDocumentView,
+    IngestionJobStatusView, IngestionSourceListView, IngestionSourceView, CacheStatsView, PlanStatusView, PlanStreamView,
+    WorkspaceView,
+)
+from .async_views import (
+    AsyncSubmitPromptView, AsyncCreateFirmView, AsyncEditMainDocumentAIView, AsyncAddNewDoc, AsyncRAGUploadView,
+    AsyncPlanStreamView,
 )
 #Most document interactions haven't been impleneted
 
@@ -11,9 +17,11 @@ urlpatterns = [
     path("submit/<int:firm_id>/", SubmitPromptView.as_view(), name="submit_prompt"),
     path("firms/initialize/", CreateFirmView.as_view(), name="create_firm"),
     path("interactions/<int:firm_id>/",
-         ListFirmInteractionsView.as_view(), name="create_firm"),
+         ListFirmInteractionsView.as_view(), name="list_firm_interactions"),
     path("firms/<int:firm_id>/update-main-document/",
          EditMainDocumentAIView.as_view(), name="update_main_document"),
+    path("firms/<int:firm_id>/plan/status/", PlanStatusView.as_view(), name="plan_status"),
+    path("firms/<int:firm_id>/plan/stream/", PlanStreamView.as_view(), name="plan_stream"),
     path("firms/list/", ListFirmsView.as_view(), name="list_firms_view"),
     path('document/<int:firm_id>/<int:document_number>/', GetSingleDocumentView.as_view(), name='get_single_document'),
     path("documents/upload/<int:firm_id>/",
@@ -24,9 +32,21 @@ urlpatterns = [
     path("documents/list/<int:firm_id>/", ListFirmDocumentsView.as_view(),
          name="list_firm_documents_view"),
     path("rag/", RAGUploadView.as_view(),
-        name="list_firm_documents_view"),
+        name="rag_upload"),
+    path("rag/jobs/<int:job_id>/", IngestionJobStatusView.as_view(), name="ingestion_job_status"),
+    path("rag/sources/", IngestionSourceListView.as_view(), name="ingestion_sources"),
+    path("rag/sources/<int:source_id>/", IngestionSourceView.as_view(), name="ingestion_source"),
+    path("cache/stats/", CacheStatsView.as_view(), name="cache_stats"),
     #path("firms/location/", FirmCreateLocationView.as_view(), name="create-firm-with-location"),
     path("firm/<int:firm_id>/", GetFirm.as_view(), name="get_firm"),
+    path("workspace/<int:firm_id>/", WorkspaceView.as_view(), name="firm_workspace"),
     path("documents/main/<int:firm_id>/", GetMainDocumentView.as_view(), name="get_firm_document"),
     path("firm/edit/<int:firm_id>/", EditDeleteFirmView.as_view(), name="edit_delete_firm"),
+    #async (ASGI) variants of the LLM-bound endpoints
+    path("async/submit/<int:firm_id>/", AsyncSubmitPromptView.as_view(), name="async_submit_prompt"),
+    path("async/firms/initialize/", AsyncCreateFirmView.as_view(), name="async_create_firm"),
+    path("async/firms/<int:firm_id>/plan/stream/", AsyncPlanStreamView.as_view(), name="async_plan_stream"),
+    path("async/firms/<int:firm_id>/update-main-document/", AsyncEditMainDocumentAIView.as_view(), name="async_update_main_document"),
+    path("async/documents/upload/<int:firm_id>/", AsyncAddNewDoc.as_view(), name="async_upload_document"),
+    path("async/rag/", AsyncRAGUploadView.as_view(), name="async_rag_upload"),
 ]
@@ -0,0 +1,387 @@
+"""
+Vector stores behind one interface: Pinecone, or a local index on disk.
+
+VECTOR_STORE=pinecone (default) keeps using the Pinecone index. With
+VECTOR_STORE=local the vectors live under VECTOR_STORE_PATH instead:
+normalized float32 rows in a raw file read through a NumPy memmap, and ids,
+namespaces and metadata in SQLite next to it. A query is one dot product
+over the memmapped matrix, so lookups stay in-process and take a few
+milliseconds for corpora of this size, and the full pipeline runs offline.
+"""
+
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+import threading
+import weakref
+from abc import ABC, abstractmethod
+from collections import namedtuple
+from contextlib import contextmanager
+from typing import Dict, Iterable, List, Optional
+
+try:
+    from .clients import (avector_query, get_pinecone, provide, vector_delete, vector_fetch, vector_query,
+                          vector_upsert)
+except ImportError:  # imported by model.py run as a standalone script
+    from clients import avector_query, get_pinecone, provide, vector_delete, vector_fetch, vector_query, vector_upsert
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "vector_store")
+
+# under Pinecone's 1000 ids per delete request and SQLite's old 999 bound parameters
+DELETE_BATCH_SIZE = 900
+# fetch responses carry the vector values too, so ask for fewer ids at a time
+FETCH_BATCH_SIZE = 200
+
+# namespaces under 1/NAMESPACE_GATHER_FRACTION of all rows are scored on their own rows only
+NAMESPACE_GATHER_FRACTION = 4
+
+# the local vectors file is rewritten without deleted rows once they are at least
+# COMPACT_MIN_DEAD and COMPACT_DEAD_FRACTION of all rows
+COMPACT_MIN_DEAD = int(os.getenv("VECTOR_STORE_COMPACT_MIN_DEAD", "1000"))
+COMPACT_DEAD_FRACTION = 0.25
+COMPACT_BLOCK_ROWS = 4096
+
+# same shape as a Pinecone match, so callers don't care which store answered
+Match = namedtuple("Match", ["id", "score", "metadata"])
+
+# what LocalVectorStore.load read in one transaction: the memmapped matrix of that
+# layout and the live rows per namespace; replaced as a whole, never modified
+Snapshot = namedtuple("Snapshot", ["generation", "layout", "matrix", "rows"])
+
+
+class VectorStore(ABC):
+    """Vectors are dicts with "id", "values" and "metadata", as Pinecone takes them."""
+
+    @abstractmethod
+    def upsert(self, vectors: List[dict], namespace: Optional[str] = None):
+        ...
+
+    @abstractmethod
+    def query(self, vector: List[float], top_k: int, namespace: Optional[str] = None) -> List[Match]:
+        ...
+
+    @abstractmethod
+    def delete(self, ids: Iterable[str], namespace: Optional[str] = None):
+        ...
+
+    @abstractmethod
+    def fetch_metadata(self, ids: Iterable[str], namespace: Optional[str] = None) -> Dict[str, dict]:
+        """Metadata of the stored vectors among ids, by id; unknown ids are left out."""
+
+    async def aquery(self, vector: List[float], top_k: int, namespace: Optional[str] = None) -> List[Match]:
+        # query blocks (SQLite, file reads), so stores without an async client run it in a worker thread
+        return await asyncio.to_thread(self.query, vector, top_k, namespace)
+
+
+class PineconeStore(VectorStore):
+    def __init__(self, index_name: Optional[str]):
+        self.index_name = index_name
+        # asyncio index clients, one per event loop (see async_index)
+        self.async_indexes = weakref.WeakKeyDictionary()
+
+    def upsert(self, vectors, namespace=None):
+        vector_upsert(vectors=vectors, namespace=namespace)
+
+    def query(self, vector, top_k, namespace=None):
+        result = vector_query(vector=vector, top_k=top_k, include_metadata=True, namespace=namespace)
+        return [Match(match.id, match.score, match.metadata) for match in result.matches]
+
+    def delete(self, ids, namespace=None):
+        ids = list(ids)
+        for start in range(0, len(ids), DELETE_BATCH_SIZE):
+            vector_delete(ids=ids[start:start + DELETE_BATCH_SIZE], namespace=namespace)
+
+    def fetch_metadata(self, ids, namespace=None):
+        ids, found = list(ids), {}
+        for start in range(0, len(ids), FETCH_BATCH_SIZE):
+            result = vector_fetch(ids=ids[start:start + FETCH_BATCH_SIZE], namespace=namespace)
+            found.update((vector_id, vector.metadata or {}) for vector_id, vector in result.vectors.items())
+        return found
+
+    async def async_index(self):
+        """
+        Returns the asyncio Pinecone index for the running event loop. Its aiohttp
+        session is bound to the loop, so each loop gets its own client.
+        """
+        loop = asyncio.get_running_loop()
+        async_index = self.async_indexes.get(loop)
+        if async_index is None:
+            host = await asyncio.to_thread(lambda: get_pinecone().describe_index(self.index_name).host)
+            async_index = get_pinecone().IndexAsyncio(host=host)
+            self.async_indexes[loop] = async_index
+        return async_index
+
+    async def aquery(self, vector, top_k, namespace=None):
+        result = await avector_query(await self.async_index(), vector=vector, top_k=top_k,
+                                     include_metadata=True, namespace=namespace)
+        return [Match(match.id, match.score, match.metadata) for match in result.matches]
+
+
+class LocalVectorStore(VectorStore):
+    """
+    Row i of the vectors file is the unit-length embedding of the chunk stored
+    with row=i in chunks.sqlite3. Upserting an existing id overwrites its row
+    in place; deleting marks it dead. Every write bumps a generation counter,
+    so other processes reading the same directory reload on their next query.
+
+    Once enough rows are dead, delete() compacts: the live rows are copied to
+    a new vectors file and renumbered in the same transaction that switches
+    the "layout" counter naming the file, so row numbers and file always
+    match. The previous file is removed at the next compaction, by when no
+    reader can still be about to map it.
+    """
+
+    def __init__(self, path: str = DEFAULT_PATH):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        self.db_path = os.path.join(path, "chunks.sqlite3")
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        # swapped in one assignment, so a query never pairs one load's matrix with another's rows
+        self.snapshot = Snapshot(None, None, None, {})
+        conn = self.connection()
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS chunks ("
+            " row INTEGER PRIMARY KEY, namespace TEXT NOT NULL, id TEXT NOT NULL,"
+            " metadata TEXT NOT NULL, live INTEGER NOT NULL DEFAULT 1,"
+            " UNIQUE (namespace, id))"
+        )
+        conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+        conn.execute("INSERT OR IGNORE INTO meta VALUES ('generation', 0)")
+        conn.execute("INSERT OR IGNORE INTO meta VALUES ('layout', 0)")
+        open(self.vectors_file(self.meta("layout")), "ab").close()
+
+    def vectors_file(self, layout: int) -> str:
+        return os.path.join(self.path, f"vectors.{layout}.f32" if layout else "vectors.f32")
+
+    def connection(self) -> sqlite3.Connection:
+        # sqlite connections can't be shared across threads, so keep one per thread
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self.local.conn = conn
+        return conn
+
+    def meta(self, key: str) -> Optional[int]:
+        row = self.connection().execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    @contextmanager
+    def write_transaction(self):
+        """
+        BEGIN IMMEDIATE ... COMMIT under the store's lock. Any error rolls back,
+        so a failed write never leaves the database locked for other processes.
+        """
+        conn = self.connection()
+        with self.lock:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield conn
+                conn.execute("COMMIT")
+            except BaseException:
+                if conn.in_transaction:  # a failed COMMIT may have rolled back already
+                    conn.execute("ROLLBACK")
+                raise
+
+    def upsert(self, vectors, namespace=None):
+        import numpy as np
+
+        if not vectors:
+            return
+        namespace = namespace or ""
+        matrix = np.asarray([v["values"] for v in vectors], dtype=np.float32)
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        matrix /= np.where(norms == 0, 1, norms)
+
+        with self.write_transaction() as conn:
+            dimension = self.meta("dimension")
+            if dimension is None:
+                dimension = matrix.shape[1]
+                conn.execute("INSERT INTO meta VALUES ('dimension', ?)", (dimension,))
+            elif dimension != matrix.shape[1]:
+                raise ValueError(f"Expected {dimension}-dimensional vectors, got {matrix.shape[1]}")
+
+            existing = dict(conn.execute(
+                "SELECT id, row FROM chunks WHERE namespace = ? AND id IN (%s)" % ",".join("?" * len(vectors)),
+                [namespace] + [v["id"] for v in vectors],
+            ).fetchall())
+            next_row = conn.execute("SELECT COALESCE(MAX(row) + 1, 0) FROM chunks").fetchone()[0]
+            with open(self.vectors_file(self.meta("layout")), "r+b") as f:
+                for v, values in zip(vectors, matrix):
+                    row = existing.get(v["id"])
+                    if row is None:
+                        row = existing[v["id"]] = next_row
+                        next_row += 1
+                    f.seek(row * dimension * 4)
+                    f.write(values.tobytes())
+            conn.executemany(
+                "INSERT OR REPLACE INTO chunks (row, namespace, id, metadata, live) VALUES (?, ?, ?, ?, 1)",
+                [(existing[v["id"]], namespace, v["id"], json.dumps(v.get("metadata") or {}, ensure_ascii=False))
+                 for v in vectors],
+            )
+            conn.execute("UPDATE meta SET value = value + 1 WHERE key = 'generation'")
+
+    def delete(self, ids, namespace=None):
+        ids = list(ids)
+        if not ids:
+            return
+        with self.write_transaction() as conn:
+            for start in range(0, len(ids), DELETE_BATCH_SIZE):
+                batch = ids[start:start + DELETE_BATCH_SIZE]
+                conn.execute(
+                    "UPDATE chunks SET live = 0 WHERE namespace = ? AND id IN (%s)" % ",".join("?" * len(batch)),
+                    [namespace or ""] + batch,
+                )
+            conn.execute("UPDATE meta SET value = value + 1 WHERE key = 'generation'")
+            live, dead = self.row_counts()
+            if dead >= COMPACT_MIN_DEAD and dead >= (live + dead) * COMPACT_DEAD_FRACTION:
+                self.compact_rows(conn)
+
+    def fetch_metadata(self, ids, namespace=None):
+        ids, found = list(ids), {}
+        for start in range(0, len(ids), DELETE_BATCH_SIZE):
+            batch = ids[start:start + DELETE_BATCH_SIZE]
+            found.update((chunk_id, json.loads(metadata)) for chunk_id, metadata in self.connection().execute(
+                "SELECT id, metadata FROM chunks WHERE live = 1 AND namespace = ? AND id IN (%s)"
+                % ",".join("?" * len(batch)), [namespace or ""] + batch))
+        return found
+
+    def compact(self):
+        """Rewrites the vectors file without deleted rows, whatever their share."""
+        with self.write_transaction() as conn:
+            self.compact_rows(conn)
+
+    def compact_rows(self, conn: sqlite3.Connection):
+        """Copies the live rows to the next layout's file and renumbers them; call inside write_transaction."""
+        import numpy as np
+
+        layout, dimension = self.meta("layout"), self.meta("dimension")
+        rows = [row for (row,) in conn.execute("SELECT row FROM chunks WHERE live = 1 ORDER BY row")]
+        with open(self.vectors_file(layout + 1), "wb") as f:
+            if rows:
+                source = self.vectors_file(layout)
+                old = np.memmap(source, dtype=np.float32, mode="r",
+                                shape=(os.path.getsize(source) // (dimension * 4), dimension))
+                for start in range(0, len(rows), COMPACT_BLOCK_ROWS):
+                    f.write(np.ascontiguousarray(old[rows[start:start + COMPACT_BLOCK_ROWS]]).tobytes())
+                del old
+        conn.execute("DELETE FROM chunks WHERE live = 0")
+        # in ascending order a row's new number is always free already
+        conn.executemany("UPDATE chunks SET row = ? WHERE row = ?",
+                         [(new, old) for new, old in enumerate(rows) if new != old])
+        conn.execute("UPDATE meta SET value = ? WHERE key = 'layout'", (layout + 1,))
+        conn.execute("UPDATE meta SET value = value + 1 WHERE key = 'generation'")
+        if layout:
+            try:
+                os.remove(self.vectors_file(layout - 1))
+            except OSError:
+                pass  # already gone, or still mapped on Windows; the next compaction skips it
+        logger.info("Compacted %s to %d rows (layout %d)", self.path, len(rows), layout + 1)
+
+    def load(self) -> Snapshot:
+        """
+        Returns the current snapshot, first re-mapping the matrix and re-reading
+        the live rows if another write happened since the last load.
+        """
+        import numpy as np
+
+        snapshot = self.snapshot
+        if self.meta("generation") == snapshot.generation:
+            return snapshot
+        with self.lock:
+            conn = self.connection()
+            # one snapshot, so the rows belong to the layout whose file is mapped
+            conn.execute("BEGIN")
+            try:
+                generation, layout, dimension = self.meta("generation"), self.meta("layout"), self.meta("dimension")
+                rows: Dict[str, list] = {}
+                for namespace, row in conn.execute("SELECT namespace, row FROM chunks WHERE live = 1"):
+                    rows.setdefault(namespace, []).append(row)
+                # sized after reading the rows: a committed row's vector is already in the file
+                path = self.vectors_file(layout)
+                size = os.path.getsize(path)
+                matrix = None
+                if dimension and size:
+                    matrix = np.memmap(path, dtype=np.float32, mode="r", shape=(size // (dimension * 4), dimension))
+            finally:
+                conn.execute("COMMIT")
+            snapshot = Snapshot(generation, layout, matrix,
+                                {namespace: np.asarray(r, dtype=np.int64) for namespace, r in rows.items()})
+            self.snapshot = snapshot
+            return snapshot
+
+    def query(self, vector, top_k, namespace=None):
+        while True:
+            snapshot = self.load()
+            matches = self.query_snapshot(snapshot, vector, top_k, namespace)
+            if matches is not None:
+                return matches
+            # compacted since the load, so the row numbers changed: load again and rescore
+
+    def query_snapshot(self, snapshot: Snapshot, vector, top_k, namespace=None) -> Optional[List[Match]]:
+        """Scores one snapshot; None when the store's layout no longer matches it."""
+        import numpy as np
+
+        matrix, rows = snapshot.matrix, snapshot.rows.get(namespace or "")
+        if matrix is None or rows is None or not len(rows):
+            return []
+
+        query = np.asarray(vector, dtype=np.float32)
+        norm = np.linalg.norm(query)
+        if norm:
+            query = query / norm
+        if len(rows) * NAMESPACE_GATHER_FRACTION < len(matrix):
+            # a small namespace in a big file: only read its rows
+            scores = matrix[rows] @ query
+        else:
+            # one pass over the whole memmap beats gathering the namespace's rows first
+            scores = (matrix @ query)[rows]
+        k = min(top_k, len(rows))
+        best = np.argpartition(-scores, k - 1)[:k]
+        best = best[np.argsort(-scores[best])]
+
+        top_rows = [int(r) for r in rows[best]]
+        conn = self.connection()
+        conn.execute("BEGIN")
+        try:
+            layout = self.meta("layout")
+            # chunks deleted since the load are dropped here
+            found = {
+                row: (chunk_id, json.loads(metadata))
+                for row, chunk_id, metadata in conn.execute(
+                    "SELECT row, id, metadata FROM chunks WHERE live = 1 AND namespace = ? AND row IN (%s)"
+                    % ",".join("?" * len(top_rows)), [namespace or ""] + top_rows)
+            }
+        finally:
+            conn.execute("COMMIT")
+        if layout != snapshot.layout:
+            return None
+        return [Match(found[row][0], float(score), found[row][1])
+                for row, score in zip(top_rows, scores[best]) if row in found]
+
+    def row_counts(self):
+        return self.connection().execute(
+            "SELECT COALESCE(SUM(live), 0), COALESCE(SUM(1 - live), 0) FROM chunks").fetchone()
+
+    def stats(self) -> Dict[str, int]:
+        live, dead = self.row_counts()
+        return {"live": live, "deleted": dead, "generation": self.meta("generation"), "layout": self.meta("layout")}
+
+
+def build_vector_store() -> VectorStore:
+    backend = os.getenv("VECTOR_STORE", "pinecone").lower()
+    if backend == "local":
+        return LocalVectorStore(os.getenv("VECTOR_STORE_PATH") or DEFAULT_PATH)
+    if backend == "pinecone":
+        return PineconeStore(os.getenv("PINECONE_INDEX_NAME"))
+    raise ValueError(f"Unknown VECTOR_STORE '{backend}' (expected 'pinecone' or 'local')")
+
+
+def get_vector_store() -> VectorStore:
+    return provide("vector_store", build_vector_store)
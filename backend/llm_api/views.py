@@ -1,27 +1,41 @@
 from rest_framework.parsers import MultiPartParser, FormParser, JSONParser
 from django.shortcuts import get_object_or_404
 from rest_framework import generics, status
-from rest_framework.permissions import IsAuthenticated
+from rest_framework.exceptions import APIException
+from rest_framework.permissions import IsAdminUser, IsAuthenticated
+from rest_framework.renderers import BaseRenderer, JSONRenderer
 from rest_framework.response import Response
 from rest_framework.views import APIView
 from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.db import transaction
+from django.http import Http404, StreamingHttpResponse
+from django.urls import reverse
+from django.utils import timezone
 from .models import Firm, MainDocument
 from .serializers import FirmSerializer
-from openai import OpenAI
 import os
-from .models import AIInteraction, Document
-from .serializers import DocumentSerializer, AIInteractionSerializer
-from pinecone import Pinecone
-from dotenv import load_dotenv
-from .model import query_pinecone, chunk_text,upsert_chunks
-import requests
-import requests
+from .models import AIInteraction, Document, IngestionJob, IngestionSource
+from .serializers import (
+    DocumentSerializer, IngestionJobSerializer, IngestionSourceSerializer,
+    AIInteractionSummarySerializer, DocumentSummarySerializer, FirmSummarySerializer,
+)
+from .pagination import DocumentPagination, FirmPagination, InteractionPagination
+from .model import retrieve_chunks, get_embedding, embedding_cache, firm_namespace, user_namespace
+from . import clients, semantic_cache
+from .clients import UpstreamUnavailable, chat_completion
+from .conversation import conversation_context, conversation_summary, schedule_summary_refresh
+from .extraction import PDF_MAX_BYTES
+from .ingestion import delete_source, source_for_job
+from .plans import expire_stale, fail_stale_plan, is_stale, start_plan_generation
+from .prompt_builder import PromptBuilder
+from .prompt_templates import registry as prompt_templates
+from .tokens import count_tokens
+import datetime
 import time
 import json
-import PyPDF2
-import urllib
+import logging
 
-load_dotenv()  # this should run BEFORE os.getenv is called
 
 # Headers
 
@@ -32,42 +46,150 @@ PINECONE_ENV = os.getenv("PINECONE_ENV")
 PINECONE_INDEX_NAME = os.getenv("PINECONE_INDEX_NAME")
 EMBEDDING_MODEL = os.getenv("PINECONE_EMBEDDING_MODEL")
 GPT_MODEL = os.getenv("GPT_MODEL")
-NAMESPACE = os.getenv("NAMESPACE", "default")
-TOP_K = 3
-
-openai_client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
-pc = Pinecone(api_key=PINECONE_API_KEY)
-index = pc.Index(PINECONE_INDEX_NAME)
-
-
-def get_embedding(text: str):
-    response = openai_client.embeddings.create(
-        model=EMBEDDING_MODEL,
-        input=[text]
-    )
-    return response.data[0].embedding
-
+# shared law corpus; uploads are searched in the firm's and the user's own namespaces
+LAW_NAMESPACE = os.getenv("NAMESPACE")
+
+logger = logging.getLogger(__name__)
+
+# a workspace cursor is this much older than the response, so writes still committing
+# while it was read come again in the next delta (clients merge by id / document number)
+WORKSPACE_CURSOR_OVERLAP = datetime.timedelta(seconds=5)
+# interactions in one ?since= delta; a client that fell further behind loads the workspace afresh
+WORKSPACE_DELTA_INTERACTIONS = 500
+
+# a plan stream ends after this long even if the plan is still generating; clients reconnect or poll the status
+PLAN_STREAM_MAX_SECONDS = float(os.getenv("PLAN_STREAM_MAX_SECONDS", "300"))
+# the same for the sync (WSGI) stream, which holds a worker meanwhile; 0 answers with the current state at once
+PLAN_STREAM_SYNC_MAX_SECONDS = float(os.getenv("PLAN_STREAM_SYNC_MAX_SECONDS", "0"))
+# comment lines sent while nothing changes, so proxies don't close an idle stream
+PLAN_STREAM_HEARTBEAT_SECONDS = 15
+
+# input tokens for the chat system prompt; gpt-4's 8k window leaves ~2k for the answer
+PROMPT_TOKEN_BUDGET = int(os.getenv("PROMPT_TOKEN_BUDGET", "6000"))
+
+CHAT_SYSTEM_TEMPLATE = (
+    "Answer in bulgarian. {instructions}\n\n"
+    "### Retrieved Dataset Context ###\n{dataset_context}\n\n"
+    "THIS IS THE MAIN DOCUMENT USE IT AT THE CORE OF YOUR USER RESPONSES:{main_document}THIS IS THE EXTRA DOCUMENT YOU SHOULD USE FOR CONTEXT:{document_context}\n\n"
+    "### Previous Interactions ###\n{history}\n\n"
+    "###THIS IS CONTEXTUAL INFORMATION FROM THE BULGARIAN FIRM CREATION LAWS CONNECTED WITH THE USER PROMPT WHICH YOU MUST USE TO GIVE ACCURATE DEPICTION OF THE COMPANY STARTUP PROCESS: {law_context}"
+    "{extra_instructions}"
+)
+
+
+#status for a failed OpenAI/Pinecone call: 503 while its circuit breaker is open, 502 for upstream errors
+def upstream_error_status(e):
+    if isinstance(e, UpstreamUnavailable):
+        return status.HTTP_503_SERVICE_UNAVAILABLE
+    from openai import APIError
+
+    if isinstance(e, APIError):
+        return status.HTTP_502_BAD_GATEWAY
+    return status.HTTP_500_INTERNAL_SERVER_ERROR
+
+
+def upstream_error_response(e):
+    response = Response({"error": str(e)}, status=upstream_error_status(e))
+    if isinstance(e, UpstreamUnavailable):
+        response["Retry-After"] = str(max(1, round(e.retry_after)))
+    return response
+
+
+#numbered chunk list used in system prompts
+def format_chunks(chunks):
+    return "\n".join([
+        f"--- Chunk {i+1} (score: {score:.2f}) ---\n{chunk}" for i, (chunk, score) in enumerate(chunks)
+    ])
+
+#namespaces searched together for a firm chat's dataset context: the firm's uploads and the user's own
+def dataset_namespaces(firm, user):
+    return (firm_namespace(firm.id), user_namespace(user.id))
+
+#"### Additional Context" block for an extra document picked in the chat
+def extra_document_context(firm, document_id):
+    if not document_id:
+        return ""
+    document = get_object_or_404(Document, firm=firm, document_number=document_id)
+    return f"\n\n### Additional Context from Document '{document.title}' ###\n{document.text}"
+
+#chat messages for SubmitPromptView (sync and async); returns them with the formatted RAG context
+def compose_chat_messages(firm, main_document, user_prompt, document_context, conversation_history,
+                          retrieved_chunks, law_chunks, save_as_document):
+    context_from_chunks = format_chunks(retrieved_chunks)
+
+    # full system prompt - normal sysPrompt file in prompts dir, dataset filtered info,
+    # documents context, conversation history, optional if creating a plan doc.
+    # Sections share the token budget by weight so long plans/history can't overflow the context.
+    builder = PromptBuilder(PROMPT_TOKEN_BUDGET, reserved=count_tokens(CHAT_SYSTEM_TEMPLATE) + count_tokens(user_prompt))
+    builder.add("instructions", f"{get_prompt_file('systemPrompt.txt')}", weight=None)
+    builder.add("extra_instructions", f"{get_prompt_file('extradocPrompt') if save_as_document else ''}", weight=None)
+    builder.add("dataset_context", context_from_chunks, weight=2)
+    builder.add("main_document", main_document.text, weight=4)
+    builder.add("document_context", document_context, weight=2)
+    builder.add("history", conversation_history, weight=2)
+    builder.add("law_context", format_chunks(law_chunks), weight=1)
+    full_system_prompt = CHAT_SYSTEM_TEMPLATE.format(**builder.build())
+    builder.log_breakdown(f"Firm {firm.id} chat prompt")
+
+    # user prompt included after chunked data about it
+    messages = [
+        {"role": "system", "content": full_system_prompt},
+        {"role": "user", "content": user_prompt}
+    ]
+    return messages, context_from_chunks
+
+#stores a chat interaction and, if requested, the answer as a new document
+def save_chat_interaction(firm, main_document, user_prompt, ai_response, save_as_document, cache_embedding=None, cache_context=""):
+    interaction = AIInteraction.objects.create(
+        firm=firm, user_prompt=user_prompt, ai_response=ai_response)
+    schedule_summary_refresh(firm)
+    if cache_embedding is not None:
+        semantic_cache.store(firm, main_document.version, prompt_templates.version("systemPrompt.txt"),
+                             cache_context, cache_embedding, interaction)
+    if save_as_document:
+        return Document.objects.create(
+            firm=firm,
+            title=f"AI Response for {firm.name}",
+            text=ai_response
+        )
+    return None
 
-def query_dataset_chunks(query: str):
-    query_vector = get_embedding(query)
-    result = index.query(
-        vector=query_vector,
-        top_k=TOP_K,
-        include_metadata=True,
-        namespace=NAMESPACE
+#messages asking the model to fold selected chat messages into the plan
+def plan_update_messages(current_plan, selected_messages):
+    system_prompt = (
+        f"Answer in bulgarian. You are an expert business consultant, text analyser and technical text writer. {get_prompt_file('GeneratePlan.txt')}\n\n"
+        f"Original plan {current_plan}"
     )
-    chunks = [(match.metadata["text"], match.score)
-              for match in result.matches]
-    return chunks
-
-#extract txt from filepath of prompt
+    pitch_text = "\n".join(selected_messages)
+    return [
+        {"role": "system", "content": system_prompt},
+        {"role": "user", "content": f"Update the plan using these pitch ideas:\n\n{pitch_text}"}
+    ]
+
+#messages asking the model to write a new document from selected chat messages
+def new_document_messages(selected_messages):
+    system_prompt = get_prompt_file("extradocPrompt")
+    pitch_text = "\n".join(selected_messages)
+    return [
+        {"role": "system", "content": f"{system_prompt} \n Write the documents using the provided messages"},
+        {"role": "user", "content": pitch_text}
+    ]
+
+#lets clients ask for Accept: text/event-stream without a 406 from content negotiation
+class EventStreamRenderer(BaseRenderer):
+    media_type = "text/event-stream"
+    format = "sse"
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        return json.dumps(data, ensure_ascii=False)
+
+#format one server-sent event frame
+def sse_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+#text of a template in prompts/, loaded once at startup by the prompt registry
 def get_prompt_file(path):
-    file_path = os.path.join(settings.BASE_DIR, "prompts", path)
-    if os.path.exists(file_path):
-        with open(file_path, "r", encoding="utf-8") as file:
-            return file.read()
-    else:
-        return Response({"error": "No planPrompt file"}, status=status.HTTP_400_BAD_REQUEST)
+    return prompt_templates.get(path)
 
 #CRUD for firms
 class EditDeleteFirmView(APIView):
@@ -115,31 +237,117 @@ class CreateFirmView(generics.CreateAPIView):
             f"Firm Budget : {firm_budget}\n"
             f"Extra user descriptions / notes : {firm_notes}\n"
         )
-        # big prompt
-        messages = [
-            {"role": "user",
-             "content": f"Answer in bulgarian. {get_prompt_file('GeneratePlan.txt')}. \n\n Firm details: {content}"}
-        ]
+        # the plan is generated in the background; follow it via firms/<id>/plan/status/ or plan/stream/
+        main_document = MainDocument.objects.create(firm=firm, text="", status=MainDocument.STATUS_GENERATING)
+        transaction.on_commit(lambda: start_plan_generation(main_document, content))
 
-        # model specifications
-        response = openai_client.chat.completions.create(
-            model="gpt-4",
-            messages=messages,
-            temperature=0.5
-        )
-        plan_text = response.choices[0].message.content.strip()
+        return Response({
+            "firm_id": firm.id,
+            "plan_status": main_document.status,
+            "status_url": f"/api/LLM/firms/{firm.id}/plan/status/",
+            "stream_url": f"/api/LLM/firms/{firm.id}/plan/stream/"
+        }, status=status.HTTP_201_CREATED)
+
+#status of a firm's main plan, including the text generated so far
+class PlanStatusView(APIView):
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request, firm_id):
+        main_document = expire_stale(get_object_or_404(MainDocument, firm_id=firm_id))
+        return Response({
+            "firm_id": firm_id,
+            "status": main_document.status,
+            "error": main_document.error,
+            "plan": main_document.text
+        }, status=status.HTTP_200_OK)
+
+def plan_stream_events(text, doc_status, error, sent):
+    """SSE events for one read of the plan after `sent` characters went out; returns (events, finished)."""
+    events = []
+    if len(text) > sent:
+        events.append(sse_event("token", {"text": text[sent:]}))
+    if doc_status == MainDocument.STATUS_READY:
+        return events + [sse_event("done", {"status": doc_status, "plan": text})], True
+    if doc_status == MainDocument.STATUS_FAILED:
+        return events + [sse_event("error", {"status": doc_status, "error": error})], True
+    return events, False
 
-        main_document = MainDocument.objects.create(firm=firm, text=plan_text)
-        main_document.save()
-        firm.save()
 
-        return Response({"firm_id": firm.id, "plan": plan_text}, status=status.HTTP_201_CREATED)
+def plan_stream_timeout(firm_id, doc_status):
+    return sse_event("timeout", {"status": doc_status, "status_url": f"/api/LLM/firms/{firm_id}/plan/status/"})
+
+
+#server-sent events with the plan text as it is generated (token events, then done or error, or timeout)
+class PlanStreamView(APIView):
+    """
+    The plan so far as server-sent events, for sync (WSGI) deployments.
+
+    URL: /api/LLM/firms/<int:firm_id>/plan/stream/
+    A WSGI worker serving a stream serves nothing else, so this view answers with
+    the text generated so far and, unless the plan is done or failed, a timeout
+    event pointing at plan/status/ to poll. PLAN_STREAM_SYNC_MAX_SECONDS lets it
+    wait for progress instead. The live stream is meant for ASGI:
+    /api/LLM/async/firms/<int:firm_id>/plan/stream/ (async_views.AsyncPlanStreamView).
+    """
+    permission_classes = [IsAuthenticated]
+    renderer_classes = [JSONRenderer, EventStreamRenderer]
+    poll_interval = 0.5
+    max_seconds = PLAN_STREAM_SYNC_MAX_SECONDS
+    heartbeat_seconds = PLAN_STREAM_HEARTBEAT_SECONDS
+
+    def get(self, request, firm_id):
+        get_object_or_404(MainDocument, firm_id=firm_id)
+        response = StreamingHttpResponse(self.events(firm_id), content_type="text/event-stream")
+        response["Cache-Control"] = "no-cache"
+        response["X-Accel-Buffering"] = "no"
+        return response
+
+    def events(self, firm_id):
+        sent = 0
+        started = last_write = time.monotonic()
+        while True:
+            row = MainDocument.objects.filter(firm_id=firm_id).values_list("id", "text", "status", "error", "updated_at").first()
+            if row is None:  # the firm was deleted meanwhile
+                yield sse_event("error", {"status": None, "error": "Plan not found."})
+                return
+            main_document_id, text, doc_status, error, updated_at = row
+            # a generation that stopped writing progress is over; read it again as failed (or moved on)
+            if is_stale(doc_status, updated_at):
+                fail_stale_plan(main_document_id, updated_at)
+                continue
+            events, finished = plan_stream_events(text, doc_status, error, sent)
+            yield from events
+            if finished:
+                return
+            now = time.monotonic()
+            if len(text) > sent:
+                sent = len(text)
+                last_write = now
+            if now - started >= self.max_seconds:
+                yield plan_stream_timeout(firm_id, doc_status)
+                return
+            if now - last_write >= self.heartbeat_seconds:
+                yield ": heartbeat\n\n"
+                last_write = now
+            time.sleep(self.poll_interval)
 
 #View for submitting prompts to llm
 class SubmitPromptView(generics.CreateAPIView):
+    """
+    Answers a user prompt using the firm's plan, history and RAG context.
+
+    URL: /api/LLM/submit/<int:firm_id>/
+    Add ?stream=1 to receive the answer as server-sent events (token, done, error)
+    instead of a single JSON response. With SEMANTIC_CACHE_ENABLED, plain prompts
+    (no document_id, not saved as a document) may be answered from the semantic cache.
+    Answers 409 while the plan is still being generated.
+    """
     permission_classes = [IsAuthenticated]
+    renderer_classes = [JSONRenderer, EventStreamRenderer]
 
     def post(self, request, firm_id):
+        # time to first token is counted from here, so retrieval and prompt assembly are included
+        self.started = time.perf_counter()
         # fields. Prompt is required, save as document is for extra document creation, document id if including an extra document
         user_prompt = request.data.get("prompt", "").strip()
         save_as_document = request.data.get("save_as_document", False)
@@ -148,68 +356,129 @@ class SubmitPromptView(generics.CreateAPIView):
         if not user_prompt:
             return Response({"error": "Prompt cannot be empty"}, status=status.HTTP_400_BAD_REQUEST)
 
-        firm = get_object_or_404(Firm, id=firm_id)
-        main_document_text = MainDocument.objects.filter(firm=firm_id)[0].text
-
-        # extra document context - if id is included, include extra document for context (not implemented)
-        document_context = ""
-        if document_id:
-            document = get_object_or_404(
-                Document, firm=firm, document_number=document_id)
-            document_context = f"\n\n### Additional Context from Document '{document.title}' ###\n{document.text}"
-
-        # conversation history for last 10 interactions
-        conversation_history = "\n".join([
-            f"User: {i.user_prompt}\nAI: {i.ai_response}" for i in
-            AIInteraction.objects.filter(
-                firm=firm).order_by("-created_at")[:10]
-        ])
-
-        # chunk the dataset
-        retrieved_chunks = query_dataset_chunks(user_prompt)
-        context_from_chunks = "\n".join([
-            f"--- Chunk {i+1} (score: {score:.2f}) ---\n{chunk}" for i, (chunk, score) in enumerate(retrieved_chunks)
-        ])
-
-        # full system prompt - normal sysPrompt file in prompts dir, dataset filtered info,
-        # documents context, last 10 interactions, optional if creating a plan doc
-        full_system_prompt = (
-            f"Answer in bulgarian. {get_prompt_file('systemPrompt.txt')}\n\n"
-            f"### Retrieved Dataset Context ###\n{context_from_chunks}\n\n"
-            f"THIS IS THE MAIN DOCUMENT USE IT AT THE CORE OF YOUR USER RESPONSES:{main_document_text}THIS IS THE EXTRA DOCUMENT YOU SHOULD USE FOR CONTEXT:{document_context}\n\n"
-            f"### Previous Interactions ###\n{conversation_history}\n\n"
-            f"###THIS IS CONTEXTUAL INFORMATION FROM THE BULGARIAN FIRM CREATION LAWS CONNECTED WITH THE USER PROMPT WHICH YOU MUST USE TO GIVE ACCURATE DEPICTION OF THE COMPANY STARTUP PROCESS: {query_pinecone(user_prompt)}"
-            f"{get_prompt_file('extradocPrompt') if save_as_document else ''}"
-        )
+        # one query for both; a firm without a plan has nothing to chat about
+        main_document = expire_stale(get_object_or_404(MainDocument.objects.select_related("firm"), firm_id=firm_id))
+        if main_document.status == MainDocument.STATUS_GENERATING:
+            return Response({"error": "The plan is still being generated."}, status=status.HTTP_409_CONFLICT)
+        firm = main_document.firm
+        stream = request.query_params.get("stream") in ("1", "true")
 
-        # user prompt included after chunked data about it
-        messages = [
-            {"role": "system", "content": full_system_prompt},
-            {"role": "user", "content": user_prompt}
-        ]
+        try:
+            return self.respond(firm, main_document, user_prompt, document_id, save_as_document, stream)
+        except (Http404, APIException):
+            raise  # e.g. an unknown document_id; DRF turns these into their own responses
+        except Exception as e:
+            logger.exception("Firm %s: answering the prompt failed", firm.id)
+            return upstream_error_response(e)
+
+    def respond(self, firm, main_document, user_prompt, document_id, save_as_document, stream):
+        # rolling summary of older interactions plus the latest raw turns
+        conversation_history = conversation_context(firm)
+        scopes = [dataset_namespaces(firm, self.request.user), LAW_NAMESPACE]
+
+        # near-identical plain questions against the same plan version, conversation summary and namespaces
+        # reuse an earlier answer
+        cache_embedding = None
+        self.cache_context = ""
+        if semantic_cache.ENABLED and not save_as_document and not document_id:
+            cache_embedding = get_embedding(user_prompt)
+            self.cache_context = semantic_cache.context_key(conversation_summary(firm), scopes)
+            cached = semantic_cache.lookup(firm, main_document.version, prompt_templates.version("systemPrompt.txt"),
+                                           self.cache_context, cache_embedding)
+            if cached:
+                entry, similarity = cached
+                ai_response = entry.interaction.ai_response
+                AIInteraction.objects.create(firm=firm, user_prompt=user_prompt, ai_response=ai_response)
+                schedule_summary_refresh(firm)
+                body = {"response": ai_response, "rag_context": "", "cached": True, "similarity": round(similarity, 4)}
+                if stream:
+                    return self.event_stream_response(iter([sse_event("token", {"text": ai_response}), sse_event("done", body)]))
+                return Response(body)
+
+        messages, context_from_chunks = self.build_messages(
+            firm, main_document, user_prompt, document_id, save_as_document, conversation_history, scopes)
+
+        if stream:
+            return self.event_stream_response(
+                self.stream_response(firm, main_document, user_prompt, messages, context_from_chunks, save_as_document, cache_embedding)
+            )
 
         # gpt model setup
-        response = openai_client.chat.completions.create(
+        response = chat_completion(
             model="gpt-4",
             messages=messages,
             temperature=0.5
         )
 
         ai_response = response.choices[0].message.content.strip()
-        AIInteraction.objects.create(
-            firm=firm, user_prompt=user_prompt, ai_response=ai_response)
+        document = save_chat_interaction(firm, main_document, user_prompt, ai_response, save_as_document,
+                                         cache_embedding, self.cache_context)
 
         # saving if making a new document
-        if save_as_document:
-            document = Document.objects.create(
-                firm=firm,
-                title=f"AI Response for {firm.name}",
-                text=ai_response
-            )
+        if document:
             return Response({"response": ai_response, "document": document.document_number, "message": "Response saved as document.","rag_context": context_from_chunks})
 
         return Response({"response": ai_response,"rag_context": context_from_chunks})
 
+    def event_stream_response(self, events):
+        response = StreamingHttpResponse(events, content_type="text/event-stream")
+        response["Cache-Control"] = "no-cache"
+        response["X-Accel-Buffering"] = "no"  # stop nginx from buffering the stream
+        return response
+
+    def build_messages(self, firm, main_document, user_prompt, document_id, save_as_document, conversation_history, scopes):
+        """Returns the chat messages for the prompt and the formatted RAG context."""
+        # extra document context - if id is included, include extra document for context (not implemented)
+        document_context = extra_document_context(firm, document_id)
+
+        # one embedding, all lookups in parallel; law chunks already in the dataset context are dropped
+        retrieved_chunks, law_chunks = retrieve_chunks(user_prompt, scopes)
+
+        return compose_chat_messages(firm, main_document, user_prompt, document_context,
+                                     conversation_history, retrieved_chunks, law_chunks, save_as_document)
+
+    def stream_response(self, firm, main_document, user_prompt, messages, context_from_chunks, save_as_document, cache_embedding=None):
+        """Yields the completion as SSE events and saves it once the stream ends."""
+        started = self.started
+        ttft_ms = None
+        parts = []
+
+        try:
+            stream = chat_completion(
+                model="gpt-4",
+                messages=messages,
+                temperature=0.5,
+                stream=True
+            )
+            for chunk in stream:
+                if not chunk.choices:
+                    continue
+                token = chunk.choices[0].delta.content
+                if not token:
+                    continue
+                if ttft_ms is None:
+                    ttft_ms = round((time.perf_counter() - started) * 1000)
+                    logger.info("Firm %s: first token after %d ms", firm.id, ttft_ms)
+                    yield sse_event("meta", {"ttft_ms": ttft_ms, "rag_context": context_from_chunks})
+                parts.append(token)
+                yield sse_event("token", {"text": token})
+        except Exception as e:
+            logger.exception("Firm %s: streaming completion failed", firm.id)
+            yield sse_event("error", {"error": str(e)})
+            return
+
+        ai_response = "".join(parts).strip()
+        document = save_chat_interaction(firm, main_document, user_prompt, ai_response, save_as_document,
+                                         cache_embedding, self.cache_context)
+        total_ms = round((time.perf_counter() - started) * 1000)
+        logger.info("Firm %s: streamed %d chars in %d ms", firm.id, len(ai_response), total_ms)
+
+        done = {"response": ai_response, "ttft_ms": ttft_ms, "total_ms": total_ms, "rag_context": context_from_chunks}
+        if document:
+            done["document"] = document.document_number
+            done["message"] = "Response saved as document."
+        yield sse_event("done", done)
+
 
 #edit documment (not implemented)
 class EditDocumentView(APIView):
@@ -246,25 +515,47 @@ class DeleteDocumentView(APIView):
             return Response({"error": "Document not found"}, status=status.HTTP_404_NOT_FOUND)
 
 
+#list views below return one keyset page of summaries; ?fields= and ?limit= / ?cursor= adjust them
+class SummaryListMixin:
+    """
+    For list views with a SummarySerializer and a keyset pagination_class: loads
+    only the requested fields from the database and serializes one page.
+    """
+
+    def requested_fields(self):
+        return self.get_serializer_class().requested_fields(self.request)
+
+    def page_data(self, queryset):
+        fields = self.requested_fields()
+        # the cursor is built from the ordering field, so it has to be loaded too
+        ordering = self.paginator.ordering.lstrip("-")
+        page = self.paginate_queryset(queryset.only(*dict.fromkeys(fields + [ordering])))
+        return self.get_serializer(page, many=True, fields=fields).data
+
+    def page_links(self):
+        return {"next": self.paginator.get_next_link(), "previous": self.paginator.get_previous_link()}
+
+
 #used to list all documents by title then select
-class ListFirmDocumentsView(generics.ListAPIView):
-    """Lists all documents for a specific firm."""
-    serializer_class = DocumentSerializer
+class ListFirmDocumentsView(SummaryListMixin, generics.ListAPIView):
+    """
+    Lists a firm's documents by document_number, a page at a time.
+    The text is left out unless asked for, e.g. ?fields=document_number,title,text.
+    """
+    serializer_class = DocumentSummarySerializer
+    pagination_class = DocumentPagination
     permission_classes = [IsAuthenticated]
 
     def get_queryset(self):
-        firm_id = self.kwargs.get("firm_id")
-        firm = get_object_or_404(Firm, id=firm_id)
-        return Document.objects.filter(firm=firm).order_by("document_number")
+        return Document.objects.filter(firm_id=self.kwargs["firm_id"])
 
     def list(self, request, firm_id, *args, **kwargs):
-        queryset = self.get_queryset()
-        firm = get_object_or_404(Firm, id=firm_id)
-        serializer = self.get_serializer(queryset, many=True)
+        firm = get_object_or_404(Firm.objects.only("id", "name"), id=firm_id)
         return Response({
             "firm_id": firm.id,
             "firm_name": firm.name,
-            "documents": serializer.data
+            "documents": self.page_data(self.get_queryset()),
+            **self.page_links(),
         })
 
 class GetSingleDocumentView(APIView):
@@ -285,41 +576,144 @@ class GetSingleDocumentView(APIView):
 
 
 #list all interactions (prompt + responce) with a firm
-class ListFirmInteractionsView(generics.ListAPIView):
-    """Lists all AI interactions for a specific firm."""
-    serializer_class = AIInteractionSerializer
+class ListFirmInteractionsView(SummaryListMixin, generics.ListAPIView):
+    """
+    Lists a firm's AI interactions. The first page holds the latest ones and
+    "next" goes back in time; each page is in chronological order. The answers
+    are left out unless asked for, e.g. ?fields=id,user_prompt,ai_response,created_at.
+    """
+    serializer_class = AIInteractionSummarySerializer
+    pagination_class = InteractionPagination
     permission_classes = [IsAuthenticated]
 
     def get_queryset(self):
-        firm_id = self.kwargs.get("firm_id")
-        firm = get_object_or_404(Firm, id=firm_id)
-        return AIInteraction.objects.filter(firm=firm).order_by("created_at")
+        return AIInteraction.objects.filter(firm_id=self.kwargs["firm_id"])
 
     def list(self, request, firm_id, *args, **kwargs):
-        queryset = self.get_queryset()
-        firm = get_object_or_404(Firm, id=firm_id)
-        serializer = self.get_serializer(queryset, many=True)
+        firm = get_object_or_404(Firm.objects.only("id", "name"), id=firm_id)
         return Response({
             "firm_id": firm.id,
             "firm_name": firm.name,
-            "interactions": serializer.data
+            "interactions": list(reversed(self.page_data(self.get_queryset()))),
+            **self.page_links(),
         })
 
 #list all firms
-class ListFirmsView(generics.ListAPIView):
-    """Lists all firms"""
-    serializer_class = FirmSerializer
+class ListFirmsView(SummaryListMixin, generics.ListAPIView):
+    """Lists firms, newest first, a page at a time (?fields= adds description, image, website)."""
+    serializer_class = FirmSummarySerializer
+    pagination_class = FirmPagination
     permission_classes = [IsAuthenticated]
 
     def get_queryset(self):
-        """Retrieve all firms"""
-        return Firm.objects.all().order_by("-created_at")
+        return Firm.objects.all()
 
     def list(self, request, *args, **kwargs):
-        """Customize response format"""
-        queryset = self.get_queryset()
-        serializer = self.get_serializer(queryset, many=True)
-        return Response({"firms": serializer.data})
+        return Response({"firms": self.page_data(self.get_queryset()), **self.page_links()})
+
+
+#everything the chat page shows for a firm, in one request
+class WorkspaceView(APIView):
+    """
+    The firm, its main document, the first page of document summaries and the
+    latest interactions in one round-trip (three queries). documents_next and
+    interactions_next continue the lists at documents/list/ and interactions/.
+
+    Passing a response's "cursor" back as ?since= returns only what changed
+    after it: documents created or edited since, new interactions, the main
+    document's text only if it changed, and document_numbers (all of the firm's
+    current numbers) so the client can drop deleted documents.
+    """
+    permission_classes = [IsAuthenticated]
+    main_document_fields = ["id", "status", "error", "version", "updated_at"]
+    interaction_fields = ["id", "user_prompt", "ai_response", "created_at"]
+
+    def get(self, request, firm_id):
+        since = None
+        if request.query_params.get("since"):
+            try:
+                since = datetime_from_cursor(request.query_params["since"])
+            except (ValueError, OverflowError):
+                return Response({"error": "since must be the cursor of an earlier workspace response."},
+                                status=status.HTTP_400_BAD_REQUEST)
+        cursor = timezone.now() - WORKSPACE_CURSOR_OVERLAP
+
+        main_fields = self.main_document_fields if since else self.main_document_fields + ["text"]
+        firm = get_object_or_404(
+            Firm.objects.select_related("maindocument")
+            .only("id", "name", "created_at", *(f"maindocument__{name}" for name in main_fields)),
+            id=firm_id,
+        )
+        data = {
+            "firm": FirmSummarySerializer(firm).data,
+            "main_document": self.main_document_data(firm, since),
+        }
+        if since:
+            data.update(self.changes(firm, since))
+        else:
+            data.update(self.first_pages(request, firm))
+        data["cursor"] = cursor_from_datetime(cursor)
+        return Response(data, status=status.HTTP_200_OK)
+
+    def main_document_data(self, firm, since):
+        try:
+            main_document = firm.maindocument
+        except MainDocument.DoesNotExist:
+            return None
+        data = {name: getattr(main_document, name) for name in self.main_document_fields}
+        if not since:
+            data["text"] = main_document.text
+        elif main_document.updated_at >= since:
+            data["text"] = MainDocument.objects.filter(id=main_document.id).values_list("text", flat=True).get()
+        return data
+
+    def first_pages(self, request, firm):
+        document_fields = DocumentSummarySerializer.Meta.summary_fields
+        documents = DocumentPagination()
+        document_page = documents.paginate_queryset(
+            Document.objects.filter(firm=firm).only(*document_fields), request, view=self)
+        # the cursors are valid for the list endpoints, which page the same way
+        documents.base_url = request.build_absolute_uri(reverse("list_firm_documents_view", args=[firm.id]))
+
+        interactions = InteractionPagination()
+        interaction_page = interactions.paginate_queryset(
+            AIInteraction.objects.filter(firm=firm).only(*self.interaction_fields), request, view=self)
+        interactions.base_url = request.build_absolute_uri(
+            reverse("list_firm_interactions", args=[firm.id]) + "?fields=" + ",".join(self.interaction_fields))
+
+        return {
+            "documents": DocumentSummarySerializer(document_page, many=True).data,
+            "documents_next": documents.get_next_link(),
+            # newest first from the paginator, chronological for the chat
+            "interactions": list(reversed(AIInteractionSummarySerializer(
+                interaction_page, many=True, fields=self.interaction_fields).data)),
+            "interactions_next": interactions.get_next_link(),
+        }
+
+    def changes(self, firm, since):
+        document_fields = DocumentSummarySerializer.Meta.summary_fields
+        documents = Document.objects.filter(firm=firm, updated_at__gte=since).only(*document_fields)
+        interactions = (AIInteraction.objects.filter(firm=firm, created_at__gte=since)
+                        .only(*self.interaction_fields).order_by("-created_at")[:WORKSPACE_DELTA_INTERACTIONS])
+        return {
+            "documents": DocumentSummarySerializer(documents, many=True).data,
+            "document_numbers": list(Document.objects.filter(firm=firm).order_by("document_number")
+                                     .values_list("document_number", flat=True)),
+            "interactions": list(reversed(AIInteractionSummarySerializer(
+                interactions, many=True, fields=self.interaction_fields).data)),
+        }
+
+
+CURSOR_EPOCH = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+
+
+def cursor_from_datetime(value):
+    """Workspace cursors are microseconds since the epoch: opaque, and safe in a query string."""
+    return str((value - CURSOR_EPOCH) // datetime.timedelta(microseconds=1))
+
+
+def datetime_from_cursor(cursor):
+    return CURSOR_EPOCH + datetime.timedelta(microseconds=int(cursor))
 
 
 #edit main (plan) document
@@ -349,36 +743,32 @@ class EditMainDocumentAIView(generics.CreateAPIView):
         if not selected_messages:
             return Response({"error": "selected_messages cannot be empty."}, status=status.HTTP_400_BAD_REQUEST)
 
-        # Retrieve the firm and its current main document (if any)
-        firm = get_object_or_404(Firm, id=firm_id)
-        main_document = MainDocument.objects.filter(firm=firm).first()
+        # Retrieve the current main document; the firm is only loaded when there is none yet
+        main_document = MainDocument.objects.filter(firm_id=firm_id).first()
+        firm = None if main_document else get_object_or_404(Firm, id=firm_id)
+        if main_document and expire_stale(main_document).status == MainDocument.STATUS_GENERATING:
+            return Response({"error": "The plan is still being generated."}, status=status.HTTP_409_CONFLICT)
         current_plan = main_document.text if main_document else "No existing plan."
 
         # Construct the system prompt
-        system_prompt = (
-            f"Answer in bulgarian. You are an expert business consultant, text analyser and technical text writer. {get_prompt_file("GeneratePlan.txt")}\n\n"
-            f"Original plan {current_plan}"
-        )
-        pitch_text = "\n".join(selected_messages)
-        messages = [
-            {"role": "system", "content": system_prompt},
-            {"role": "user", "content": f"Update the plan using these pitch ideas:\n\n{pitch_text}"}
-        ]
+        messages = plan_update_messages(current_plan, selected_messages)
 
         try:
-            response = openai_client.chat.completions.create(
+            response = chat_completion(
                 model=GPT_MODEL,
                 messages=messages,
                 temperature=0.1
             )
         except Exception as e:
-            return Response({"error": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+            return upstream_error_response(e)
 
         updated_plan = response.choices[0].message.content.strip()
 
         # Save the updated plan into the firm's main document (update or create)
         if main_document:
             main_document.text = updated_plan
+            # an edited plan is usable again, even if its generation had failed
+            main_document.status, main_document.error = MainDocument.STATUS_READY, ""
             main_document.save()
         else:
             MainDocument.objects.create(firm=firm, text=updated_plan)
@@ -398,32 +788,24 @@ class AddNewDoc(generics.CreateAPIView):
         firm = get_object_or_404(Firm, id=firm_id)
 
         # Construct the system prompt
-        system_prompt = get_prompt_file("extradocPrompt")
-        
-        pitch_text = "\n".join(selected_messages)
-        messages = [
-            {"role": "system", "content": f"{system_prompt} \n Write the documents using the provided messages"},
-            {"role": "user", "content": pitch_text}
-        ]
+        messages = new_document_messages(selected_messages)
 
         try:
-            response = openai_client.chat.completions.create(
+            response = chat_completion(
                 model=GPT_MODEL,
                 messages=messages,
                 temperature=0.3
             )
         except Exception as e:
-            return Response({"error": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+            return upstream_error_response(e)
 
         newDoc = response.choices[0].message.content.strip()
 
-        # Count current documents for the firm
-        doc_count = Document.objects.filter(firm=firm).count()
-        new_index = doc_count + 1
-
-        # Create the document with index in title
+        # Number the document first, so its title carries the same index
+        new_index = Document.next_number(firm.id)
         document = Document.objects.create(
             firm=firm,
+            document_number=new_index,
             title=f"Document {new_index}",
             text=newDoc
         )
@@ -436,9 +818,7 @@ class UpdateFirmDocumentView(APIView):
     permission_classes = [IsAuthenticated]
 
     def patch(self, request, firm_id, document_number):
-        firm = get_object_or_404(Firm, id=firm_id)
-        document = get_object_or_404(
-            Document, firm=firm, document_number=document_number, user=request.user)
+        document = get_object_or_404(Document, firm_id=firm_id, document_number=document_number)
 
         new_title = request.data.get("title", None)
         new_text = request.data.get("text", None)
@@ -469,7 +849,7 @@ class GetFirm(APIView):
         return Response(serializer.data, status=status.HTTP_200_OK)
     
     
-#Upload to RAG
+#Upload to RAG - queues an ingestion job that a worker (manage.py run_ingestion_worker) processes
 class RAGUploadView(APIView):
     parser_classes = [MultiPartParser, FormParser, JSONParser]
     permission_classes = [IsAuthenticated]
@@ -480,63 +860,88 @@ class RAGUploadView(APIView):
         text_input = request.data.get("rag_EXTRA", "").strip()
         url = request.data.get("url", "").strip()
         pdf_file = request.FILES.get("pdf_file")
+        # uploading again under the same name (or URL / file name) updates that source
+        name = request.data.get("name", "").strip()
+        # with a firm_id the upload is only used in that firm's chats, otherwise in all of the user's
+        firm_id = request.data.get("firm_id")
+        firm = get_object_or_404(Firm, id=firm_id) if firm_id else None
+
+        # 1. Handle PDF
+        if pdf_file:
+            if pdf_file.size > PDF_MAX_BYTES:
+                return Response({"error": f"PDF uploads are limited to {PDF_MAX_BYTES // 1024 // 1024} MB."},
+                                status=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
+            job = IngestionJob(user=user, source_type=IngestionJob.SOURCE_PDF, file=pdf_file)
+
+        # 2. Handle URL
+        elif url:
+            job = IngestionJob(user=user, source_type=IngestionJob.SOURCE_URL, url=url)
+
+        # 3. Handle raw text
+        elif text_input:
+            job = IngestionJob(user=user, source_type=IngestionJob.SOURCE_TEXT, text=text_input)
+
+        else:
+            return Response({
+                "error": "Provide either 'rag_EXTRA', 'url' or 'pdf_file'."
+            }, status=status.HTTP_400_BAD_REQUEST)
 
         try:
-            # 1. Handle PDF
-            if pdf_file:
-                reader = PyPDF2.PdfReader(pdf_file)
-                text = ""
-                for page in reader.pages:
-                    extracted = page.extract_text()
-                    if extracted:
-                        text += extracted
-
-            # 2. Handle URL
-            elif url:
-                text = ""
-                try:
-                    with urllib.request.urlopen(url, timeout=10) as response:
-                        url_content = response.read().decode("utf-8", errors="ignore")
-                        text += "\n\n[From URL]:\n" + url_content
-                except Exception as e:
-                    return Response(
-                        {"error": "Failed to fetch URL content", "details": str(e)},
-                        status=status.HTTP_400_BAD_REQUEST
-                    )
-
-            # 3. Handle raw text
-            elif text_input:
-                text = text_input
-
-            else:
-                return Response({
-                    "error": "Provide either 'rag_EXTRA', 'url' or 'pdf_file'."
-                }, status=status.HTTP_400_BAD_REQUEST)
-
-            if not text.strip():
-                return Response({
-                    "error": "No valid text found to process."
-                }, status=status.HTTP_400_BAD_REQUEST)
-
-            # Chunk and upsert to Pinecone
-            chunks = chunk_text(text)
-            timestamp = int(time.time())
-            metadata_prefix = f"user-{user.id}-{timestamp}"
-            upsert_chunks(chunks, metadata_prefix=metadata_prefix)
+            job.full_clean(exclude=["file"])
+        except ValidationError as e:
+            return Response({"error": "Invalid upload.", "details": e.message_dict}, status=status.HTTP_400_BAD_REQUEST)
+        job.firm = firm
+        job.source = source_for_job(job, name, firm)
+        job.save()
 
-            return Response({
-                "message": "Data successfully added to RAG.",
-                "chunks_uploaded": len(chunks),
-                "source_type": "pdf" if pdf_file else "url" if url else "text",
-                "metadata_prefix": metadata_prefix
-            }, status=status.HTTP_201_CREATED)
+        return Response({
+            "message": "Upload queued for RAG ingestion.",
+            "job_id": job.id,
+            "source_id": job.source_id,
+            "status": job.status,
+            "source_type": job.source_type
+        }, status=status.HTTP_202_ACCEPTED)
 
+
+#status and progress of a RAG ingestion job
+class IngestionJobStatusView(APIView):
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request, job_id):
+        job = get_object_or_404(IngestionJob, id=job_id, user=request.user)
+        return Response(IngestionJobSerializer(job).data, status=status.HTTP_200_OK)
+
+#documents in the user's RAG index
+class IngestionSourceListView(APIView):
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request):
+        sources = IngestionSource.objects.filter(user=request.user).order_by("-updated_at")
+        if request.query_params.get("firm_id"):
+            sources = sources.filter(firm_id=request.query_params["firm_id"])
+        return Response({"sources": IngestionSourceSerializer(sources, many=True).data}, status=status.HTTP_200_OK)
+
+
+class IngestionSourceView(APIView):
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request, source_id):
+        source = get_object_or_404(IngestionSource, id=source_id, user=request.user)
+        return Response(IngestionSourceSerializer(source).data, status=status.HTTP_200_OK)
+
+    def delete(self, request, source_id):
+        """Removes the source's vectors from the index, then the source."""
+        source = get_object_or_404(IngestionSource, id=source_id, user=request.user)
+        if source.jobs.filter(status=IngestionJob.STATUS_RUNNING).exists():
+            return Response({"error": "The source is being ingested; try again when the job has finished."},
+                            status=status.HTTP_409_CONFLICT)
+        try:
+            delete_source(source)
         except Exception as e:
-            return Response({
-                "error": "Failed to process and upload.",
-                "details": str(e)
-            }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
-            
+            logger.exception("Deleting RAG source %s failed", source_id)
+            return upstream_error_response(e)
+        return Response(status=status.HTTP_204_NO_CONTENT)
+
 class GetMainDocumentView(APIView):
     """
     Returns the main document for a firm.
@@ -553,13 +958,26 @@ class GetMainDocumentView(APIView):
     permission_classes = [IsAuthenticated]
 
     def get(self, request, firm_id):
-        firm = get_object_or_404(Firm, id=firm_id)
-        main_document = MainDocument.objects.filter(firm=firm).first()
+        main_document = MainDocument.objects.filter(firm_id=firm_id).only("text", "status").first()
 
         if not main_document:
             return Response({"error": "Main document not found for this firm."}, status=status.HTTP_404_NOT_FOUND)
 
         return Response({
-            "firm_id": firm.id,
-            "main_document": main_document.text
-        }, status=status.HTTP_200_OK)
\ No newline at end of file
+            "firm_id": firm_id,
+            "main_document": main_document.text,
+            "status": main_document.status
+        }, status=status.HTTP_200_OK)
+
+
+#hit rates of this process's caches, for tuning
+class CacheStatsView(APIView):
+    permission_classes = [IsAdminUser]
+
+    def get(self, request):
+        return Response({
+            "embeddings": embedding_cache.stats(),
+            "semantic": semantic_cache.counters.stats(),
+            "prompt_templates": prompt_templates.versions(),
+            "upstreams": clients.stats()
+        }, status=status.HTTP_200_OK)
@@ -1,6 +1,6 @@
 "use client";
 
-import React, { useState, useEffect } from "react";
+import React, { useState, useEffect, useRef } from "react";
 import { useRouter, useParams } from "next/navigation";
 import { FiMaximize2, FiMinimize2, FiDownload, FiChevronDown } from "react-icons/fi";
 import  apiFetch  from "@/app/apifetch";
@@ -18,42 +18,47 @@ export default function ChatPage() {
   const [mainDocument, setMainDocument] = useState("");
   const { firmId } = useParams();
   const router = useRouter();
+  // cursor of the last workspace response; later loads fetch only what changed since
+  const workspaceCursor = useRef(null);
+
+  const loadWorkspace = async () => {
+    const since = workspaceCursor.current;
+    const res = await apiFetch(
+      `http://localhost:8000/api/LLM/workspace/${firmId}/${since ? `?since=${since}` : ""}`
+    );
+    const data = await res.json();
+    if (!res.ok) throw new Error(data.error || "Workspace error");
+
+    setFirmName(data.firm.name);
+    if (data.main_document && data.main_document.text !== undefined) {
+      setMainDocument(data.main_document.text || "");
+    }
+    if (since) {
+      // replace edited documents, add new ones, drop deleted ones
+      setDocuments((prev) => {
+        const byNumber = new Map(prev.map((doc) => [doc.document_number, doc]));
+        data.documents.forEach((doc) => byNumber.set(doc.document_number, doc));
+        return data.document_numbers.filter((n) => byNumber.has(n)).map((n) => byNumber.get(n));
+      });
+      // messages sent from this page are already shown
+      const key = (msg) => `${msg.user_prompt}\n${msg.ai_response}`;
+      setChatHistory((prev) => {
+        const shown = new Set(prev.map(key));
+        return [...prev, ...data.interactions.filter((msg) => !shown.has(key(msg)))];
+      });
+    } else {
+      setDocuments(data.documents || []);
+      setChatHistory(data.interactions || []);
+    }
+    workspaceCursor.current = data.cursor;
+  };
 
   useEffect(() => {
     const token = localStorage.getItem("access");
     if (!firmId || !token) return;
 
-    apiFetch(`http://localhost:8000/api/LLM/interactions/${firmId}/`, {
-      headers: { Authorization: `Bearer ${token}` },
-    })
-      .then((res) => res.json())
-      .then((data) => setChatHistory(data.interactions || []))
-      .catch((err) => console.error("Chat history error:", err));
-
-    apiFetch(`http://localhost:8000/api/LLM/firm/${firmId}/`, {
-      headers: { Authorization: `Bearer ${token}` },
-    })
-      .then((res) => res.json())
-      .then((data) => setFirmName(data.name))
-      .catch((err) => console.error("Name fetching error:", err));
-
-    fetch(`http://localhost:8000/api/LLM/documents/main/${firmId}/`, {
-      headers: {
-        "Content-Type": "application/json",
-        Authorization: `Bearer ${token}`,
-      },
-    })
-      .then((res) => res.json())
-      .then((data) => setMainDocument(data.main_document || ""))
-      .catch((err) => console.error("Main doc error:", err));
-    fetch(`http://localhost:8000/api/LLM/documents/list/${firmId}/`, {
-      headers: {
-        "Content-Type": "application/json",
-        Authorization: `Bearer ${token}`,
-      },
-    })
-      .then(res => res.json())
-      .then(data => setDocuments(data.documents || []));
+    workspaceCursor.current = null;
+    loadWorkspace().catch((err) => console.error("Workspace error:", err));
   }, [firmId]);
 
   const handleDocumentSelect = async (docId, title) => {
@@ -150,19 +155,8 @@ export default function ChatPage() {
       alert("Документът е създаден успешно.");
       setSelectedIndexes([]); // optional: reset selected checkboxes
   
-      // Refresh documents list
-      const updatedDocs = await fetch(
-        `http://localhost:8000/api/LLM/documents/list/${firmId}/`,
-        {
-          headers: {
-            "Content-Type": "application/json",
-            Authorization: `Bearer ${token}`,
-          },
-        }
-      );
-      const docData = await updatedDocs.json();
-      setDocuments(docData.documents || []);
-      location.reload(true);
+      // Fetch only what changed
+      await loadWorkspace();
   
     } catch (err) {
       console.error("Document creation failed:", err);
@@ -203,19 +197,8 @@ export default function ChatPage() {
       alert("Планат е обновен успешно.");
       setSelectedIndexes([]); // optional: reset selected checkboxes
   
-      // Refresh documents list
-      const updatedDocs = await fetch(
-        `http://localhost:8000/api/LLM/documents/list/${firmId}/`,
-        {
-          headers: {
-            "Content-Type": "application/json",
-            Authorization: `Bearer ${token}`,
-          },
-        }
-      );
-      const docData = await updatedDocs.json();
-      setDocuments(docData.documents || []);
-      location.reload(true);
+      // Fetch only what changed
+      await loadWorkspace();
   
     } catch (err) {
       console.error("Document creation failed:", err);
@@ -252,19 +235,8 @@ export default function ChatPage() {
   
       alert("Документът е изтрит успешно.");
   
-      // Refresh documents list
-      const updatedDocs = await fetch(
-        `http://localhost:8000/api/LLM/documents/list/${firmId}/`,
-        {
-          headers: {
-            "Content-Type": "application/json",
-            Authorization: `Bearer ${token}`,
-          },
-        }
-      );
-      const docData = await updatedDocs.json();
-      setDocuments(docData.documents || []);
-      location.reload(true);
+      // Fetch only what changed
+      await loadWorkspace();
   
     } catch (err) {
       console.error("Document deletion failed:", err);
@@ -18,7 +18,7 @@ export default function ChatPage() {
       try {
         const token = localStorage.getItem("access");
         const res = await apiFetch(
-          `http://localhost:8000/api/LLM/interactions/${firmId}/`,
+          `http://localhost:8000/api/LLM/interactions/${firmId}/?fields=id,user_prompt,ai_response,created_at`,
           {
             headers: {
               Authorization: token ? `Bearer ${token}` : "",